@@ -0,0 +1,67 @@
+"""Compare decoding pipelined frames one at a time with decode_many.
+
+Run with ``python -m mux.benchmarks.batch``.  Each row decodes a buffer holding the given number
+of small framed messages, as a single recv on a busy connection returns, either by calling
+Fragments.decode_packet per frame or with one call to decode_many, and reports messages per
+second.  The encode columns compare framing each message separately with encode_many.
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from mux.dtab import Dtab
+from mux.wire import (
+    Fragments,
+    RreqOk,
+    Tdispatch,
+    Tping,
+    decode_many,
+    encode_many,
+    frame,
+)
+
+
+BATCH_SIZES = (1, 16, 64, 256)
+
+
+def make_batch(size):
+  kinds = (
+      lambda tag: Tdispatch(tag, (), '/s/service', Dtab.empty(), b'x' * 32),
+      lambda tag: RreqOk(tag, b'y' * 32),
+      Tping,
+  )
+  return [kinds[tag % len(kinds)](tag + 1) for tag in range(size)]
+
+
+def decode_each(buf):
+  view, offset, packets = memoryview(buf), 0, []
+  while offset < len(view):
+    consumed, packet = Fragments.decode_packet(view, offset)
+    packets.append(packet)
+    offset += consumed
+  return packets
+
+
+def rate(fn, messages, repeat=5):
+  number = max(1, 20000 // messages)
+  return number * messages / min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def main():
+  print('%-8s %14s %14s %14s %14s' % (
+      'batch', 'decode each', 'decode_many', 'frame each', 'encode_many'))
+  for size in BATCH_SIZES:
+    packets = make_batch(size)
+    buf = encode_many(packets)
+    assert buf == b''.join(frame(packet) for packet in packets)
+    print('%-8d %14.0f %14.0f %14.0f %14.0f' % (
+        size,
+        rate(lambda: decode_each(buf), size),
+        rate(lambda: decode_many(buf), size),
+        rate(lambda: b''.join(frame(packet) for packet in packets), size),
+        rate(lambda: encode_many(packets), size)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,220 @@
+"""Drive a loopback mux echo server and report end-to-end throughput and latency.
+
+Installed as the ``mux-load`` console script (or run ``python -m mux.benchmarks.load``.)  This
+starts a MuxServer whose handler echoes each request body, connects clients to it over a
+localhost TCP port or a unix socket, and keeps --concurrency requests in flight across them for
+--duration seconds.  Requests are a mix of Tdispatch (carrying --contexts contexts and a dtab of
+--dtab dentries) and Treq, in the proportion given by --dispatch-ratio.  For example:
+
+  mux-load --transport unix --concurrency 256 --payload 1024 --contexts 4 --dtab 10
+
+Latencies are recorded in microseconds in a log-linear histogram (see mux.histogram.)  Requests
+completing during the --warmup period are excluded.  Server and clients share one process and
+one event loop, so the figures are for a single core doing both halves of the work.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from mux.client import MuxClient
+from mux.dtab import Dtab
+from mux.histogram import Histogram
+from mux.server import MuxServer
+from mux.stats import clock
+from mux.wire import Rdispatch, Rreq
+
+
+def echo(request):
+  return request.body
+
+
+class LoadGenerator(object):
+  """Keeps concurrency requests in flight across clients until the deadline passes."""
+
+  def __init__(self, loop, clients, concurrency, payload, contexts=0, dentries=0,
+               dispatch_ratio=1.0, duration=5.0, warmup=0.0, seed=0):
+    self._loop = loop
+    self._clients = clients
+    self._concurrency = concurrency
+    self._body = b'x' * payload
+    self._contexts = tuple(
+        ('com.twitter.context.%d' % k, 'value-%d' % k) for k in range(contexts))
+    self._dtab = Dtab(('/s/%d' % k, '/$/inet/localhost/%d' % k) for k in range(dentries))
+    self._dispatch_ratio = dispatch_ratio
+    self._duration = duration
+    self._warmup = warmup
+    self._random = random.Random(seed)
+    self._issued = 0
+    self._active = 0
+    self._done = None
+    self._started = self._measuring = self._deadline = None
+    self.histogram = Histogram()
+    self.completed = self.errors = self.payload_bytes = 0
+    self.elapsed = 0.0
+
+  def start(self):
+    """Start issuing requests, returning a future that completes once the run has finished."""
+    self._done = self._loop.create_future()
+    self._started = clock()
+    self._measuring = self._started + self._warmup
+    self._deadline = self._measuring + self._duration
+    for _ in range(self._concurrency):
+      self._active += 1
+      self._issue()
+    return self._done
+
+  def _issue(self):
+    client = self._clients[self._issued % len(self._clients)]
+    self._issued += 1
+    if self._random.random() < self._dispatch_ratio:
+      future = client.dispatch('/s/echo', self._body, contexts=self._contexts, dtab=self._dtab)
+    else:
+      future = client.request(self._body)
+    start = clock()
+    future.add_done_callback(lambda future: self._complete(future, start))
+
+  def _complete(self, future, start):
+    now = clock()
+    if now >= self._measuring:
+      if future.cancelled() or future.exception() is not None:
+        self.errors += 1
+      else:
+        reply = future.result()
+        self.completed += 1
+        self.histogram.record(int((now - start) * 1e6))
+        if isinstance(reply, (Rdispatch, Rreq)):
+          self.payload_bytes += len(self._body) + len(reply.body)
+
+    if now < self._deadline and not future.cancelled():
+      self._issue()
+      return
+
+    self._active -= 1
+    if not self._active and not self._done.done():
+      self.elapsed = max(0.0, now - self._measuring)
+      self._done.set_result(self)
+
+  def report(self):
+    elapsed = self.elapsed or 1e-9
+    return dict(
+        requests=self.completed,
+        errors=self.errors,
+        seconds=self.elapsed,
+        requests_per_sec=self.completed / elapsed,
+        payload_bytes_per_sec=self.payload_bytes / elapsed,
+        latency_us=dict(
+            min=self.histogram.min or 0,
+            mean=self.histogram.mean,
+            p50=self.histogram.percentile(50),
+            p99=self.histogram.percentile(99),
+            p999=self.histogram.percentile(99.9),
+            max=self.histogram.max or 0,
+        ),
+    )
+
+
+def run(transport='tcp', connections=1, concurrency=64, payload=256, contexts=0, dentries=0,
+        dispatch_ratio=1.0, duration=5.0, warmup=1.0, loop=None, **session_kw):
+  """Run a load test against a fresh loopback echo server and return its report as a dict."""
+  own_loop = loop is None
+  loop = loop or asyncio.new_event_loop()
+  tmpdir = tempfile.mkdtemp() if transport == 'unix' else None
+  server = MuxServer(echo, loop=loop, **session_kw)
+  clients = []
+
+  try:
+    if transport == 'unix':
+      path = os.path.join(tmpdir, 'mux.sock')
+      loop.run_until_complete(server.listen_unix(path))
+
+      def connect():
+        return MuxClient.connect_unix(path, loop=loop, **session_kw)
+    elif transport == 'tcp':
+      loop.run_until_complete(server.listen('127.0.0.1', 0))
+      port = server.sockets[0].getsockname()[1]
+
+      def connect():
+        return MuxClient.connect('127.0.0.1', port, loop=loop, **session_kw)
+    else:
+      raise ValueError('Unknown transport %r' % transport)
+
+    for _ in range(connections):
+      clients.append(loop.run_until_complete(connect()))
+
+    generator = LoadGenerator(
+        loop, clients, concurrency, payload, contexts=contexts, dentries=dentries,
+        dispatch_ratio=dispatch_ratio, duration=duration, warmup=warmup)
+    loop.run_until_complete(generator.start())
+    report = generator.report()
+    report['config'] = dict(
+        transport=transport, connections=connections, concurrency=concurrency,
+        payload=payload, contexts=contexts, dentries=dentries, dispatch_ratio=dispatch_ratio)
+    return report
+  finally:
+    for client in clients:
+      client.close()
+    loop.run_until_complete(server.close())
+    if own_loop:
+      loop.close()
+    if tmpdir is not None:
+      shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def format_report(report):
+  latency = report['latency_us']
+  return '\n'.join([
+      '%d requests in %.2fs (%d errors)' % (
+          report['requests'], report['seconds'], report['errors']),
+      '%12.0f req/s' % report['requests_per_sec'],
+      '%12.0f payload bytes/s' % report['payload_bytes_per_sec'],
+      'latency (us): min %d  mean %.0f  p50 %d  p99 %d  p999 %d  max %d' % (
+          latency['min'], latency['mean'], latency['p50'], latency['p99'], latency['p999'],
+          latency['max']),
+  ])
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--transport', choices=('tcp', 'unix'), default='tcp')
+  parser.add_argument('--connections', type=int, default=1)
+  parser.add_argument('--concurrency', type=int, default=64,
+                      help='Requests kept in flight across all connections.')
+  parser.add_argument('--payload', type=int, default=256, help='Request body size in bytes.')
+  parser.add_argument('--contexts', type=int, default=0, help='Contexts per Tdispatch.')
+  parser.add_argument('--dtab', type=int, default=0, help='Dentries per Tdispatch.')
+  parser.add_argument('--dispatch-ratio', type=float, default=1.0,
+                      help='Fraction of requests sent as Tdispatch rather than Treq.')
+  parser.add_argument('--duration', type=float, default=5.0, help='Seconds to measure.')
+  parser.add_argument('--warmup', type=float, default=1.0, help='Seconds to run unmeasured.')
+  parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+  args = parser.parse_args(argv)
+
+  report = run(
+      transport=args.transport,
+      connections=args.connections,
+      concurrency=args.concurrency,
+      payload=args.payload,
+      contexts=args.contexts,
+      dentries=args.dtab,
+      dispatch_ratio=args.dispatch_ratio,
+      duration=args.duration,
+      warmup=args.warmup)
+
+  if args.json:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+  else:
+    print(format_report(report))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
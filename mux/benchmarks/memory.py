@@ -0,0 +1,75 @@
+"""Measure the memory held by each live message and routing value.
+
+Run with ``python -m mux.benchmarks.memory``.  For each kind of object this keeps COUNT
+instances alive at once and reports the bytes allocated per instance (via tracemalloc), which
+is the cost of a message sitting in flight or in a queue.  Bodies, contexts and dtabs are
+shared between the instances, as they are when decoded from identical frames, so the figures
+are the per-message overhead alone.
+"""
+
+from __future__ import print_function
+
+import tracemalloc
+
+from mux.dtab import Dtab
+from mux.parsers import parse_dtab, parse_path
+from mux.wire import (
+    Packet,
+    RdispatchOk,
+    RreqOk,
+    Tdispatch,
+    TraceId,
+    Treq,
+)
+
+
+COUNT = 10000
+
+CONTEXTS = (
+    ('com.twitter.finagle.Deadline', '1234567890'),
+    ('com.twitter.finagle.Retries', '0'),
+)
+
+
+def bytes_per_instance(make, count=COUNT):
+  """Return the bytes allocated per object by count calls to make, all kept alive."""
+  make()  # warm any caches the first call populates
+  tracemalloc.start()
+  try:
+    before = tracemalloc.get_traced_memory()[0]
+    instances = [make() for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+  finally:
+    tracemalloc.stop()
+  del instances
+  return (after - before) / count
+
+
+def measurements():
+  body = b'x' * 64
+  # Decode from views of one buffer, as a FrameDecoder does, so decoded bodies share it.
+  dispatch = memoryview(Tdispatch(1, CONTEXTS, '/s/service', Dtab.empty(), body).encode())
+  treq = memoryview(Treq(1, body, trace_id=TraceId(1, 2, 3)).encode())
+  path = '/s/service/method'
+  dtab = '/s => /$/inet/localhost/8080; /t => /s/a | /s/b'
+
+  return [
+      ('Tdispatch', lambda: Tdispatch(1, CONTEXTS, '/s/service', Dtab.empty(), body)),
+      ('Tdispatch (decoded)', lambda: Packet.decode(dispatch)),
+      ('Tdispatch (lazy)', lambda: Packet.decode(dispatch, lazy=True)),
+      ('RdispatchOk', lambda: RdispatchOk(1, CONTEXTS, body)),
+      ('Treq (decoded)', lambda: Packet.decode(treq)),
+      ('RreqOk', lambda: RreqOk(1, body)),
+      ('Path (parsed)', lambda: parse_path(path)),
+      ('Dtab (parsed)', lambda: parse_dtab(dtab)),
+  ]
+
+
+def main():
+  print('%-24s %14s' % ('object', 'bytes/object'))
+  for name, make in measurements():
+    print('%-24s %14.1f' % (name, bytes_per_instance(make)))
+
+
+if __name__ == '__main__':
+  main()
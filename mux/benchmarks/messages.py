@@ -0,0 +1,115 @@
+"""Microbenchmark encode and decode rates for every registered message type.
+
+Run with ``python -m mux.benchmarks.messages`` (under CPython and PyPy alike.)  Messages are
+small, so the numbers are dominated by per-message overhead: header packing, length prefixes
+and dispatch on the message type.
+
+Each rate is compared with the header path the wire module used before its codecs were
+precompiled: headers packed from format strings with struct.pack, and decoding that unpacked
+the type and tag separately and looked the type up with IMPLS.get.  Message bodies are encoded
+and decoded by the current code on both sides, so the speedup is that of the header path alone;
+for whole messages across the change, save a report with ``mux-benchmark --output`` on each
+commit and compare them with ``mux-benchmark --compare``.
+"""
+
+from __future__ import print_function
+
+import struct
+import timeit
+
+from mux.dtab import Dtab
+from mux.wire import (
+    Packet,
+    RdispatchOk,
+    Rdrain,
+    Rerr,
+    Rping,
+    RreqOk,
+    Tdiscarded,
+    Tdispatch,
+    Tdrain,
+    Tlease,
+    Tping,
+    TraceId,
+    Treq,
+)
+
+
+CONTEXTS = (
+    ('com.twitter.finagle.Deadline', '1234567890'),
+    ('com.twitter.finagle.Retries', '0'),
+)
+
+
+def sample_messages():
+  return [
+      Treq(1, b'x' * 64, trace_id=TraceId(1, 2, 3)),
+      RreqOk(1, b'x' * 64),
+      Tdispatch(1, CONTEXTS, '/s/service', Dtab.empty(), b'x' * 64),
+      RdispatchOk(1, CONTEXTS, b'x' * 64),
+      Tdrain(1),
+      Rdrain(1),
+      Tping(1),
+      Rping(1),
+      Tdiscarded(1, 'timed out'),
+      Tlease(1, Tlease.MILLISECONDS, 1000),
+      Rerr(1, 'failed'),
+  ]
+
+
+def legacy_encode_header(message_type, tag):
+  """Pack a header as Packet.encode_header did before the header codecs were precompiled."""
+  return bytearray().join([struct.pack('b', message_type), struct.pack('>I', tag)[1:]])
+
+
+def legacy_decode(buf):
+  """Decode a message as Packet.decode did before the header codecs were precompiled."""
+  if not isinstance(buf, memoryview):
+    if not isinstance(buf, (bytes, bytearray)):
+      raise TypeError('Packet.decode requires a bytes, bytearray or memoryview buffer.')
+    buf = memoryview(buf)
+
+  if len(buf) < 4:
+    raise ValueError('Buffer insufficient size for message.')
+
+  typ, = struct.unpack_from('b', buf, 0)
+  tag, = struct.unpack_from('>I', buf, 0)
+  tag &= 0xFFFFFF
+
+  impl = Packet.IMPLS.get(typ)
+
+  if impl is None:
+    raise ValueError('Unknown Tmessage (%d) 0x%x with tag 0x%x' % (typ, typ & 0xFF, tag))
+
+  try:
+    return impl.decode_body(tag, buf[4:])
+  except struct.error as e:
+    raise ValueError('Truncated %s: %s' % (impl.__name__, e))
+
+
+def rate(fn, number=20000, repeat=5):
+  """Best-of-repeat calls per second, which is the most stable figure on a noisy machine."""
+  return number / min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def main():
+  print('%-12s %12s %12s %12s %8s %12s %12s %8s' % (
+      'message', 'encodes/sec', 'headers/sec', 'legacy', 'speedup', 'decodes/sec', 'legacy',
+      'speedup'))
+  for msg in sample_messages():
+    encoded = msg.encode()
+    message_type, = struct.unpack_from('b', encoded, 0)
+    assert legacy_encode_header(message_type, msg.tag) == msg.encode_header(message_type)
+    assert legacy_decode(encoded).encode() == encoded
+    headers = rate(lambda: msg.encode_header(message_type))
+    legacy_headers = rate(lambda: legacy_encode_header(message_type, msg.tag))
+    decodes = rate(lambda: Packet.decode(encoded))
+    legacy_decodes = rate(lambda: legacy_decode(encoded))
+    print('%-12s %12.0f %12.0f %12.0f %7.2fx %12.0f %12.0f %7.2fx' % (
+        msg.__class__.__name__, rate(msg.encode),
+        headers, legacy_headers, headers / legacy_headers,
+        decodes, legacy_decodes, decodes / legacy_decodes))
+
+
+if __name__ == '__main__':
+  main()
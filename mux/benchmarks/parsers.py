@@ -0,0 +1,42 @@
+"""Compare mux.parsers with the character-at-a-time scanner it replaced.
+
+Run with ``python -m mux.benchmarks.parsers``.  Each row parses a dtab of the given number of
+dentries (of the shape typically carried in request headers) and reports parses per second for
+both implementations.
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from mux import parsers
+from mux.benchmarks import scanner
+
+
+DENTRY_COUNTS = (1, 10, 100, 500)
+
+
+def make_dtab(num_dentries):
+  return ';'.join(
+      '/s/service%d/\\x2dshard => /$/inet/10.0.%d.%d/8080 | (/s/fallback & /s/backup%d)' % (
+          k, k // 256, k % 256, k)
+      for k in range(num_dentries))
+
+
+def rate(fn, number, repeat=3):
+  return number / min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def main():
+  print('%-10s %16s %16s %8s' % ('dentries', 'scanner/sec', 'regex/sec', 'speedup'))
+  for count in DENTRY_COUNTS:
+    dtab = make_dtab(count)
+    assert parsers.parse_dtab(dtab) == scanner.parse_dtab(dtab)
+    number = max(1, 2000 // count)
+    old = rate(lambda: scanner.parse_dtab(dtab), number)
+    new = rate(lambda: parsers.parse_dtab(dtab), number)
+    print('%-10d %16.1f %16.1f %7.1fx' % (count, old, new, new / old))
+
+
+if __name__ == '__main__':
+  main()
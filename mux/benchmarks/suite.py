@@ -0,0 +1,253 @@
+"""Run every mux benchmark and emit the results as JSON.
+
+Installed as the ``mux-benchmark`` console script (or run ``python -m mux.benchmarks.suite``.)
+Results cover encode and decode rates for every registered message type across payload sizes
+and context counts, parsing of realistic dtabs and paths, framing, batch framing and memory per
+live message.  Save a run with --output and compare a later run against it with --compare:
+
+  mux-benchmark --output before.json
+  mux-benchmark --compare before.json
+
+Each result is identified by its group, name and parameters, and reports a rate in operations
+per second (higher is better) or a size in bytes (lower is better.)  Rates are the best of
+several timed runs.  Contexts and dtabs repeat from message to message, as they do in practice,
+so decoding benefits from the wire module's encoding cache.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+import timeit
+
+from mux.dtab import Dtab
+from mux.parsers import parse_dtab, parse_path
+from mux.wire import (
+    Packet,
+    Rdispatch,
+    RdispatchOk,
+    Rdrain,
+    Rerr,
+    Rping,
+    Rreq,
+    RreqOk,
+    Tdiscarded,
+    Tdispatch,
+    Tdrain,
+    Tlease,
+    Tping,
+    TraceId,
+    Treq,
+    decode_many,
+    encode_many,
+    frame,
+    unframe,
+)
+
+from .batch import make_batch
+from .parsers import make_dtab
+
+
+PAYLOAD_SIZES = (0, 1024, 64 * 1024)
+CONTEXT_COUNTS = (0, 8, 64)
+DENTRY_COUNTS = (10, 100, 1000)
+BATCH_SIZES = (16, 256)
+
+
+def make_contexts(count):
+  return tuple(('com.twitter.context.%d' % k, 'value-%d' % k) for k in range(count))
+
+
+# Sample messages by registered type: each is called with a payload and a contexts tuple, which
+# the message may ignore.  The suite refuses to run if a registered type has no sample here.
+SAMPLES = {
+    Treq: lambda body, contexts: Treq(1, body, trace_id=TraceId(1, 2, 3)),
+    Rreq: lambda body, contexts: RreqOk(1, body),
+    Tdispatch: lambda body, contexts: Tdispatch(1, contexts, '/s/service', Dtab.empty(), body),
+    Rdispatch: lambda body, contexts: RdispatchOk(1, contexts, body),
+    Tdrain: lambda body, contexts: Tdrain(1),
+    Rdrain: lambda body, contexts: Rdrain(1),
+    Tping: lambda body, contexts: Tping(1),
+    Rping: lambda body, contexts: Rping(1),
+    Tdiscarded: lambda body, contexts: Tdiscarded(1, 'timed out'),
+    Tlease: lambda body, contexts: Tlease(1, Tlease.MILLISECONDS, 1000),
+    Rerr: lambda body, contexts: Rerr(1, 'failed'),
+}
+
+HAS_PAYLOAD = frozenset([Treq, Rreq, Tdispatch, Rdispatch])
+HAS_CONTEXTS = frozenset([Tdispatch, Rdispatch])
+
+
+def measure(fn, min_time, repeat):
+  """Return the best-of-repeat rate of fn in calls per second.
+
+  The number of calls per run is first scaled up until a run lasts at least min_time.
+  """
+  number = 1
+  while True:
+    elapsed = timeit.timeit(fn, number=number)
+    if elapsed >= min_time:
+      break
+    number *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+  best = min([elapsed] + timeit.repeat(fn, number=number, repeat=repeat - 1))
+  return number / best
+
+
+def codec_results(rate):
+  for typ, make in sorted(SAMPLES.items(), key=lambda item: item[0].__name__):
+    payloads = PAYLOAD_SIZES if typ in HAS_PAYLOAD else (0,)
+    context_counts = CONTEXT_COUNTS if typ in HAS_CONTEXTS else (0,)
+    for payload in payloads:
+      for count in context_counts:
+        msg = make(b'x' * payload, make_contexts(count))
+        encoded = bytes(msg.encode())
+        params = dict(payload=payload, contexts=count)
+        yield 'codec', typ.__name__ + '.encode', params, rate(msg.encode)
+        yield 'codec', typ.__name__ + '.decode', params, rate(lambda: Packet.decode(encoded))
+        if typ in HAS_CONTEXTS:
+          yield 'codec', typ.__name__ + '.decode_lazy', params, rate(
+              lambda: Packet.decode(encoded, lazy=True))
+
+
+def parser_results(rate):
+  for count in DENTRY_COUNTS:
+    dtab = make_dtab(count)
+    yield 'parsers', 'parse_dtab', dict(dentries=count), rate(lambda: parse_dtab(dtab))
+  path = '/s/service/\\x2dshard/method/v1'
+  yield 'parsers', 'parse_path', dict(labels=5), rate(lambda: parse_path(path))
+
+
+def framing_results(rate):
+  msg = Tdispatch(1, make_contexts(2), '/s/service', Dtab.empty(), b'x' * 1024)
+  framed = frame(msg)
+  yield 'framing', 'frame', dict(payload=1024), rate(lambda: frame(msg))
+  yield 'framing', 'unframe', dict(payload=1024), rate(lambda: unframe(framed))
+  for size in BATCH_SIZES:
+    packets = make_batch(size)
+    buf = encode_many(packets)
+    params = dict(batch=size)
+    # Rates are reported per message rather than per batch.
+    yield 'framing', 'encode_many', params, rate(lambda: encode_many(packets)) * size
+    yield 'framing', 'decode_many', params, rate(lambda: decode_many(buf)) * size
+
+
+def memory_results():
+  try:
+    from .memory import bytes_per_instance, measurements
+  except ImportError:  # tracemalloc is unavailable before Python 3.4 and on PyPy
+    return
+  for name, make in measurements():
+    yield 'memory', name, {}, bytes_per_instance(make)
+
+
+GROUPS = ('codec', 'parsers', 'framing', 'memory')
+
+
+def run(groups=GROUPS, min_time=0.05, repeat=5, progress=None):
+  """Run the benchmark groups, returning a JSON-serializable report."""
+  missing = set(Packet.IMPLS.values()) - set(SAMPLES)
+  if missing:
+    raise ValueError('No benchmark sample for %s' % ', '.join(
+        sorted(typ.__name__ for typ in missing)))
+
+  def rate(fn):
+    return measure(fn, min_time, repeat)
+
+  producers = dict(
+      codec=lambda: codec_results(rate),
+      parsers=lambda: parser_results(rate),
+      framing=lambda: framing_results(rate),
+      memory=memory_results,
+  )
+
+  results = []
+  for group in groups:
+    for _, name, params, value in producers[group]():
+      result = dict(group=group, name=name, params=params)
+      result['bytes' if group == 'memory' else 'ops_per_sec'] = value
+      results.append(result)
+      if progress is not None:
+        progress(result)
+
+  return dict(
+      python=dict(
+          implementation=platform.python_implementation(),
+          version=platform.python_version()),
+      platform=platform.platform(),
+      timestamp=time.time(),
+      results=results,
+  )
+
+
+def result_key(result):
+  return (result['group'], result['name'], tuple(sorted(result['params'].items())))
+
+
+def describe(result):
+  params = ' '.join('%s=%s' % item for item in sorted(result['params'].items()))
+  return '%-8s %-24s %-24s' % (result['group'], result['name'], params)
+
+
+def format_result(result):
+  if 'bytes' in result:
+    return '%s %14.1f bytes' % (describe(result), result['bytes'])
+  return '%s %14.0f ops/sec' % (describe(result), result['ops_per_sec'])
+
+
+def compare(baseline, report):
+  """Return lines comparing each result of report with the same result in baseline.
+
+  The ratio is new/old for rates and old/new for sizes, so above 1.0 is always an improvement.
+  """
+  previous = dict((result_key(result), result) for result in baseline['results'])
+  lines = []
+  for result in report['results']:
+    old = previous.get(result_key(result))
+    if old is None:
+      lines.append('%s %14s' % (describe(result), 'new'))
+    elif 'bytes' in result:
+      lines.append('%s %14.2fx' % (describe(result), old['bytes'] / max(result['bytes'], 1)))
+    else:
+      lines.append('%s %14.2fx' % (describe(result), result['ops_per_sec'] / old['ops_per_sec']))
+  return lines
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('groups', nargs='*', metavar='group',
+                      help='Benchmark groups to run, of %s (default: all.)' % ', '.join(GROUPS))
+  parser.add_argument('--output', '-o', help='Write the JSON report to this file.')
+  parser.add_argument('--compare', help='Compare against the JSON report in this file.')
+  parser.add_argument('--min-time', type=float, default=0.05,
+                      help='Minimum duration of each timed run in seconds.')
+  parser.add_argument('--repeat', type=int, default=5, help='Timed runs per benchmark.')
+  parser.add_argument('--quiet', '-q', action='store_true', help='Do not print progress.')
+  args = parser.parse_args(argv)
+  for group in args.groups:
+    if group not in GROUPS:
+      parser.error('Unknown benchmark group %r' % group)
+
+  progress = None if args.quiet else lambda result: print(format_result(result), file=sys.stderr)
+  report = run(args.groups or GROUPS, min_time=args.min_time, repeat=args.repeat,
+               progress=progress)
+
+  if args.output:
+    with open(args.output, 'w') as fp:
+      json.dump(report, fp, indent=2, sort_keys=True)
+  elif not args.compare:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+
+  if args.compare:
+    with open(args.compare) as fp:
+      baseline = json.load(fp)
+    print('\n'.join(compare(baseline, report)))
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
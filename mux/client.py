@@ -0,0 +1,348 @@
+"""An asyncio mux client that multiplexes concurrent requests over a single connection."""
+
+import asyncio
+import functools
+import logging
+
+from .dtab import Dtab
+from .session import (
+    LeaseExpired,
+    MuxError,
+    ServerError,
+    Session,
+    SessionClosed,
+    SessionDraining,
+    protocol_future,
+    then,
+)
+from .stats import clock
+from .tags import MAX_TAG, TagPool, TagTable
+from .tracing import CLIENT_RECV, CLIENT_SEND, with_trace
+from .wire import (
+    Rdispatch,
+    Rdrain,
+    Rerr,
+    Rping,
+    Rreq,
+    Status,
+    Tdiscarded,
+    Tdispatch,
+    Tdrain,
+    Tlease,
+    Tping,
+    TraceFlag,
+    Treq,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class MuxClient(Session):
+  """A client session.
+
+  Every request is assigned a tag that is unique among the requests outstanding on the
+  connection, and returns a future that is completed by the reply carrying that tag, so any
+  number of requests may be in flight at once and replies may arrive in any order.
+
+  In addition to the session stats, the client gauges the requests awaiting a reply
+  (outstanding), records the time from issuing each request to its completion in microseconds
+  (request_latency_us), and counts replies that were nacks, errors or Rerrs.  With a tracer, the
+  client records cs and cr annotations for sampled requests.
+
+  Once the server issues a Tlease, requests may only be issued until the lease runs out; after
+  that they fail with LeaseExpired (counted as lease_expired) until the server grants a new one.
+  A zero-length lease stops requests straight away.
+
+  Given retries (a mux.retry.NackRetries), nacked requests are retried within its budget, and
+  the future of a request completes with the reply to its last attempt.
+  """
+
+  @classmethod
+  def connect(cls, host, port, loop=None, **kw):
+    """Connect to host:port, returning a future of the connected MuxClient."""
+    loop = loop or asyncio.get_event_loop()
+    return protocol_future(loop, loop.create_connection(lambda: cls(loop=loop, **kw), host, port))
+
+  @classmethod
+  def connect_unix(cls, path, loop=None, **kw):
+    """Connect to the unix socket at path, returning a future of the connected MuxClient."""
+    loop = loop or asyncio.get_event_loop()
+    return protocol_future(loop, loop.create_unix_connection(lambda: cls(loop=loop, **kw), path))
+
+  def __init__(self, loop=None, max_tag=MAX_TAG, retries=None, **kw):
+    super(MuxClient, self).__init__(loop=loop, **kw)
+    self._retries = retries
+    self._tags = TagPool(max_tag=max_tag)
+    self._outstanding = TagTable()
+    self._started = TagTable()  # tag -> issue time, kept only when stats are enabled
+    self._spans = TagTable()  # tag -> Span, for sampled requests
+    self._draining = False
+    self._lease_expiry = None  # loop time at which the current lease ends, if one was granted
+    self._handlers = {
+        Rdispatch: self._reply_received,
+        Rreq: self._reply_received,
+        Rping: self._reply_received,
+        Rerr: self._rerr_received,
+        Tping: self._tping_received,
+        Tdrain: self._tdrain_received,
+        Tlease: self._tlease_received,
+    }
+
+  @property
+  def outstanding(self):
+    """The number of requests awaiting a reply."""
+    return len(self._outstanding)
+
+  @property
+  def draining(self):
+    return self._draining
+
+  @property
+  def lease_remaining(self):
+    """The seconds left on the server's lease, or None if no lease limits this session."""
+    if self._lease_expiry is None:
+      return None
+    return max(0.0, self._lease_expiry - self._loop.time())
+
+  @property
+  def available(self):
+    """Whether requests may be issued: the session is open, not draining and has a lease."""
+    return self.is_open and not self._draining and (
+        self._lease_expiry is None or self._loop.time() < self._lease_expiry)
+
+  def dispatch(self, dest, body, contexts=(), dtab=None, parent=None):
+    """Issue a Tdispatch, returning a future of the Rdispatch reply.
+
+    parent is the trace of the request this one is made on behalf of (see mux.tracing.extract.)
+    """
+    dtab = Dtab.empty() if dtab is None else dtab
+    trace = None
+    if self._tracer is not None:
+      trace = self._tracer.client_trace(parent)
+      contexts = with_trace(contexts, trace)
+    return self._send(lambda tag: Tdispatch(tag, contexts, dest, dtab, body), trace, dest)
+
+  def request(self, body, trace_id=None, trace_flag=None, parent=None):
+    """Issue a Treq, returning a future of the Rreq reply.
+
+    Unless trace_id is given, the Treq carries a trace from the session's tracer, if it has one.
+    """
+    trace = None
+    if self._tracer is not None:
+      if trace_id is None:
+        trace = self._tracer.client_trace(parent)
+      else:
+        trace = trace_id, trace_flag or TraceFlag.default()
+      trace_id, trace_flag = trace
+    return self._send(
+        lambda tag: Treq(tag, body, trace_id=trace_id, trace_flag=trace_flag), trace, 'treq')
+
+  def ping(self):
+    """Issue a Tping, returning a future of the Rping reply."""
+    return self._issue(Tping, leased=False)
+
+  def _send(self, make_packet, trace, name):
+    if self._retries is None:
+      span = None if trace is None else self._tracer.client_span(trace, name)
+      return self._issue(make_packet, span)
+    # Each attempt records its own span.
+    return self._retries.issue(self._loop, lambda: self._issue(
+        make_packet, None if trace is None else self._tracer.client_span(trace, name)))
+
+  def _issue(self, make_packet, span=None, leased=True):
+    future = self._loop.create_future()
+
+    if not self.is_open:
+      future.set_exception(SessionClosed('Session is not connected.'))
+      return future
+
+    if self._draining:
+      future.set_exception(SessionDraining('Session is draining.'))
+      return future
+
+    if leased and self._lease_expiry is not None and self._loop.time() >= self._lease_expiry:
+      self._stats.counter('lease_expired')
+      future.set_exception(LeaseExpired('Session has no lease from the server.'))
+      return future
+
+    tag = self._tags.acquire()
+    if tag is None:
+      future.set_exception(MuxError('No free tags: %d requests outstanding.' % (
+          len(self._outstanding))))
+      return future
+
+    self._outstanding[tag] = future
+    if self._stats.enabled:
+      self._started[tag] = clock()
+      self._stats.gauge('outstanding', len(self._outstanding))
+    future.add_done_callback(functools.partial(self._future_done, tag))
+    if span is not None:
+      span.annotate(CLIENT_SEND)
+      self._spans[tag] = span
+    try:
+      self.send(make_packet(tag))
+    except Exception:
+      # Nothing was written (a packet that cannot be encoded fails before any of it is), so
+      # forget the request and free its tag before the error reaches the caller.
+      self._outstanding.pop(tag)
+      self._started.pop(tag)
+      self._spans.pop(tag)
+      self._tags.release(tag)
+      raise
+    return future
+
+  def _future_done(self, tag, future):
+    # A request cancelled by the caller keeps its tag until the server acknowledges the discard
+    # by replying, so that a late reply can never be mistaken for the reply to a newer request.
+    if future.cancelled() and self._outstanding.get(tag) is future and self.is_open:
+      aborted = self.abort_stream(tag)
+      self.send(Tdiscarded(tag, 'Request cancelled by client.'))
+      if aborted:
+        # The final fragment was never written, so the server only drops the fragments it has
+        # and will not reply: the tag can be released straight away.
+        self._complete(tag)
+
+  def _complete(self, tag, result=None, exception=None):
+    future = self._outstanding.pop(tag)
+    if future is None:
+      log.warning('Received reply for unknown tag %d', tag)
+      return
+    self._tags.release(tag)
+    if self._stats.enabled:
+      self._record_completion(tag, result, exception)
+    if self._tracer is not None:
+      self._record_span(tag, result, exception)
+    if not future.done():
+      if exception is not None:
+        future.set_exception(exception)
+      else:
+        future.set_result(result)
+
+  def _record_completion(self, tag, reply, exception):
+    stats = self._stats
+    started = self._started.pop(tag)
+    if started is not None:
+      stats.record('request_latency_us', int((clock() - started) * 1e6))
+    stats.gauge('outstanding', len(self._outstanding))
+    status = getattr(reply, 'status', Status.OK)
+    if exception is not None:
+      stats.counter('rerrs')
+    elif status == Status.NACK:
+      stats.counter('nacks')
+    elif status == Status.ERROR:
+      stats.counter('errors')
+
+  def _record_span(self, tag, reply, exception):
+    span = self._spans.pop(tag)
+    if span is None:
+      return
+    span.complete(CLIENT_RECV, reply, exception)
+    self._tracer.record(span)
+
+  def packet_received(self, packet):
+    handler = self._handlers.get(type(packet))
+    if handler is None:
+      log.warning('Client received unexpected %s', packet.__class__.__name__)
+    else:
+      handler(packet)
+
+  def _reply_received(self, packet):
+    self._complete(packet.tag, result=packet)
+
+  def _rerr_received(self, packet):
+    if packet.tag in self._outstanding:
+      self._complete(packet.tag, exception=ServerError(packet.error))
+    else:
+      log.error('Received session-level Rerr: %s', packet.error)
+
+  def _tping_received(self, packet):
+    self.send(Rping(packet.tag))
+
+  def _tdrain_received(self, packet):
+    self._draining = True
+    self.send(Rdrain(packet.tag))
+
+  def _tlease_received(self, packet):
+    if packet.length >= Tlease.MAX_LENGTH:
+      self._lease_expiry = None
+    else:
+      self._lease_expiry = self._loop.time() + packet.length / 1000.0
+
+  def connection_lost(self, exc):
+    super(MuxClient, self).connection_lost(exc)
+    outstanding, self._outstanding = self._outstanding, TagTable()
+    self._started.clear()
+    self._spans.clear()
+    for future in outstanding.values():
+      if not future.done():
+        future.set_exception(SessionClosed('Connection lost: %s' % (exc or 'closed')))
+
+
+class NoSessionAvailable(MuxError):
+  """None of the sessions in a pool can currently issue requests."""
+
+
+class MuxClientPool(object):
+  """Spreads requests over several client sessions.
+
+  Each request goes to the available session (see MuxClient.available) with the fewest
+  outstanding requests, so sessions that are draining, closed or without a lease from the
+  server are passed over until they can issue requests again.  Requests made while no session
+  is available fail with NoSessionAvailable.  Given retries (a mux.retry.NackRetries), nacked
+  requests are retried, each time on the best session then available; the sessions themselves
+  should then not retry as well.
+  """
+
+  @classmethod
+  def connect(cls, host, port, size=2, loop=None, retries=None, **kw):
+    """Open size connections to host:port, returning a future of the connected pool."""
+    loop = loop or asyncio.get_event_loop()
+    connecting = [MuxClient.connect(host, port, loop=loop, **kw) for _ in range(size)]
+    return then(loop, asyncio.gather(*connecting),
+                lambda clients: cls(clients, loop=loop, retries=retries))
+
+  def __init__(self, clients, loop=None, retries=None):
+    self.clients = list(clients)
+    self._loop = loop or asyncio.get_event_loop()
+    self._retries = retries
+    self._next = 0
+
+  def pick(self):
+    """Return the available session with the fewest outstanding requests, or None."""
+    clients = self.clients
+    count = len(clients)
+    best = None
+    # Start from a different session each time, so that ties are broken round-robin.
+    for offset in range(count):
+      client = clients[(self._next + offset) % count]
+      if client.available and (best is None or client.outstanding < best.outstanding):
+        best = client
+    self._next = (self._next + 1) % count if count else 0
+    return best
+
+  def _unavailable(self):
+    future = self._loop.create_future()
+    future.set_exception(NoSessionAvailable(
+        'None of %d sessions can issue requests.' % len(self.clients)))
+    return future
+
+  def _send(self, method, args, kw):
+    def attempt():
+      client = self.pick()
+      return self._unavailable() if client is None else getattr(client, method)(*args, **kw)
+    if self._retries is None:
+      return attempt()
+    return self._retries.issue(self._loop, attempt)
+
+  def dispatch(self, *args, **kw):
+    """Issue a Tdispatch (see MuxClient.dispatch) on an available session."""
+    return self._send('dispatch', args, kw)
+
+  def request(self, *args, **kw):
+    """Issue a Treq (see MuxClient.request) on an available session."""
+    return self._send('request', args, kw)
+
+  def close(self):
+    for client in self.clients:
+      client.close()
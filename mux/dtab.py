@@ -1,4 +1,27 @@
+import threading
+
+from .lru import LRUCache
+from .name_tree import NameTree
+
+
+# Paths beginning with /$ name concrete addresses, so binding stops at them.
+BOUND_PREFIX = ('$',)
+
+
 class Dentry(object):
+  """An immutable rewrite rule from a path prefix to a NameTree."""
+
+  __slots__ = ('path', 'tree')
+
+  @classmethod
+  def read(cls, entry):
+    """Return entry as a Dentry, parsing it if it is a (prefix, tree) pair of strings."""
+    if isinstance(entry, Dentry):
+      return entry
+    from .parsers import parse_path, parse_tree
+    prefix, tree = entry
+    return cls(parse_path(prefix), parse_tree(tree))
+
   def __init__(self, path, tree):
     self.path = path
     self.tree = tree
@@ -6,21 +29,251 @@ class Dentry(object):
   def __eq__(self, other):
     return isinstance(other, Dentry) and self.path == other.path and self.tree == other.tree
 
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self.path, self.tree))
+
+
+class DentryIndex(object):
+  """A trie of dentries keyed by the labels of their prefixes.
+
+  Finding the dentries whose prefix matches a path walks one node per label of the path, so its
+  cost depends on the depth of the path rather than on the number of dentries.
+  """
+
+  __slots__ = ('_root',)
+
+  def __init__(self, dentries, start=0):
+    self._root = root = ({}, [])  # (children by label, [(position, dentry)])
+    for position, dentry in enumerate(dentries, start):
+      node = root
+      for label in dentry.path:
+        children = node[0]
+        child = children.get(label)
+        if child is None:
+          child = children[label] = ({}, [])
+        node = child
+      node[1].append((position, dentry))
+
+  def matches(self, path):
+    """Return [(position, dentry)] for every dentry whose prefix path starts with, ordered by
+    the depth of the prefix and then by position."""
+    node = self._root
+    matches = list(node[1])
+    for label in path:
+      node = node[0].get(label)
+      if node is None:
+        break
+      matches.extend(node[1])
+    return matches
+
+
+# Dtab content hashes are polynomial in the entry hashes, so that the hash of base + local can be
+# derived from the hash of base and the entries of local alone.
+_HASH_MULTIPLIER = 1000003
+_HASH_MODULUS = 1 << 64
+
+
+def _entry_key(entry):
+  try:
+    return Dentry.read(entry)
+  except ValueError:
+    return tuple(entry)
+
+
+def _content_hash(entries, initial=0):
+  value = initial
+  for entry in entries:
+    value = (value * _HASH_MULTIPLIER + hash(entry)) % _HASH_MODULUS
+  return value
+
 
 class Dtab(object):
+  """An immutable sequence of dentries.
+
+  Entries are Dentry objects, or (prefix, tree) string pairs as carried on the wire which are
+  parsed the first time the dtab is used to resolve a path, hashed or compared.
+
+  base + local shares base rather than copying it, so layering a small per-request dtab over a
+  large one costs O(len(local)), and lookups consult the prefix index of base alongside an index
+  of just the local entries.  Dtabs are equal if their parsed entries are equal, however they
+  were built.
+  """
+
+  __slots__ = (
+      '_local', '_base', '_size', '_dentries', '_keys', '_content', '_encoded', '_index',
+      '_bound')
+
+  DEFAULT_MAX_DEPTH = 100
+  BIND_CACHE_SIZE = 1024
+
+  # Guards the bind memo of every Dtab; binding holds it only to read and update the memo.
+  _bind_lock = threading.Lock()
+
   @classmethod
   def empty(cls):
     return cls([])
 
-  def __init__(self, entries):
-    self.entries = entries
+  def __init__(self, entries, base=None):
+    self._local = tuple(entries)
+    self._base = base
+    self._size = len(self._local) + (len(base) if base is not None else 0)
+    self._dentries = None  # the local entries as Dentry objects
+    self._keys = None  # the local entries as compared and hashed, see _local_keys
+    self._content = None
+    self._encoded = None  # wire encoding, computed and cached by mux.wire
+    self._index = None
+    self._bound = None  # path -> (bound tree, nested lookups it took), see _bind
+
+  @property
+  def entries(self):
+    if self._base is None:
+      return self._local
+    return tuple(self)
+
+  def _local_dentries(self):
+    if self._dentries is None:
+      self._dentries = tuple(Dentry.read(entry) for entry in self._local)
+    return self._dentries
+
+  def _local_keys(self):
+    # Entries are compared as Dentry objects, except entries (from a peer, say) that do not
+    # parse, which are compared as they are rather than raising.
+    if self._keys is None:
+      try:
+        self._keys = self._local_dentries()
+      except ValueError:
+        self._keys = tuple(_entry_key(entry) for entry in self._local)
+    return self._keys
+
+  def _iter_keys(self):
+    if self._base is not None:
+      for key in self._base._iter_keys():
+        yield key
+    for key in self._local_keys():
+      yield key
+
+  @property
+  def content_hash(self):
+    """A hash of the entries, which is the same for equal dtabs however they were built."""
+    if self._content is None:
+      base = self._base.content_hash if self._base is not None else 0
+      self._content = _content_hash(self._local_keys(), base)
+    return self._content
+
+  def __add__(self, other):
+    """Return a dtab of the entries of self followed by those of other.
+
+    The entries of other become a new top layer over self, which is shared rather than copied,
+    unless the top layer of self is less than twice their number: then the two are merged, and so
+    on down.  Each layer is thus at least twice the size of the one above it, which keeps the
+    number of layers logarithmic in the number of entries however the dtab was built.
+    """
+    if not isinstance(other, Dtab):
+      return NotImplemented
+    if not other._size:
+      return self
+    if not self._size:
+      return other
+    local, base = tuple(other), self
+    while base is not None and len(base._local) < 2 * len(local):
+      local, base = base._local + local, base._base
+    return Dtab(local, base=base)
 
   def __eq__(self, other):
-    # TODO(wickman) This should be made more sophisticated, obv.
-    return isinstance(other, Dtab) and self.entries == other.entries
+    if self is other:
+      return True
+    if not isinstance(other, Dtab) or self._size != other._size:
+      return False
+    if self.content_hash != other.content_hash:
+      return False
+    return all(a == b for a, b in zip(self._iter_keys(), other._iter_keys()))
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self._size, self.content_hash))
 
   def __iter__(self):
-    return iter(self.entries)
+    if self._base is not None:
+      for entry in self._base:
+        yield entry
+    for entry in self._local:
+      yield entry
 
   def __len__(self):
-    return len(self.entries)
+    return self._size
+
+  def _matches(self, path):
+    if self._index is None:
+      start = self._size - len(self._local)
+      self._index = DentryIndex(self._local_dentries(), start=start)
+    matches = self._index.matches(path)
+    if self._base is not None:
+      matches.extend(self._base._matches(path))
+    return matches
+
+  def lookup(self, path):
+    """Rewrite path by every dentry whose prefix it starts with.
+
+    Each matching dentry replaces the prefix of path with each leaf of its tree.  As in Finagle,
+    later dentries take precedence, so the rewrites are returned as an Alt with the last matching
+    dentry first.  Returns NameTree.Neg if no dentry matches.
+    """
+    matches = self._matches(path)
+    if not matches:
+      return NameTree.Neg
+    matches.sort(key=lambda match: match[0], reverse=True)
+    trees = [self._rewrite(dentry, path) for _, dentry in matches]
+    return trees[0] if len(trees) == 1 else NameTree.Alt(*trees)
+
+  @staticmethod
+  def _rewrite(dentry, path):
+    suffix = path.drop(len(dentry.path))
+    return NameTree.map(dentry.tree, lambda prefix: prefix.concat(suffix))
+
+  def bind(self, path, max_depth=DEFAULT_MAX_DEPTH):
+    """Recursively look up path and the leaves it is rewritten to, returning the simplified
+    NameTree (see NameTree.simplify.)
+
+    Paths under /$ name concrete addresses and are left as leaves; any other path that no
+    dentry matches binds to NameTree.Neg.  Raises ValueError if binding takes more than
+    max_depth nested lookups, as it would for a cyclic dtab.
+
+    Bound trees of path and of every path it delegates to are memoized by the dtab, so repeated
+    binds of the same paths cost a cache lookup.  Since a Dtab is immutable, a changed dtab is a
+    new Dtab with an empty memo.
+    """
+    return self._bind(path, max_depth)[0]
+
+  def _bind(self, path, depth):
+    with self._bind_lock:
+      if self._bound is None:
+        self._bound = LRUCache(self.BIND_CACHE_SIZE)
+      bound = self._bound.get(path)
+
+    # A memoized result stands wherever at least as many nested lookups are allowed as it took.
+    if bound is not None and bound[1] <= depth:
+      return bound
+
+    if path.components[:1] == BOUND_PREFIX:
+      bound = (NameTree.Leaf(path), 0)
+    elif depth <= 0:
+      raise ValueError('Max recursion depth reached binding %s' % path)
+    else:
+      deepest = [0]
+
+      def bind_leaf(leaf):
+        tree, lookups = self._bind(leaf, depth - 1)
+        deepest[0] = max(deepest[0], lookups)
+        return tree
+
+      tree = NameTree.simplify(NameTree.flat_map(self.lookup(path), bind_leaf))
+      bound = (tree, deepest[0] + 1)
+
+    with self._bind_lock:
+      self._bound.put(path, bound)
+    return bound
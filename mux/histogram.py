@@ -0,0 +1,97 @@
+"""A log-linear histogram of non-negative integers, in the style of HdrHistogram.
+
+Values are counted in buckets whose width grows with their magnitude, so that every recorded
+value is represented to within a fixed relative precision (1 part in 2^(precision_bits - 1))
+while memory stays logarithmic in the largest value recorded.  Recording is O(1).
+"""
+
+import math
+
+
+class Histogram(object):
+  DEFAULT_PRECISION_BITS = 8  # values are accurate to within 1/128, i.e. better than 1%
+
+  def __init__(self, precision_bits=DEFAULT_PRECISION_BITS):
+    if precision_bits < 2:
+      raise ValueError('precision_bits must be at least 2.')
+    self._bits = precision_bits
+    self._half = 1 << (precision_bits - 1)
+    self._counts = []
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = None
+
+  def _index(self, value):
+    exponent = value.bit_length() - self._bits
+    if exponent <= 0:
+      return value
+    return exponent * self._half + (value >> exponent)
+
+  def _highest_value(self, index):
+    """The largest value counted in the bucket at index."""
+    if index < 2 * self._half:
+      return index
+    exponent = (index >> (self._bits - 1)) - 1
+    return ((index - exponent * self._half + 1) << exponent) - 1
+
+  def record(self, value, count=1):
+    """Count value (a non-negative integer, e.g. a latency in microseconds) count times."""
+    if value < 0:
+      raise ValueError('Histogram values must not be negative.')
+    value = int(value)
+    index = self._index(value)
+    counts = self._counts
+    if index >= len(counts):
+      counts.extend([0] * (index + 1 - len(counts)))
+    counts[index] += count
+    self.count += count
+    self.total += value * count
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    """Add the counts of other, which must have the same precision, to this histogram."""
+    if other._bits != self._bits:
+      raise ValueError('Cannot merge histograms of different precision.')
+    if len(other._counts) > len(self._counts):
+      self._counts.extend([0] * (len(other._counts) - len(self._counts)))
+    for index, count in enumerate(other._counts):
+      self._counts[index] += count
+    self.count += other.count
+    self.total += other.total
+    for value in (other.min, other.max):
+      if value is not None:
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+  @property
+  def mean(self):
+    return self.total / float(self.count) if self.count else 0.0
+
+  def percentile(self, percentile):
+    """Return the value below or at which percentile percent of the recorded values fall.
+
+    Values are reported as the highest value of their bucket (capped at the largest value
+    recorded), so percentiles never understate.  Returns 0 for an empty histogram.
+    """
+    if not self.count:
+      return 0
+    rank = max(1, int(math.ceil(percentile * self.count / 100.0 - 1e-9)))
+    seen = 0
+    for index, count in enumerate(self._counts):
+      seen += count
+      if seen >= rank:
+        return min(self._highest_value(index), self.max)
+    return self.max
+
+  def percentiles(self, percentiles=(50, 90, 99, 99.9)):
+    """Return a dict mapping each of percentiles to its value."""
+    return dict((percentile, self.percentile(percentile)) for percentile in percentiles)
+
+  def clear(self):
+    self._counts = []
+    self.count = self.total = 0
+    self.min = self.max = None
@@ -0,0 +1,86 @@
+"""Lease-based admission control for mux servers.
+
+A mux server tells each client how long it may go on issuing requests by sending it a Tlease.
+A MuxClient stops issuing requests once its lease runs out or is revoked with a zero-length
+lease, and a MuxClientPool sends them to its other connections meanwhile, so an overloaded
+server sheds load before it is queued rather than after it has timed out.
+
+LoadLessor issues leases on a MuxServer's behalf.  Every interval it measures the requests being
+handled across the server's sessions and the event loop's lag (how late its own timer fired),
+revokes every lease while either is at or above its limit, and otherwise keeps clients supplied
+with leases of lease seconds, renewing each before it runs out:
+
+  lessor = LoadLessor(server, max_inflight=512, max_lag=0.05).start()
+"""
+
+from .stats import NULL_STATS
+
+
+class LoadLessor(object):
+  DEFAULT_LEASE = 1.0
+  DEFAULT_INTERVAL = 0.1
+
+  def __init__(self, server, max_inflight=None, max_lag=None, lease=DEFAULT_LEASE,
+               interval=DEFAULT_INTERVAL, stats=NULL_STATS):
+    if max_inflight is None and max_lag is None:
+      raise ValueError('LoadLessor needs max_inflight, max_lag or both.')
+    if lease <= 2 * interval:
+      raise ValueError('lease must be more than twice interval to be renewed in time.')
+    self._server = server
+    self._loop = server.loop
+    self._max_inflight = max_inflight
+    self._max_lag = max_lag
+    self._lease = lease
+    self._interval = interval
+    self._stats = stats
+    self._handle = None
+    self._expected = None
+    self.inflight = 0
+    self.lag = 0.0
+    self.overloaded = False
+
+  def start(self):
+    """Start issuing leases to the server's sessions, returning this lessor."""
+    if self._handle is None:
+      self._schedule()
+      self._update(overloaded=False)
+    return self
+
+  def stop(self):
+    """Stop issuing leases, lifting the limit on every session."""
+    if self._handle is not None:
+      self._handle.cancel()
+      self._handle = None
+      self._server.issue_lease(None)
+
+  def _schedule(self):
+    self._expected = self._loop.time() + self._interval
+    self._handle = self._loop.call_later(self._interval, self._tick)
+
+  def _tick(self):
+    self.lag = max(0.0, self._loop.time() - self._expected)
+    self.inflight = sum(session.inflight for session in self._server.sessions)
+    self._schedule()
+    busy = self._max_inflight is not None and self.inflight >= self._max_inflight
+    lagging = self._max_lag is not None and self.lag >= self._max_lag
+    self._update(busy or lagging)
+
+  def _update(self, overloaded):
+    stats = self._stats
+    if stats.enabled:
+      stats.gauge('inflight', self.inflight)
+      stats.gauge('loop_lag_us', int(self.lag * 1e6))
+      stats.gauge('overloaded', int(overloaded))
+    if overloaded and not self.overloaded:
+      stats.counter('revocations')
+    self.overloaded = overloaded
+
+    for session in list(self._server.sessions):
+      if not session.is_open:
+        continue
+      remaining = session.lease_remaining
+      if overloaded:
+        if remaining is None or remaining > 0:
+          session.issue_lease(0)
+      elif remaining is None or remaining < 2 * self._interval:
+        session.issue_lease(self._lease)
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+  """A mapping bounded to max_entries, evicting the least recently used entry first.
+
+  If max_bytes is given, entries are also evicted until the sizes passed to put sum to at most
+  max_bytes.  An entry larger than max_bytes on its own is not cached at all.  LRUCache is not
+  thread-safe.
+  """
+
+  def __init__(self, max_entries, max_bytes=None):
+    if max_entries < 1:
+      raise ValueError('max_entries must be positive.')
+    if max_bytes is not None and max_bytes < 0:
+      raise ValueError('max_bytes must not be negative.')
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self._entries = OrderedDict()  # key -> (value, size)
+    self.total_bytes = 0
+    self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default=None):
+    entries = self._entries
+    try:
+      entry = entries.pop(key)
+    except KeyError:
+      self.misses += 1
+      return default
+    entries[key] = entry
+    self.hits += 1
+    return entry[0]
+
+  def put(self, key, value, size=0):
+    entries = self._entries
+    previous = entries.pop(key, None)
+    if previous is not None:
+      self.total_bytes -= previous[1]
+    if self.max_bytes is not None and size > self.max_bytes:
+      return
+    entries[key] = (value, size)
+    self.total_bytes += size
+    while len(entries) > self.max_entries or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes):
+      _, (_, evicted_size) = entries.popitem(last=False)
+      self.total_bytes -= evicted_size
+      self.evictions += 1
+
+  def clear(self):
+    self._entries.clear()
+    self.total_bytes = 0
@@ -1,8 +1,69 @@
 class NameTree(object):
+  """Immutable name trees.  Neg, Fail and Empty are singletons."""
+
   Neg = object()
   Fail = object()
   Empty = object()
 
+  @classmethod
+  def map(cls, tree, fn):
+    """Return tree with the path of every leaf replaced by fn(path)."""
+    return cls.flat_map(tree, lambda path: cls.Leaf(fn(path)))
+
+  @classmethod
+  def flat_map(cls, tree, fn):
+    """Return tree with every leaf replaced by the tree fn(leaf.path)."""
+    tree_type = type(tree)
+    if tree_type is cls.Leaf:
+      return fn(tree.path)
+    elif tree_type is cls.Alt or tree_type is cls.Union:
+      return tree_type(*[cls.flat_map(subtree, fn) for subtree in tree.trees])
+    return tree
+
+  @classmethod
+  def simplify(cls, tree):
+    """Return an equivalent tree with redundant structure removed.
+
+    Nested Alts and Unions are flattened into their parents and Neg branches are dropped.  An
+    Alt ends at its first Fail or Empty branch, since later alternatives can never be reached,
+    and a Union containing a Fail fails.  Empty branches of a Union are dropped unless nothing
+    else remains, an Alt or Union with no branches left is Neg, and one with a single branch is
+    replaced by that branch.
+    """
+    tree_type = type(tree)
+    if tree_type is cls.Alt:
+      trees = []
+      for subtree in tree.trees:
+        subtree = cls.simplify(subtree)
+        if subtree is cls.Neg:
+          continue
+        if type(subtree) is cls.Alt:
+          trees.extend(subtree.trees)
+        else:
+          trees.append(subtree)
+        if trees[-1] is cls.Fail or trees[-1] is cls.Empty:
+          break
+    elif tree_type is cls.Union:
+      trees = []
+      empty = False
+      for subtree in tree.trees:
+        subtree = cls.simplify(subtree)
+        if subtree is cls.Fail:
+          return subtree
+        elif subtree is cls.Empty:
+          empty = True
+        elif type(subtree) is cls.Union:
+          trees.extend(subtree.trees)
+        elif subtree is not cls.Neg:
+          trees.append(subtree)
+      if not trees and empty:
+        return cls.Empty
+    else:
+      return tree
+    if not trees:
+      return cls.Neg
+    return trees[0] if len(trees) == 1 else tree_type(*trees)
+
   class Leaf(object):
     __slots__ = ('path',)
 
@@ -12,6 +73,12 @@ class NameTree(object):
     def __eq__(self, other):
       return isinstance(other, NameTree.Leaf) and self.path == other.path
 
+    def __ne__(self, other):
+      return not self == other
+
+    def __hash__(self):
+      return hash((NameTree.Leaf, self.path))
+
   class Alt(object):
     __slots__ = ('trees',)
 
@@ -21,6 +88,12 @@ class NameTree(object):
     def __eq__(self, other):
       return isinstance(other, NameTree.Alt) and self.trees == other.trees
 
+    def __ne__(self, other):
+      return not self == other
+
+    def __hash__(self):
+      return hash((NameTree.Alt, self.trees))
+
   class Union(object):
     __slots__ = ('trees',)
 
@@ -29,3 +102,9 @@ class NameTree(object):
 
     def __eq__(self, other):
       return isinstance(other, NameTree.Union) and self.trees == other.trees
+
+    def __ne__(self, other):
+      return not self == other
+
+    def __hash__(self):
+      return hash((NameTree.Union, self.trees))
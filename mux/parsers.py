@@ -1,201 +1,239 @@
-from .dtab import Dtab, Dentry
-from .name_tree import NameTree
-from .path import Path
+"""Parsers for the textual forms of paths, name trees, dentries and dtabs.
 
+Input is split into tokens by a single precompiled regular expression, and a small recursive
+descent parser builds Path, NameTree, Dentry and Dtab objects from the token list.  Each parse
+must consume its entire input (surrounding whitespace aside); malformed input raises ValueError
+naming the offending character and its position.
 
-class Buffer(object):
-  @classmethod
-  def wrap(cls, buf):
-    if isinstance(buf, cls):
-      return buf
-    else:
-      return cls(buf)
+The grammar, as in Finagle:
 
-  def __init__(self, buf):
-    self.buf = buf
-    self.index = 0
+  dtab   ::= [dentry] (';' [dentry])*
+  dentry ::= path '=>' tree
+  tree   ::= tree1 ('|' tree1)*
+  tree1  ::= simple ('&' simple)*
+  simple ::= '(' tree ')' | path | '!' | '~' | '$'
+  path   ::= '/' [label ('/' label)*]
+"""
 
-  def peek(self):
-    if self.at_end():
-      return None
-    return self.buf[self.index]
+import re
+import threading
 
-  def next(self):
-    self.index += 1
+from .dtab import Dtab, Dentry
+from .lru import LRUCache
+from .name_tree import NameTree
+from .path import Path
 
-  def maybe_eat(self, char):
-    if self.peek() != char:
-      return False
-    self.next()
-    return True
 
-  def eat(self, char):
-    if not self.maybe_eat(char):
-      raise ValueError('Unexpected character %s' % self.peek())
+_SHOWABLE = r'0-9A-Za-z_:.#$%\-'
+_LABEL = r'(?:[%s]|\\x[0-9a-fA-F]{2})+' % _SHOWABLE
 
-  def eat_whitespace(self):
-    while not self.at_end() and self.peek().isspace():
-      self.next()
+# Paths are tokenized greedily and then validated, so that a malformed escape or trailing '/'
+# is reported where it occurs rather than as an unexpected token.  Each token is a tuple of
+# (path, operator, error) of which exactly one is non-empty; any character that cannot begin a
+# token is returned as an error token, so no input is skipped.
+_TOKEN = re.compile(r'\s*(?:(/[%s\\/]*)|(=>|[!~$&|();])|(\S))' % _SHOWABLE)
+_PATH = re.compile(r'/(?:%s(?:/%s)*)?' % (_LABEL, _LABEL))
+_LABEL_PREFIX = re.compile(r'(?:[%s]|\\x[0-9a-fA-F]{2})*' % _SHOWABLE)
+_ESCAPE = re.compile(r'\\x([0-9a-fA-F]{2})')
 
-  def at_end(self):
-    return self.index >= len(self.buf)
+_END = ('', '', '')
 
 
-def char_range(start, end):
-  return frozenset(chr(v) for v in range(ord(start), ord(end) + 1))
+def _unescape(match):
+  return chr(int(match.group(1), 16))
 
 
-class Patterns(object):
-  SHOWABLE_CHARS = frozenset.union(
-      char_range('0', '9'),
-      char_range('A', 'Z'),
-      char_range('a', 'z'),
-      frozenset(['_', ':', '.', '#', '$', '%', '-']),
-  )
+def _invalid_offset(path):
+  """The offset of the first invalid character of a path token that failed to match _PATH."""
+  offset = 1
+  for label in path[1:].split('/'):
+    if not label:
+      return offset if offset < len(path) else offset - 1
+    end = _LABEL_PREFIX.match(label).end()
+    if end < len(label):
+      return offset + end
+    offset += len(label) + 1
+  return offset
 
-  @classmethod
-  def is_showable(cls, ch):
-    return ch in cls.SHOWABLE_CHARS
 
-  @classmethod
-  def is_label_char(cls, ch):
-    return cls.is_showable(ch) or ch == '\\'
+class _Parser(object):
+  LEAVES = {
+      '!': NameTree.Fail,
+      '~': NameTree.Neg,
+      '$': NameTree.Empty,
+  }
 
+  def __init__(self, string):
+    self.string = string
+    self.tokens = _TOKEN.findall(string)
+    self.tokens.append(_END)
+    self.index = 0
+
+  def position(self, index, offset=0):
+    """The position in the input of the token at index.  Only needed to report errors."""
+    for k, token in enumerate(_TOKEN.finditer(self.string)):
+      if k == index:
+        return token.start(token.lastindex) + offset
+    return len(self.string)
+
+  def error(self, expected=None, offset=0):
+    position = self.position(self.index, offset)
+    if position >= len(self.string):
+      found = 'end of input'
+    else:
+      found = repr(self.string[position])
+    message = 'Unexpected %s at position %d' % (found, position)
+    if expected:
+      message += ' (expected %s)' % expected
+    return ValueError('%s: %r' % (message, self.string))
+
+  def expect(self, operator):
+    if self.tokens[self.index][1] != operator:
+      raise self.error(repr(operator))
+    self.index += 1
 
-def parse_hex(buf):
-  ch = buf.peek()
-  buf.next()
-  return int(ch, 16)
+  def finish(self, result):
+    if self.tokens[self.index] is not _END:
+      raise self.error('end of input')
+    return result
+
+  def path(self):
+    value = self.tokens[self.index][0]
+    if not value:
+      raise self.error('a path')
+    if _PATH.match(value).end() != len(value):
+      raise self.error(offset=_invalid_offset(value))
+    self.index += 1
+    if len(value) == 1:
+      return Path.empty()
+    labels = value[1:].split('/')
+    if '\\' in value:
+      labels = [_ESCAPE.sub(_unescape, label) for label in labels]
+    return Path(*labels)
+
+  def dentry(self):
+    path = self.path()
+    self.expect('=>')
+    return Dentry(path, self.tree())
+
+  def dtab(self):
+    tokens = self.tokens
+    dentries = []
+    while True:
+      if tokens[self.index][0]:
+        dentries.append(self.dentry())
+      if tokens[self.index][1] != ';':
+        break
+      self.index += 1
+    return Dtab(dentries)
+
+  def tree(self):
+    trees = [self.tree1()]
+    while self.tokens[self.index][1] == '|':
+      self.index += 1
+      trees.append(self.tree1())
+    return NameTree.Alt(*trees) if len(trees) > 1 else trees[0]
+
+  def tree1(self):
+    trees = [self.simple()]
+    while self.tokens[self.index][1] == '&':
+      self.index += 1
+      trees.append(self.simple())
+    return NameTree.Union(*trees) if len(trees) > 1 else trees[0]
+
+  def simple(self):
+    path, operator, _ = self.tokens[self.index]
+    if path:
+      return NameTree.Leaf(self.path())
+    if operator == '(':
+      self.index += 1
+      tree = self.tree()
+      self.expect(')')
+      return tree
+    leaf = self.LEAVES.get(operator)
+    if leaf is None:
+      raise self.error('a name tree')
+    self.index += 1
+    return leaf
 
 
-def parse_label(string):
-  buf = Buffer.wrap(string)
-  label = ''
+def parse_path(string):
+  parser = _Parser(string)
+  return parser.finish(parser.path())
 
-  while True:
-    ch = buf.peek()
 
-    if Patterns.is_showable(ch):
-      label += ch
-      buf.next()
-    elif ch == '\\':
-      buf.next()
-      buf.eat('x')
-      fst = parse_hex(buf)
-      snd = parse_hex(buf)
-      label += chr(fst * 16 + snd)
-    else:
-      raise ValueError('Unknown character: %s' % ch)
+def parse_dentry(string):
+  parser = _Parser(string)
+  return parser.finish(parser.dentry())
 
-    if not Patterns.is_label_char(buf.peek()):
-      return label
 
+def parse_dtab(string):
+  parser = _Parser(string)
+  return parser.finish(parser.dtab())
 
-def parse_path(string):
-  buf = Buffer.wrap(string)
-  buf.eat_whitespace()
-  buf.eat('/')
 
-  if not Patterns.is_label_char(buf.peek()):
-    return Path.empty()
+def parse_tree(string):
+  parser = _Parser(string)
+  return parser.finish(parser.tree())
 
-  labels = []
 
-  while True:
-    labels.append(parse_label(buf))
-    if not buf.maybe_eat('/'):
-      break
+class ParseCache(object):
+  """A memoizing, thread-safe front end to the parse functions.
 
-  return Path(*labels)
+  Results are cached by input string, keeping at most max_entries results whose input strings
+  total at most max_bytes characters, and evicting the least recently used first.  Parsed values
+  are immutable, so one result is shared by every caller that parses the same string.  Inputs
+  that fail to parse are not cached.
+  """
 
+  DEFAULT_MAX_ENTRIES = 4096
+  DEFAULT_MAX_BYTES = 4 * 1024 * 1024
 
-def parse_dentry(string):
-  buf = Buffer.wrap(string)
-  path = parse_path(buf)
-  buf.eat_whitespace()
-  buf.eat('=')
-  buf.eat('>')
-  tree = parse_tree(buf)
-  return Dentry(path, tree)
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+    self._cache = LRUCache(max_entries, max_bytes=max_bytes)
+    self._lock = threading.Lock()
 
+  def _parse(self, parse, string):
+    key = (parse, string)
+    with self._lock:
+      result = self._cache.get(key)
+    if result is None:
+      result = parse(string)
+      with self._lock:
+        self._cache.put(key, result, size=len(string))
+    return result
 
-def parse_dtab(string):
-  buf = Buffer.wrap(string)
-  dentries = []
-
-  while True:
-    buf.eat_whitespace()
-    if not buf.at_end():
-      dentries.append(parse_dentry(buf))
-      buf.eat_whitespace()
-    if not buf.maybe_eat(';'):
-      break
-
-  return Dtab(dentries)
-
-
-def parse_tree1(string):
-  buf = Buffer.wrap(string)
-
-  trees = []
-
-  while True:
-    trees.append(parse_simple(buf))
-    buf.eat_whitespace()
-    if not buf.maybe_eat('&'):
-      break
-
-  if len(trees) > 1:
-    return NameTree.Union(*trees)
-  else:
-    return trees[0]
-
-
-def parse_simple(string):
-  buf = Buffer.wrap(string)
-
-  buf.eat_whitespace()
-  ch = buf.peek()
-
-  if ch == '(':
-    buf.next()
-    tree = parse_tree(buf)
-    buf.eat_whitespace()
-    buf.eat(')')
-    return tree
-  elif ch == '/':
-    return NameTree.Leaf(parse_path(buf))
-  elif ch == '!':
-    buf.next()
-    return NameTree.Fail
-  elif ch == '~':
-    buf.next()
-    return NameTree.Neg
-  elif ch == '$':
-    buf.next()
-    return NameTree.Empty
-  else:
-    raise ValueError('Failed to parse NameTree.')
+  def parse_path(self, string):
+    return self._parse(parse_path, string)
 
+  def parse_dentry(self, string):
+    return self._parse(parse_dentry, string)
 
-def parse_tree(string):
-  buf = Buffer.wrap(string)
+  def parse_dtab(self, string):
+    return self._parse(parse_dtab, string)
 
-  trees = []
+  def parse_tree(self, string):
+    return self._parse(parse_tree, string)
 
-  while True:
-    trees.append(parse_tree1(buf))
-    buf.eat_whitespace()
-    if not buf.maybe_eat('|'):
-      break
+  @property
+  def stats(self):
+    """A dict of hits, misses and evictions so far, and the current entries and bytes."""
+    with self._lock:
+      cache = self._cache
+      return dict(
+          hits=cache.hits,
+          misses=cache.misses,
+          evictions=cache.evictions,
+          entries=len(cache),
+          bytes=cache.total_bytes)
 
-  if len(trees) > 1:
-    return NameTree.Alt(*trees)
-  else:
-    return trees[0]
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
 
 
 __all__ = (
+    'ParseCache',
     'parse_dentry',
     'parse_dtab',
     'parse_path',
@@ -1,13 +1,94 @@
+import weakref
+
+
 class Path(object):
+  """An immutable, hashable sequence of labels.
+
+  The hash is computed once at construction.  Paths derived by drop, take and concat share the
+  label strings of the paths they are derived from, and return an existing path unchanged where
+  the result would be equal to it.
+  """
+
+  __slots__ = ('components', '_hash', '__weakref__')
+
+  _interned = weakref.WeakValueDictionary()
+
   @classmethod
   def empty(cls):
-    return cls()
+    return EMPTY
+
+  @classmethod
+  def _from_tuple(cls, components):
+    path = cls.__new__(cls)
+    path.components = components
+    path._hash = hash(components)
+    return path
 
   def __init__(self, *components):
     self.components = components
+    self._hash = hash(components)
+
+  def intern(self):
+    """Return the canonical instance of this path, so that equal paths share one object.
+
+    Interned paths are held weakly and are released once nothing else refers to them.
+    """
+    return self._interned.setdefault(self.components, self)
 
   def __iter__(self):
     return iter(self.components)
 
+  def __len__(self):
+    return len(self.components)
+
+  def __getitem__(self, index):
+    return self.components[index]
+
   def __eq__(self, other):
-    return isinstance(other, Path) and self.components == other.components
+    if self is other:
+      return True
+    if not isinstance(other, Path) or self._hash != other._hash:
+      return False
+    return self.components == other.components
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return self._hash
+
+  def startswith(self, prefix):
+    """Return True if the leading labels of this path are the labels of prefix."""
+    size = len(prefix.components)
+    return size <= len(self.components) and self.components[:size] == prefix.components
+
+  def drop(self, count):
+    """Return this path without its first count labels."""
+    if count <= 0:
+      return self
+    return self._from_tuple(self.components[count:])
+
+  def take(self, count):
+    """Return the first count labels of this path."""
+    if count >= len(self.components):
+      return self
+    return self._from_tuple(self.components[:max(count, 0)])
+
+  def concat(self, other):
+    """Return the labels of this path followed by the labels of other."""
+    if not other.components:
+      return self
+    if not self.components:
+      return other
+    return self._from_tuple(self.components + other.components)
+
+  __add__ = concat
+
+  def __str__(self):
+    return '/' + '/'.join(self.components)
+
+  def __repr__(self):
+    return 'Path(%s)' % ', '.join(repr(label) for label in self.components)
+
+
+EMPTY = Path()
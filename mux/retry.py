@@ -0,0 +1,186 @@
+"""Automatic retries of nacked requests, limited by a retry budget.
+
+A server nacks a request it has not processed, so a nacked request can always be retried
+safely, but retrying every nack would multiply the load on a server that is nacking because it
+is already overloaded.  NackRetries therefore retries only while its RetryBudget allows: every
+request deposits into the budget, every retry withdraws from it, and retries are allowed up to a
+fraction of the requests made over the last ttl seconds plus a minimum rate, so that clients
+making few requests can still retry.  Retries are also spaced out by jittered exponential
+backoff, and a request is retried at most max_retries times.
+
+Pass NackRetries to MuxClient or MuxClientPool as retries (on a pool, each retry goes to
+whichever session is then the best available):
+
+  retries = NackRetries(RetryBudget(percent_can_retry=0.1), stats=stats.scope('retries'))
+  pool = MuxClientPool(clients, retries=retries)
+
+NackRetries counts retries issued (requeues), nacks not retried because the budget was empty
+(budget_exhausted) or the request had been retried max_retries times (request_limit), records
+the retries made per request (retries) and gauges the budget's balance (budget).
+"""
+
+import random
+
+from .stats import NULL_STATS, clock
+from .wire import Status
+
+
+class RetryBudget(object):
+  """A token bucket of retries, refilled by the requests made over a sliding window.
+
+  Each deposit (a request) adds percent_can_retry of a token, and each withdrawal (a retry)
+  takes one, over a window of the last ttl seconds which always holds min_retries_per_sec * ttl
+  tokens in reserve.  The window moves in steps of a tenth of ttl.
+  """
+
+  SLOTS = 10
+
+  DEFAULT_TTL = 10.0
+  DEFAULT_MIN_RETRIES_PER_SEC = 10
+  DEFAULT_PERCENT_CAN_RETRY = 0.2
+
+  def __init__(self, ttl=DEFAULT_TTL, min_retries_per_sec=DEFAULT_MIN_RETRIES_PER_SEC,
+               percent_can_retry=DEFAULT_PERCENT_CAN_RETRY, now=clock):
+    if ttl <= 0:
+      raise ValueError('ttl must be positive.')
+    if min_retries_per_sec < 0 or percent_can_retry < 0:
+      raise ValueError('min_retries_per_sec and percent_can_retry must not be negative.')
+    self._width = float(ttl) / self.SLOTS
+    self._reserve = min_retries_per_sec * ttl
+    self._percent = percent_can_retry
+    self._now = now
+    self._deposits = [0] * self.SLOTS
+    self._withdrawals = [0] * self.SLOTS
+    self._slot = int(now() / self._width)
+
+  def _advance(self):
+    slot = int(self._now() / self._width)
+    if slot != self._slot:
+      # Empty the slots that have left the window since the last call.
+      for expired in range(self._slot + 1, min(slot, self._slot + self.SLOTS) + 1):
+        self._deposits[expired % self.SLOTS] = self._withdrawals[expired % self.SLOTS] = 0
+      self._slot = slot
+    return slot % self.SLOTS
+
+  def _balance(self):
+    return sum(self._deposits) * self._percent + self._reserve - sum(self._withdrawals)
+
+  @property
+  def balance(self):
+    """The number of retries the budget would currently allow."""
+    self._advance()
+    return max(0, int(self._balance()))
+
+  def deposit(self):
+    """Account for a request."""
+    self._deposits[self._advance()] += 1
+
+  def try_withdraw(self):
+    """Account for a retry, returning whether the budget allows it."""
+    index = self._advance()
+    if self._balance() < 1:
+      return False
+    self._withdrawals[index] += 1
+    return True
+
+
+class NackRetries(object):
+  """Retries nacked requests after a backoff, while the budget allows."""
+
+  DEFAULT_MAX_RETRIES = 10
+  DEFAULT_BACKOFF_BASE = 0.005
+  DEFAULT_BACKOFF_MAX = 1.0
+
+  def __init__(self, budget=None, max_retries=DEFAULT_MAX_RETRIES,
+               backoff_base=DEFAULT_BACKOFF_BASE, backoff_max=DEFAULT_BACKOFF_MAX, rng=None,
+               stats=NULL_STATS):
+    self.budget = budget if budget is not None else RetryBudget()
+    self._max_retries = max_retries
+    self._backoff_base = backoff_base
+    self._backoff_max = backoff_max
+    self._random = (rng or random.Random()).random
+    self._stats = stats
+
+  def backoff(self, retries):
+    """Return the delay before retry number retries (counting from 1), with full jitter."""
+    ceiling = min(self._backoff_max, self._backoff_base * (1 << min(retries - 1, 32)))
+    return self._random() * ceiling
+
+  def issue(self, loop, attempt):
+    """Call attempt() for a future of a reply, and again while it is nacked and may be retried.
+
+    Returns a future of the last reply.
+    """
+    self.budget.deposit()
+    if self._stats.enabled:
+      self._stats.gauge('budget', self.budget.balance)
+    return _RetryingRequest(self, loop, attempt).future
+
+  def _should_retry(self, retries):
+    """Decide whether to retry a request nacked after retries retries, counting the outcome."""
+    stats = self._stats
+    if retries >= self._max_retries:
+      stats.counter('request_limit')
+      return False
+    if not self.budget.try_withdraw():
+      stats.counter('budget_exhausted')
+      return False
+    stats.counter('requeues')
+    return True
+
+  def _completed(self, retries):
+    if self._stats.enabled:
+      self._stats.record('retries', retries)
+
+
+class _RetryingRequest(object):
+  """The attempts made for one request by NackRetries."""
+
+  __slots__ = ('_retries', '_loop', '_attempt', 'future', '_pending', '_handle', '_count')
+
+  def __init__(self, retries, loop, attempt):
+    self._retries = retries
+    self._loop = loop
+    self._attempt = attempt
+    self._count = 0
+    self._handle = None
+    self.future = loop.create_future()
+    self.future.add_done_callback(self._future_done)
+    self._send()
+
+  def _send(self):
+    self._handle = None
+    if self.future.done():
+      return
+    self._pending = self._attempt()
+    self._pending.add_done_callback(self._attempt_done)
+
+  def _attempt_done(self, pending):
+    future = self.future
+    if future.done():
+      return
+    if pending.cancelled():
+      future.cancel()
+      return
+    exception = pending.exception()
+    if exception is not None:
+      self._retries._completed(self._count)
+      future.set_exception(exception)
+      return
+    reply = pending.result()
+    nacked = getattr(reply, 'status', Status.OK) == Status.NACK
+    retry = nacked and self._retries._should_retry(self._count)
+    if retry:
+      self._count += 1
+      self._handle = self._loop.call_later(self._retries.backoff(self._count), self._send)
+      return
+    self._retries._completed(self._count)
+    future.set_result(reply)
+
+  def _future_done(self, future):
+    # Cancelling the request cancels whichever attempt or backoff is outstanding.
+    if future.cancelled():
+      if self._handle is not None:
+        self._handle.cancel()
+      elif not self._pending.done():
+        self._pending.cancel()
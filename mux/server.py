@@ -0,0 +1,314 @@
+"""An asyncio mux server that runs requests concurrently and replies as they complete."""
+
+import asyncio
+import functools
+import logging
+
+from .session import (
+    Nack,
+    Session,
+    then,
+)
+from .stats import clock
+from .tags import TagTable
+from .tracing import SERVER_RECV, SERVER_SEND
+from .wire import (
+    Rdispatch,
+    RdispatchError,
+    RdispatchNack,
+    RdispatchOk,
+    Rdrain,
+    Rerr,
+    Rping,
+    Rreq,
+    RreqError,
+    RreqNack,
+    RreqOk,
+    Status,
+    Tdiscarded,
+    Tdispatch,
+    Tdrain,
+    Tlease,
+    Tping,
+    Treq,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class ServerSession(Session):
+  """The server end of a single mux connection.
+
+  Each Tdispatch and Treq is passed to handler(request).  The handler may return a reply body,
+  a complete Rdispatch/Rreq, or a coroutine or future resolving to either; raising Nack rejects
+  the request and raising anything else replies with an error.  Asynchronous handlers run
+  concurrently and their replies are written as soon as each completes, regardless of the order
+  in which the requests arrived.  Control messages such as Tping are answered inline.
+
+  In addition to the session stats, the server gauges the requests being handled (inflight),
+  records the time from receiving each request to replying in microseconds
+  (handler_latency_us), and counts the nacks, error replies and Rerrs it sends.  With a tracer,
+  the server makes the sampling decision for requests that arrive without one, and records sr
+  and ss annotations for sampled requests.
+  """
+
+  # Tag used by the server for its own control messages (Tdrain.)
+  CONTROL_TAG = 1
+
+  # Tag of Tlease messages, which are not replied to.
+  LEASE_TAG = 0
+
+  def __init__(self, handler, loop=None, **kw):
+    super(ServerSession, self).__init__(loop=loop, **kw)
+    self._handler = handler
+    self._inflight = TagTable()
+    self._spans = TagTable()  # tag -> Span, for sampled requests
+    self._draining = False
+    self._drained = False  # whether the client has acknowledged the Tdrain with an Rdrain
+    self._lease_expiry = None
+    self._handlers = {
+        Tdispatch: self._request_received,
+        Treq: self._request_received,
+        Tping: self._tping_received,
+        Tdiscarded: self._tdiscarded_received,
+        Tdrain: self._tdrain_received,
+        Rdrain: self._rdrain_received,
+    }
+
+  @property
+  def inflight(self):
+    """The number of requests currently being handled."""
+    return len(self._inflight)
+
+  def packet_received(self, packet):
+    handler = self._handlers.get(type(packet))
+    if handler is None:
+      self._stats.counter('rerrs')
+      self.send(Rerr(packet.tag, 'Unexpected %s' % packet.__class__.__name__))
+    else:
+      handler(packet)
+
+  def _request_received(self, request):
+    tag = request.tag
+
+    if tag in self._inflight:
+      self._stats.counter('rerrs')
+      self.send(Rerr(tag, 'Tag %d is already in use.' % tag))
+      return
+
+    started = clock() if self._stats.enabled else None
+
+    if self._tracer is not None:
+      span = self._tracer.server_span(request)
+      if span is not None:
+        span.annotate(SERVER_RECV)
+        self._spans[tag] = span
+
+    if self._draining:
+      self._reply(request, started, error=Nack('Server is draining.'))
+      return
+
+    try:
+      result = self._handler(request)
+    except Exception as e:
+      self._reply(request, started, error=e)
+      return
+
+    if not (asyncio.iscoroutine(result) or asyncio.isfuture(result)):
+      self._reply(request, started, result=result)
+      return
+
+    task = asyncio.ensure_future(result, loop=self._loop)
+    self._inflight[tag] = task
+    if started is not None:
+      self._stats.gauge('inflight', len(self._inflight))
+    task.add_done_callback(functools.partial(self._task_done, request, started))
+
+  def _task_done(self, request, started, task):
+    self._inflight.pop(request.tag, None)
+    if started is not None:
+      self._stats.gauge('inflight', len(self._inflight))
+
+    if task.cancelled():
+      self._reply(request, started, error=asyncio.CancelledError('Request discarded.'))
+    elif task.exception() is not None:
+      self._reply(request, started, error=task.exception())
+    else:
+      self._reply(request, started, result=task.result())
+
+    if self._drained and not self._inflight:
+      self.close()
+
+  def _reply(self, request, started, result=None, error=None):
+    span = None
+    if self._tracer is not None:
+      span = self._spans.pop(request.tag)
+      self._tracer.release(request)
+
+    if not self.is_open:
+      return
+
+    if error is not None and not isinstance(error, (Nack, asyncio.CancelledError)):
+      log.debug('Handler for tag %d failed: %s', request.tag, error)
+
+    try:
+      reply = self._make_reply(request, result, error)
+    except TypeError as e:
+      reply = self._make_reply(request, None, e)
+
+    self.send(reply)
+
+    if started is not None:
+      stats = self._stats
+      stats.record('handler_latency_us', int((clock() - started) * 1e6))
+      if reply.status == Status.NACK:
+        stats.counter('nacks')
+      elif reply.status == Status.ERROR:
+        stats.counter('errors')
+
+    if span is not None:
+      span.complete(SERVER_SEND, reply)
+      self._tracer.record(span)
+
+  @classmethod
+  def _make_reply(cls, request, result, error):
+    tag = request.tag
+
+    if error is None:
+      if result is None:
+        result = b''
+      elif not isinstance(result, (bytes, bytearray, memoryview, Rdispatch, Rreq)):
+        raise TypeError('Handler returned %s, expected a reply body or message.' % (
+            result.__class__.__name__))
+
+    if isinstance(request, Tdispatch):
+      if error is None:
+        reply = result if isinstance(result, Rdispatch) else RdispatchOk(tag, (), result)
+      elif isinstance(error, Nack):
+        reply = RdispatchNack(tag, ())
+      else:
+        reply = RdispatchError(tag, (), str(error) or error.__class__.__name__)
+    else:
+      if error is None:
+        reply = result if isinstance(result, Rreq) else RreqOk(tag, result)
+      elif isinstance(error, Nack):
+        reply = RreqNack(tag)
+      else:
+        reply = RreqError(tag, str(error) or error.__class__.__name__)
+
+    reply.tag = tag
+    return reply
+
+  def _tping_received(self, packet):
+    self.send(Rping(packet.tag))
+
+  def _tdiscarded_received(self, packet):
+    self._decoder.discard(packet.tag)
+    task = self._inflight.get(packet.tag)
+    if task is not None:
+      task.cancel()
+
+  def _tdrain_received(self, packet):
+    self.send(Rdrain(packet.tag))
+
+  def _rdrain_received(self, packet):
+    if self._draining:
+      self._drained = True
+      if not self._inflight:
+        self.close()
+
+  @property
+  def lease_remaining(self):
+    """The seconds left on the lease last issued to the client, or None if it is unlimited."""
+    if self._lease_expiry is None:
+      return None
+    return max(0.0, self._lease_expiry - self._loop.time())
+
+  def issue_lease(self, duration=None):
+    """Grant the client a lease to issue requests for duration seconds.
+
+    A zero duration stops the client issuing requests until it is granted another lease, and
+    None lifts any limit.
+    """
+    if duration is None:
+      self._lease_expiry, length = None, Tlease.MAX_LENGTH
+    else:
+      length = max(0, min(int(duration * 1000), Tlease.MAX_LENGTH - 1))
+      self._lease_expiry = self._loop.time() + length / 1000.0
+    if self.is_open:
+      self.send(Tlease(self.LEASE_TAG, Tlease.MILLISECONDS, length))
+
+  def drain(self):
+    """Ask the client to stop sending requests, and close once it has acknowledged with an
+    Rdrain and outstanding requests have finished.
+
+    Returns a future that completes once the session has closed.
+    """
+    if not self._draining and self.is_open:
+      self._draining = True
+      self.send(Tdrain(self.CONTROL_TAG))
+    return self.closed
+
+  def connection_lost(self, exc):
+    super(ServerSession, self).connection_lost(exc)
+    inflight, self._inflight = self._inflight, TagTable()
+    for task in inflight.values():
+      task.cancel()
+
+
+class MuxServer(object):
+  """Accepts mux connections, serving requests on each with handler (see ServerSession.)"""
+
+  def __init__(self, handler, loop=None, **kw):
+    self._handler = handler
+    self._loop = loop or asyncio.get_event_loop()
+    self._session_kw = kw
+    self._server = None
+    self.sessions = set()
+
+  @property
+  def loop(self):
+    return self._loop
+
+  def _make_session(self):
+    session = ServerSession(self._handler, loop=self._loop, **self._session_kw)
+    self.sessions.add(session)
+    session.closed.add_done_callback(lambda _: self.sessions.discard(session))
+    return session
+
+  def _listening(self, creating):
+    def listening(server):
+      self._server = server
+      return self
+    return then(self._loop, creating, listening)
+
+  def issue_lease(self, duration=None):
+    """Grant every connected client a lease of duration seconds (see ServerSession.issue_lease.)"""
+    for session in list(self.sessions):
+      session.issue_lease(duration)
+
+  def listen(self, host, port, **kw):
+    """Start listening on host:port, returning a future of this server once bound."""
+    return self._listening(self._loop.create_server(self._make_session, host, port, **kw))
+
+  def listen_unix(self, path, **kw):
+    """Start listening on the unix socket at path, returning a future of this server."""
+    return self._listening(self._loop.create_unix_server(self._make_session, path, **kw))
+
+  @property
+  def sockets(self):
+    return self._server.sockets if self._server is not None else ()
+
+  def close(self):
+    """Stop accepting connections and drain every open session.
+
+    Returns a future that completes once all sessions have closed.
+    """
+    if self._server is not None:
+      self._server.close()
+    closing = [session.drain() for session in list(self.sessions)]
+    if not closing:
+      closing.append(self._loop.create_future())
+      closing[0].set_result(None)
+    return asyncio.gather(*closing)
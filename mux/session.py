@@ -0,0 +1,288 @@
+"""Plumbing shared by the asyncio client and server sessions.
+
+A Session is an asyncio protocol that owns one connection: it decodes incoming frames with a
+FrameDecoder and hands each packet to packet_received, and writes outgoing packets as framed
+buffer lists so message bodies are never copied on the way out.
+
+When max_fragment_size is set, messages larger than that are split into fragments which are
+written round-robin with the fragments of other large messages, and only while the transport
+is accepting writes.  Smaller messages are written straight away, so they are queued behind
+at most a transport buffer's worth of fragments rather than behind an entire large message.
+
+Outgoing frames are coalesced: rather than being written one at a time, they are queued and
+flushed together with a single write once per event loop iteration (or after flush_delay
+seconds), or as soon as flush_bytes are queued.  Pings and leases bypass the queue, and drains
+flush it rather than overtake the messages queued before them.  Pass flush_delay=None to write
+every frame immediately.
+
+Sessions report into the StatsReceiver given as stats (see mux.stats.)  Besides what the frame
+decoder reports, a session counts messages and bytes sent per message type (sent/<type> and
+sent_bytes/<type>), the bytes read from the transport (bytes_in) and protocol errors; records
+the time taken to encode each message (encode_ns) and the size of each coalesced write
+(flush_bytes); and gauges the bytes waiting to be flushed (queued_bytes) and the number of
+messages being sent in fragments (streams).
+
+Client and server sessions given a Tracer as tracer trace the requests they send and receive
+(see mux.tracing.)
+"""
+
+import asyncio
+import collections
+import logging
+
+from .stats import NULL_STATS, clock
+from .wire import (
+    TAG_MASK,
+    FrameDecoder,
+    Rdrain,
+    Rping,
+    Tdrain,
+    Tlease,
+    Tping,
+    fragment_iov,
+    frame_iov,
+    message_name,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class MuxError(Exception):
+  pass
+
+
+class ServerError(MuxError):
+  """The remote end replied to a request with Rerr."""
+
+
+class SessionClosed(MuxError):
+  """The session was closed before a reply was received."""
+
+
+class SessionDraining(MuxError):
+  """The remote end has asked this session to stop issuing new requests."""
+
+
+class LeaseExpired(MuxError):
+  """The remote end has not granted this session a lease to issue requests."""
+
+
+class Nack(MuxError):
+  """Raised by a server handler to reject a request it has not processed."""
+
+
+def then(loop, awaitable, transform):
+  """Return a future of transform(result) once awaitable completes successfully."""
+  future = loop.create_future()
+
+  def done(completed):
+    if completed.cancelled():
+      future.cancel()
+    elif completed.exception() is not None:
+      future.set_exception(completed.exception())
+    else:
+      future.set_result(transform(completed.result()))
+
+  asyncio.ensure_future(awaitable, loop=loop).add_done_callback(done)
+  return future
+
+
+def protocol_future(loop, connecting):
+  """Turn a create_connection/create_unix_connection call into a future of its protocol."""
+  return then(loop, connecting, lambda connected: connected[1])
+
+
+# Read straight into the frame decoder's buffer where the event loop supports it.
+_Protocol = getattr(asyncio, 'BufferedProtocol', asyncio.Protocol)
+
+
+class Session(_Protocol):
+  # Message types written immediately, ahead of any coalesced frames.
+  URGENT_MESSAGES = frozenset([Tping, Rping, Tlease])
+  # Message types written immediately, but after any coalesced frames.
+  FLUSHING_MESSAGES = frozenset([Tdrain, Rdrain])
+
+  DEFAULT_FLUSH_BYTES = 64 * 1024
+
+  def __init__(self, loop=None, buffer_size=FrameDecoder.DEFAULT_BUFFER_SIZE,
+               max_frame_size=None, max_message_size=None, max_fragment_size=None,
+               flush_bytes=DEFAULT_FLUSH_BYTES, flush_delay=0, lazy=False, stats=NULL_STATS,
+               tracer=None):
+    self._loop = loop or asyncio.get_event_loop()
+    self._stats = stats
+    self._tracer = tracer
+    self._decoder = FrameDecoder(
+        buffer_size=buffer_size,
+        max_frame_size=max_frame_size,
+        max_message_size=max_message_size,
+        lazy=lazy,
+        stats=stats)
+    self._max_fragment_size = max_fragment_size
+    # tag -> (next fragment, iterator of the fragments after it)
+    self._streams = collections.OrderedDict()
+    self._writing_paused = False
+    self._flush_bytes = flush_bytes
+    self._flush_delay = flush_delay
+    self._outbound = []
+    self._outbound_bytes = 0
+    self._flush_handle = None
+    self._transport = None
+    self._closed = self._loop.create_future()
+
+  @property
+  def loop(self):
+    return self._loop
+
+  @property
+  def stats(self):
+    return self._stats
+
+  @property
+  def tracer(self):
+    return self._tracer
+
+  @property
+  def closed(self):
+    """A future that completes once the connection has been lost."""
+    return self._closed
+
+  @property
+  def is_open(self):
+    return self._transport is not None and not self._transport.is_closing()
+
+  def connection_made(self, transport):
+    self._transport = transport
+
+  def connection_lost(self, exc):
+    self._cancel_flush()
+    self._outbound, self._outbound_bytes = [], 0
+    self._streams.clear()
+    if not self._closed.done():
+      self._closed.set_result(exc)
+
+  def pause_writing(self):
+    self._writing_paused = True
+
+  def resume_writing(self):
+    self._writing_paused = False
+    self._pump()
+
+  def get_buffer(self, sizehint):
+    return self._decoder.get_buffer(sizehint)
+
+  def buffer_updated(self, nbytes):
+    if self._stats.enabled:
+      self._stats.counter('bytes_in', nbytes)
+    self._packets_received(self._decoder.buffer_updated, nbytes)
+
+  def data_received(self, data):
+    if self._stats.enabled:
+      self._stats.counter('bytes_in', len(data))
+    self._packets_received(self._decoder.feed, data)
+
+  def eof_received(self):
+    return False
+
+  def _packets_received(self, decode, data):
+    try:
+      packets = decode(data)
+    except ValueError as e:
+      self.protocol_error(e)
+      return
+    for packet in packets:
+      self.packet_received(packet)
+
+  def packet_received(self, packet):
+    raise NotImplementedError
+
+  def protocol_error(self, error):
+    """Called when an undecodable frame is received.  By default the connection is dropped."""
+    log.error('Closing mux session after protocol error: %s', error)
+    self._stats.counter('protocol_errors')
+    self.close()
+
+  def send(self, packet):
+    if self._transport is None or self._transport.is_closing():
+      raise SessionClosed('Cannot send %s on a closed session.' % packet.__class__.__name__)
+
+    stats = self._stats
+    if stats.enabled:
+      started = clock()
+      iov = frame_iov(packet)
+      size = sum(len(buf) for buf in iov)
+      self._record_send(packet, size, started)
+    else:
+      iov = frame_iov(packet)
+      size = sum(len(buf) for buf in iov)
+
+    if self._max_fragment_size is not None and size - 8 > self._max_fragment_size:
+      fragments = fragment_iov(packet, self._max_fragment_size)
+      self._streams[packet.tag & TAG_MASK] = next(fragments), fragments
+      self._pump()
+    elif self._flush_delay is None or type(packet) in self.URGENT_MESSAGES:
+      self._transport.writelines(iov)
+    elif type(packet) in self.FLUSHING_MESSAGES:
+      self.flush()
+      self._transport.writelines(iov)
+    else:
+      self._outbound.extend(iov)
+      self._outbound_bytes += size
+      if stats.enabled:
+        stats.gauge('queued_bytes', self._outbound_bytes)
+      if self._outbound_bytes >= self._flush_bytes:
+        self.flush()
+      elif self._flush_handle is None:
+        if self._flush_delay:
+          self._flush_handle = self._loop.call_later(self._flush_delay, self.flush)
+        else:
+          self._flush_handle = self._loop.call_soon(self.flush)
+
+  def _record_send(self, packet, size, started):
+    stats = self._stats
+    stats.record('encode_ns', int((clock() - started) * 1e9))
+    name = message_name(packet)
+    stats.counter('sent/' + name)
+    stats.counter('sent_bytes/' + name, size)
+
+  @property
+  def queued_bytes(self):
+    """The number of bytes waiting to be flushed."""
+    return self._outbound_bytes
+
+  def _cancel_flush(self):
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+
+  def flush(self):
+    """Write all queued frames to the transport at once."""
+    self._cancel_flush()
+    if self._outbound and self.is_open:
+      if self._stats.enabled:
+        self._stats.record('flush_bytes', self._outbound_bytes)
+        self._stats.gauge('queued_bytes', 0)
+      outbound, self._outbound, self._outbound_bytes = self._outbound, [], 0
+      self._transport.writelines(outbound)
+
+  def _pump(self):
+    streams = self._streams
+    while streams and not self._writing_paused and self.is_open:
+      tag, (iov, fragments) = streams.popitem(last=False)
+      self._transport.writelines(iov)
+      # Look ahead, so that a stream is dropped as soon as its final fragment is written.
+      following = next(fragments, None)
+      if following is not None:
+        streams[tag] = following, fragments
+    if self._stats.enabled:
+      self._stats.gauge('streams', len(streams))
+
+  def abort_stream(self, tag):
+    """Stop sending the remaining fragments of the message with tag, returning whether its
+    final fragment was still unwritten."""
+    return self._streams.pop(tag & TAG_MASK, None) is not None
+
+  def close(self):
+    if self._transport is not None:
+      self.flush()
+      self._transport.close()
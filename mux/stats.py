@@ -0,0 +1,132 @@
+"""Pluggable statistics for mux sessions and codecs.
+
+Sessions and frame decoders report into a StatsReceiver passed as their stats argument.  Stats
+are named by '/'-separated strings, and come in three kinds: counters, which are incremented;
+gauges, which are set to the latest value; and stats, values recorded into a histogram (such as
+latencies.)  The default NullStatsReceiver discards everything, and since instrumented code
+checks its enabled attribute before doing any work to produce a value (such as reading the
+clock), an uninstrumented session costs an attribute check per message.
+
+InMemoryStatsReceiver aggregates everything it is given and can be snapshotted at any time:
+
+  stats = InMemoryStatsReceiver()
+  client = MuxClient(stats=stats.scope('client'))
+  ...
+  stats.snapshot()['histograms']['client/request_latency_us']['p99']
+"""
+
+import threading
+import time
+
+from .histogram import Histogram
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class StatsReceiver(object):
+  """The interface for stats sinks.  Subclasses override counter, gauge and record."""
+
+  # Whether values reported to this receiver are kept.  Instrumented code skips the work of
+  # measuring when this is False.
+  enabled = True
+
+  def counter(self, name, delta=1):
+    """Add delta to the counter name."""
+    raise NotImplementedError
+
+  def gauge(self, name, value):
+    """Set the gauge name to value."""
+    raise NotImplementedError
+
+  def record(self, name, value):
+    """Record value (a non-negative integer) into the histogram name."""
+    raise NotImplementedError
+
+  def scope(self, prefix):
+    """Return a receiver that reports into this one with names prefixed by prefix/."""
+    return ScopedStatsReceiver(self, prefix)
+
+
+class NullStatsReceiver(StatsReceiver):
+  enabled = False
+
+  def counter(self, name, delta=1):
+    pass
+
+  def gauge(self, name, value):
+    pass
+
+  def record(self, name, value):
+    pass
+
+  def scope(self, prefix):
+    return self
+
+
+NULL_STATS = NullStatsReceiver()
+
+
+class ScopedStatsReceiver(StatsReceiver):
+  def __init__(self, parent, prefix):
+    self._parent = parent
+    self._prefix = prefix + '/'
+    self.enabled = parent.enabled
+
+  def counter(self, name, delta=1):
+    self._parent.counter(self._prefix + name, delta)
+
+  def gauge(self, name, value):
+    self._parent.gauge(self._prefix + name, value)
+
+  def record(self, name, value):
+    self._parent.record(self._prefix + name, value)
+
+
+class InMemoryStatsReceiver(StatsReceiver):
+  """Aggregates counters, gauges and histograms in memory.  Safe to share between threads."""
+
+  SNAPSHOT_PERCENTILES = (50, 90, 99, 99.9)
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.clear()
+
+  def counter(self, name, delta=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + delta
+
+  def gauge(self, name, value):
+    with self._lock:
+      self._gauges[name] = value
+
+  def record(self, name, value):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = self._histograms[name] = Histogram()
+      histogram.record(value)
+
+  def snapshot(self):
+    """Return a dict of the current counters, gauges and histogram summaries by name."""
+    with self._lock:
+      histograms = {}
+      for name, histogram in self._histograms.items():
+        summary = dict(
+            count=histogram.count,
+            min=histogram.min or 0,
+            max=histogram.max or 0,
+            mean=histogram.mean)
+        for percentile in self.SNAPSHOT_PERCENTILES:
+          summary['p%s' % str(percentile).replace('.', '')] = histogram.percentile(percentile)
+        histograms[name] = summary
+      return dict(
+          counters=dict(self._counters),
+          gauges=dict(self._gauges),
+          histograms=histograms)
+
+  def clear(self):
+    with self._lock:
+      self._counters = {}
+      self._gauges = {}
+      self._histograms = {}
@@ -0,0 +1,144 @@
+"""Tag allocation and tag-indexed tables for mux sessions.
+
+Tags are 24 bits on the wire but the top bit marks message fragments, leaving 2^23 - 1 usable
+tags per direction (tag 0 is reserved for messages that expect no reply.)
+"""
+
+from collections import deque
+
+
+MIN_TAG = 1
+MAX_TAG = (1 << 23) - 1
+
+
+class TagPool(object):
+  """Allocates unique tags with O(1) acquire and release.
+
+  Released tags are reused in FIFO order, and only once at least reuse_delay other tags have
+  been released after them.  A reply that arrives late for a request that has already been given
+  up on therefore cannot be mistaken for the reply to a request that has just been issued.
+  Fresh tags are handed out while the reuse queue is shorter than reuse_delay, so the tags in
+  circulation stay bounded by the number in flight plus reuse_delay.
+  """
+
+  DEFAULT_REUSE_DELAY = 1024
+
+  def __init__(self, min_tag=MIN_TAG, max_tag=MAX_TAG, reuse_delay=DEFAULT_REUSE_DELAY):
+    if not MIN_TAG <= min_tag <= max_tag <= MAX_TAG:
+      raise ValueError('Invalid tag range [%d, %d]' % (min_tag, max_tag))
+    self.min_tag, self.max_tag = min_tag, max_tag
+    self._reuse_delay = reuse_delay
+    self._next = min_tag  # the lowest tag never yet handed out
+    self._free = deque()
+    self._in_use = 0
+
+  def __len__(self):
+    """The number of tags currently acquired."""
+    return self._in_use
+
+  @property
+  def capacity(self):
+    return self.max_tag - self.min_tag + 1
+
+  def acquire(self):
+    """Return a free tag, or None if every tag is in use."""
+    if len(self._free) > self._reuse_delay or (self._free and self._next > self.max_tag):
+      tag = self._free.popleft()
+    elif self._next <= self.max_tag:
+      tag, self._next = self._next, self._next + 1
+    else:
+      return None
+    self._in_use += 1
+    return tag
+
+  def release(self, tag):
+    """Return tag to the pool.  Releasing a tag that is not in use corrupts the pool."""
+    self._free.append(tag)
+    self._in_use -= 1
+
+
+class TagTable(object):
+  """A mapping from tag to per-request state.
+
+  Tags are allocated densely from the bottom of the tag space, so state is kept in a list indexed
+  by tag, which costs one pointer per slot rather than a dict entry.  Tags beyond dense_limit
+  (which only a misbehaving peer would choose) spill into a dict so that memory stays bounded.
+  Values may be any object other than None.
+  """
+
+  DEFAULT_DENSE_LIMIT = 1 << 16
+
+  def __init__(self, dense_limit=DEFAULT_DENSE_LIMIT):
+    self._dense_limit = dense_limit
+    self._slots = []
+    self._sparse = {}
+    self._count = 0
+
+  def __len__(self):
+    return self._count
+
+  def __contains__(self, tag):
+    return self.get(tag) is not None
+
+  def get(self, tag, default=None):
+    slots = self._slots
+    if tag < len(slots):
+      value = slots[tag]
+      return default if value is None else value
+    return self._sparse.get(tag, default)
+
+  def __getitem__(self, tag):
+    value = self.get(tag)
+    if value is None:
+      raise KeyError(tag)
+    return value
+
+  def __setitem__(self, tag, value):
+    if value is None:
+      raise ValueError('TagTable values may not be None.')
+    slots = self._slots
+    if tag >= len(slots):
+      if tag >= self._dense_limit:
+        if tag not in self._sparse:
+          self._count += 1
+        self._sparse[tag] = value
+        return
+      size = min(max(tag + 1, 2 * len(slots), 16), self._dense_limit)
+      slots.extend([None] * (size - len(slots)))
+    if slots[tag] is None:
+      self._count += 1
+    slots[tag] = value
+
+  def pop(self, tag, default=None):
+    slots = self._slots
+    if tag < len(slots):
+      value = slots[tag]
+      if value is None:
+        return default
+      slots[tag] = None
+    else:
+      value = self._sparse.pop(tag, None)
+      if value is None:
+        return default
+    self._count -= 1
+    return value
+
+  def __delitem__(self, tag):
+    if self.pop(tag) is None:
+      raise KeyError(tag)
+
+  def items(self):
+    for tag, value in enumerate(self._slots):
+      if value is not None:
+        yield tag, value
+    for item in list(self._sparse.items()):
+      yield item
+
+  def values(self):
+    for _, value in self.items():
+      yield value
+
+  def clear(self):
+    self._slots = []
+    self._sparse = {}
+    self._count = 0
@@ -0,0 +1,327 @@
+"""Sampled request tracing, exported as Zipkin-compatible JSON.
+
+A Tracer passed to a client or server session (as tracer=) gives each request a trace: a
+TraceId of span, parent and trace ids, and a TraceFlag recording whether the trace is sampled.
+Treq carries these in its trace kvs; Tdispatch carries them in a 'b3' context, in the B3 single
+header format (trace-span-sampled-parent, as hex.)
+
+Sampling is decided once, at the head of a trace, and then propagated: a request made without
+a parent trace starts a new trace, sampled with probability sample_rate, as does a request that
+arrives at a server carrying no trace at all.  A request arriving with a trace but no sampling
+decision is decided by the server that receives it, and debug traces are always sampled.  An
+unsampled request records nothing, but still carries its trace marked as unsampled, so that the
+services it reaches keep the decision rather than making their own.  The b3 context is encoded
+and decoded apart from the other contexts of a Tdispatch (see mux.wire.EncodingCache), so that
+a new trace on every request does not defeat the caching of those.
+
+For sampled requests the client records cs and cr annotations and the server sr and ss, each
+side completing a Span into the tracer's SpanBuffer when it replies or gets a reply.  A handler
+continues the trace of the request it is handling by passing parent=extract(request) to the
+client calls it makes.  ZipkinFileExporter drains the buffer from a background thread into a
+file, one JSON array of Zipkin v1 spans per line.
+"""
+
+import collections
+import json
+import random
+import threading
+import time
+
+from .wire import Status, TraceFlag, TraceId, Tdispatch, Treq, to_bytes
+
+
+B3_CONTEXT = 'b3'
+
+CLIENT_SEND = 'cs'
+CLIENT_RECV = 'cr'
+SERVER_RECV = 'sr'
+SERVER_SEND = 'ss'
+
+SAMPLED = TraceFlag(TraceFlag.SAMPLING_KNOWN | TraceFlag.SAMPLED)
+UNSAMPLED = TraceFlag(TraceFlag.SAMPLING_KNOWN)
+
+# The traces decided by servers for requests that arrived without one or undecided, by
+# id(request), until they are replied to (see Tracer.release.)  They are kept here rather than
+# attached to the requests, which would decode lazily decoded messages and drop their raw
+# encodings.
+_decided = {}
+
+
+def encode_b3(trace_id, trace_flag):
+  """Encode a trace in the B3 single header format."""
+  sampled = trace_flag.sampled
+  if trace_flag.is_debug:
+    state = '-d'
+  elif sampled is None:
+    state = ''
+  else:
+    state = '-1' if sampled else '-0'
+  if trace_id.parent_id != trace_id.span_id:
+    return '%016x-%016x%s-%016x' % (
+        trace_id.trace_id, trace_id.span_id, state or '-', trace_id.parent_id)
+  return '%016x-%016x%s' % (trace_id.trace_id, trace_id.span_id, state)
+
+
+def decode_b3(value):
+  """Decode a B3 single header into (TraceId, TraceFlag), raising ValueError if malformed."""
+  fields = value.split('-')
+  if len(fields) < 2 or len(fields) > 4:
+    raise ValueError('Malformed b3 trace: %r' % value)
+  trace_id, span_id = int(fields[0][-16:], 16), int(fields[1], 16)
+  parent_id = int(fields[3], 16) if len(fields) == 4 else span_id
+  state = fields[2] if len(fields) > 2 else ''
+  if state == 'd':
+    flag = TraceFlag(TraceFlag.DEBUG)
+  elif state in ('1', '0'):
+    flag = TraceFlag.default().with_sampled(state == '1')
+  elif state == '':
+    flag = TraceFlag.default()
+  else:
+    raise ValueError('Malformed b3 sampling state: %r' % state)
+  return TraceId(span_id, parent_id, trace_id), flag
+
+
+def extract(request):
+  """Return the (TraceId, TraceFlag) of a Treq or Tdispatch, or None if it has none.
+
+  This is the trace the request carries, or the one decided for it by the server handling it.
+  """
+  decided = _decided.get(id(request))
+  if decided is not None and decided[0] is request:
+    return decided[1]
+  if isinstance(request, Treq):
+    return (request.trace_id, request.trace_flag) if request.trace_id else None
+  if isinstance(request, Tdispatch):
+    for key, value in request.contexts:
+      if key == B3_CONTEXT:
+        try:
+          return decode_b3(value)
+        except ValueError:
+          return None
+  return None
+
+
+def with_trace(contexts, trace):
+  """Return contexts with the b3 context for trace in place of any it already has."""
+  value = encode_b3(*trace)
+  return tuple(context for context in contexts if context[0] != B3_CONTEXT) + (
+      (B3_CONTEXT, value),)
+
+
+def attach(request, trace):
+  """Set the trace carried by a Treq or Tdispatch."""
+  if isinstance(request, Treq):
+    request.trace_id, request.trace_flag = trace
+  elif isinstance(request, Tdispatch):
+    request.contexts = with_trace(request.contexts, trace)
+
+
+class Span(object):
+  """The annotations recorded for one side of one sampled request."""
+
+  __slots__ = ('trace_id', 'trace_flag', 'name', 'shared', 'annotations', 'error')
+
+  def __init__(self, trace_id, trace_flag, name, shared=False):
+    self.trace_id = trace_id
+    self.trace_flag = trace_flag
+    self.name = name
+    # Whether the span was started by the remote end, which then reports its timing.
+    self.shared = shared
+    self.annotations = []
+    self.error = None
+
+  def annotate(self, value):
+    self.annotations.append((int(time.time() * 1e6), value))
+
+  def complete(self, value, reply=None, exception=None):
+    """Annotate value, marking the span failed if reply was a nack or error, or by exception."""
+    self.annotate(value)
+    if exception is not None:
+      self.error = str(exception) or exception.__class__.__name__
+    elif reply is not None and reply.status == Status.NACK:
+      self.error = 'nack'
+    elif reply is not None and reply.status == Status.ERROR:
+      self.error = to_bytes(reply.body).decode('utf-8', 'replace') or 'error'
+
+  def to_zipkin(self, service_name):
+    """Return this span as a Zipkin v1 JSON-compatible dict."""
+    endpoint = dict(serviceName=service_name)
+    trace_id = self.trace_id
+    span = dict(
+        traceId='%016x' % trace_id.trace_id,
+        id='%016x' % trace_id.span_id,
+        name=self.name,
+        annotations=[
+            dict(timestamp=timestamp, value=value, endpoint=endpoint)
+            for timestamp, value in self.annotations],
+        debug=self.trace_flag.is_debug)
+    if trace_id.parent_id != trace_id.span_id:
+      span['parentId'] = '%016x' % trace_id.parent_id
+    if self.annotations and not self.shared:
+      span['timestamp'] = self.annotations[0][0]
+      span['duration'] = self.annotations[-1][0] - self.annotations[0][0]
+    if self.error is not None:
+      span['binaryAnnotations'] = [dict(key='error', value=self.error, endpoint=endpoint)]
+    return span
+
+
+class SpanBuffer(object):
+  """A bounded ring of completed spans, overwriting the oldest when full.
+
+  Spans are appended and drained with single deque operations, which are atomic, so the event
+  loop can record spans while another thread exports them without either taking a lock.
+  """
+
+  def __init__(self, capacity):
+    self._spans = collections.deque(maxlen=capacity)
+    self.dropped = 0
+
+  def __len__(self):
+    return len(self._spans)
+
+  def append(self, span):
+    spans = self._spans
+    if len(spans) == spans.maxlen:
+      self.dropped += 1
+    spans.append(span)
+
+  def drain(self, limit=None):
+    """Remove and return up to limit of the oldest spans (all of them by default.)"""
+    popleft = self._spans.popleft
+    drained = []
+    try:
+      while limit is None or len(drained) < limit:
+        drained.append(popleft())
+    except IndexError:
+      pass
+    return drained
+
+
+class Tracer(object):
+  """Makes sampling decisions and collects the spans of sampled requests."""
+
+  DEFAULT_SAMPLE_RATE = 0.001
+  DEFAULT_CAPACITY = 16384
+
+  def __init__(self, service_name='mux', sample_rate=DEFAULT_SAMPLE_RATE,
+               capacity=DEFAULT_CAPACITY, rng=None):
+    if not 0 <= sample_rate <= 1:
+      raise ValueError('sample_rate must be between 0 and 1.')
+    rng = rng or random.Random()
+    self.service_name = service_name
+    self.sample_rate = sample_rate
+    self.spans = SpanBuffer(capacity)
+    self._random = rng.random
+    self._getrandbits = rng.getrandbits
+
+  def _new_id(self):
+    return self._getrandbits(64) or 1
+
+  def _decide(self, trace_flag):
+    if trace_flag.sampled is not None:
+      return trace_flag
+    return trace_flag.with_sampled(self._random() < self.sample_rate)
+
+  def _new_trace(self):
+    span_id = self._new_id()
+    flag = SAMPLED if self._random() < self.sample_rate else UNSAMPLED
+    return TraceId(span_id, span_id, span_id), flag
+
+  def client_trace(self, parent=None):
+    """Return the (TraceId, TraceFlag) to send with a new request.
+
+    A request made on behalf of parent, as returned by extract, continues its trace in a new
+    child span and inherits its sampling decision.  Other requests start a new trace.
+    """
+    if parent is not None:
+      trace_id, trace_flag = parent
+      return (TraceId(self._new_id(), trace_id.span_id, trace_id.trace_id),
+              self._decide(trace_flag))
+    return self._new_trace()
+
+  def client_span(self, trace, name):
+    """Return a Span recording the client side of a request sent with trace, if sampled."""
+    if trace is None or not trace[1].sampled:
+      return None
+    return Span(trace[0], trace[1], name)
+
+  def server_span(self, request):
+    """Decide whether an incoming request is sampled, returning its Span if it is.
+
+    A request that carried no trace starts a new one, and a request without a sampling decision
+    is decided.  Either way extract(request) returns the trace as decided until release(request)
+    is called, without the request itself being changed.
+    """
+    trace = extract(request)
+    if trace is None:
+      trace = self._new_trace()
+      _decided[id(request)] = request, trace
+      shared = False
+    else:
+      if trace[1].sampled is None:
+        trace = trace[0], self._decide(trace[1])
+        _decided[id(request)] = request, trace
+      shared = True
+    if not trace[1].sampled:
+      return None
+    name = request.dest if isinstance(request, Tdispatch) else 'treq'
+    return Span(trace[0], trace[1], name, shared=shared)
+
+  def release(self, request):
+    """Forget the trace decided for request by server_span, once it has been replied to."""
+    _decided.pop(id(request), None)
+
+  def record(self, span):
+    """Add a completed span to the buffer for export."""
+    self.spans.append(span)
+
+
+class ZipkinFileExporter(object):
+  """Appends the spans recorded by a tracer to a file as Zipkin v1 JSON.
+
+  Each export writes the spans drained since the last as one JSON array on its own line, the
+  body Zipkin's /api/v1/spans endpoint accepts.  start() exports every interval seconds from a
+  daemon thread until close(), which exports whatever remains.
+  """
+
+  def __init__(self, tracer, path, interval=1.0, batch_size=1000):
+    self._tracer = tracer
+    self._path = path
+    self._interval = interval
+    self._batch_size = batch_size
+    self._stopped = threading.Event()
+    self._thread = None
+    self.exported = 0
+
+  def export(self):
+    """Write out every span recorded so far, returning the number written."""
+    written = 0
+    with open(self._path, 'a') as fp:
+      while True:
+        spans = self._tracer.spans.drain(self._batch_size)
+        if not spans:
+          break
+        service_name = self._tracer.service_name
+        fp.write(json.dumps([span.to_zipkin(service_name) for span in spans]))
+        fp.write('\n')
+        written += len(spans)
+    self.exported += written
+    return written
+
+  def _run(self):
+    while not self._stopped.wait(self._interval):
+      self.export()
+
+  def start(self):
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._run, name='mux-zipkin-exporter')
+      self._thread.daemon = True
+      self._thread.start()
+    return self
+
+  def close(self):
+    self._stopped.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    self.export()
@@ -1,6 +1,60 @@
+import codecs
 import struct
+import sys
+import threading
 
 from .dtab import Dtab
+from .lru import LRUCache
+from .stats import clock
+
+
+# Precompiled codecs for the fixed-width fields of the protocol.
+UINT8 = struct.Struct('>B')
+UINT16 = struct.Struct('>H')
+UINT32 = struct.Struct('>I')
+UINT64 = struct.Struct('>Q')
+
+# A message header is a signed type byte followed by a 24-bit tag.  Both are packed into (and
+# unpacked from) a single big-endian word: the type is the top byte, the tag the remaining three.
+HEADER = UINT32
+FRAME_HEADER = struct.Struct('>II')
+HEADER_STATUS = struct.Struct('>IB')
+KV_HEADER = struct.Struct('>BB')
+TRACE_ID = struct.Struct('>QQQ')
+LEASE = struct.Struct('>BQ')
+
+
+# The most significant bit of the tag marks a fragment that is followed by further fragments of
+# the same message; the final fragment (like an unfragmented message) has it clear.
+TAG_FRAGMENT = 1 << 23
+TAG_MASK = TAG_FRAGMENT - 1
+
+
+def decode_utf8(buf):
+  """Decode a utf-8 string directly out of a bytes-like object (including memoryviews)."""
+  return codecs.utf_8_decode(buf, 'strict', True)[0]
+
+
+if sys.version_info[0] >= 3:
+  join_buffers = bytearray().join
+  join_bytes = b''.join
+else:
+  # Python 2 cannot join memoryviews, or bytearrays into a str, but can extend a bytearray.
+  def join_buffers(buffers):
+    """Concatenate bytes-like objects (including memoryviews) into a bytearray."""
+    joined = bytearray()
+    for buf in buffers:
+      joined += buf
+    return joined
+
+  def join_bytes(buffers):
+    """Concatenate bytes-like objects (including memoryviews) into bytes."""
+    return bytes(join_buffers(buffers))
+
+
+def to_bytes(buf):
+  """Copy a bytes-like object (including a memoryview, even on Python 2) into bytes."""
+  return buf.tobytes() if isinstance(buf, memoryview) else bytes(buf)
 
 
 class Status(object):
@@ -37,7 +91,7 @@ class TraceId(object):
   def decode(cls, body):
     if len(body) < 24:
       raise ValueError('Buffer is not large enough to decode TraceId')
-    span_id, parent_id, trace_id = struct.unpack('>QQQ', body[0:24])
+    span_id, parent_id, trace_id = TRACE_ID.unpack_from(body, 0)
     return cls(span_id, parent_id, trace_id)
 
   def __init__(self, span_id, parent_id, trace_id):
@@ -48,10 +102,18 @@ class TraceId(object):
         other.span_id, other.parent_id, other.trace_id)
 
   def encode(self):
-    return struct.pack('>QQQ', self.span_id, self.parent_id, self.trace_id)
+    return TRACE_ID.pack(self.span_id, self.parent_id, self.trace_id)
 
 
 class TraceFlag(object):
+  __slots__ = ('flags',)
+
+  # Flag bits, as in Finagle.  Debug traces are always sampled; otherwise a trace is sampled
+  # only if SAMPLING_KNOWN and SAMPLED are both set, and undecided if SAMPLING_KNOWN is not.
+  DEBUG = 1
+  SAMPLING_KNOWN = 1 << 1
+  SAMPLED = 1 << 2
+
   @classmethod
   def debug(cls):
     return cls(1)
@@ -64,7 +126,8 @@ class TraceFlag(object):
   def decode(cls, body):
     if len(body) < 1:
       raise ValueError('Could not decode TraceFlag.')
-    return cls(body[0])
+    flags, = UINT8.unpack_from(body, 0)
+    return cls(flags)
 
   def __init__(self, flags):
     self.flags = flags
@@ -72,187 +135,436 @@ class TraceFlag(object):
   def __eq__(self, other):
     return isinstance(other, TraceFlag) and self.flags == other.flags
 
+  @property
+  def is_debug(self):
+    return bool(self.flags & self.DEBUG)
+
+  @property
+  def sampled(self):
+    """True or False once a sampling decision has been made, otherwise None."""
+    if self.flags & self.DEBUG:
+      return True
+    if self.flags & self.SAMPLING_KNOWN:
+      return bool(self.flags & self.SAMPLED)
+    return None
+
+  def with_sampled(self, sampled):
+    """Return a copy of this flag recording the sampling decision sampled."""
+    flags = (self.flags & ~self.SAMPLED) | self.SAMPLING_KNOWN
+    return TraceFlag(flags | self.SAMPLED if sampled else flags)
+
   def encode(self):
-    return struct.pack('B', self.flags)
+    return UINT8.pack(self.flags)
 
 
 class Fragments(object):
   @classmethod
-  def decode_string(cls, fmt, width, buf):
-    if len(buf) < width:
+  def decode_string(cls, codec, buf, offset=0):
+    width = codec.size
+
+    if len(buf) < offset + width:
       raise ValueError('Buffer too small to contain string.')
 
-    length, = struct.unpack(fmt, buf[0:width])
+    length, = codec.unpack_from(buf, offset)
+    start = offset + width
 
-    if len(buf) < width + length:
+    if len(buf) < start + length:
       raise ValueError('Buffer is truncated (expected string length %d)' % length)
 
-    return length + width, buf[width:length + width].decode('utf-8')
+    return length + width, decode_utf8(buf[start:start + length])
 
   @classmethod
-  def decode_s1(cls, buf):
-    return cls.decode_string('B', 1, buf)
+  def decode_s1(cls, buf, offset=0):
+    return cls.decode_string(UINT8, buf, offset)
 
   @classmethod
-  def decode_s2(cls, buf):
-    return cls.decode_string('>H', 2, buf)
+  def decode_s2(cls, buf, offset=0):
+    return cls.decode_string(UINT16, buf, offset)
 
   @classmethod
-  def decode_s4(cls, buf):
-    return cls.decode_string('>I', 4, buf)
+  def decode_s4(cls, buf, offset=0):
+    return cls.decode_string(UINT32, buf, offset)
 
   @classmethod
-  def encode_string(cls, fmt, string):
+  def skip_string(cls, codec, buf, offset=0):
+    """Return the encoded size of the string at offset without decoding it."""
+    length, = codec.unpack_from(buf, offset)
+    if len(buf) < offset + codec.size + length:
+      raise ValueError('Buffer is truncated (expected string length %d)' % length)
+    return codec.size + length
+
+  @classmethod
+  def encode_string(cls, codec, string):
     encoded_string = string.encode('utf-8')
 
     try:
-      return struct.pack(fmt, len(encoded_string)) + encoded_string
+      return codec.pack(len(encoded_string)) + encoded_string
     except struct.error as e:
       raise ValueError('Failed to serialize string: %s' % e)
 
   @classmethod
   def encode_s1(cls, string):
-    return cls.encode_string('b', string)
+    return cls.encode_string(UINT8, string)
 
   @classmethod
   def encode_s2(cls, string):
-    return cls.encode_string('>H', string)
+    return cls.encode_string(UINT16, string)
 
   @classmethod
   def encode_s4(cls, string):
-    return cls.encode_string('>I', string)
+    return cls.encode_string(UINT32, string)
 
   @classmethod
-  def decode_packet(cls, buf):
-    if len(buf) < 4:
+  def decode_packet(cls, buf, offset=0):
+    if len(buf) < offset + 4:
       raise ValueError('Buffer too small to contain packet.')
 
-    length, = struct.unpack('>I', buf[0:4])
+    length, = UINT32.unpack_from(buf, offset)
 
-    if len(buf) < 4 + length:
+    if len(buf) < offset + 4 + length:
       raise ValueError('Buffer is truncated (expected packet length %d)' % length)
 
-    return length + 4, Packet.decode(buf[4:length + 4])
+    if not isinstance(buf, memoryview):
+      buf = memoryview(buf)
+
+    return length + 4, Packet.decode_from(buf, offset + 4, offset + 4 + length)
 
   @classmethod
   def encode_context(cls, key, value):
     raw_key = key.encode('utf-8')
     raw_value = value.encode('utf-8')
-
-    return b''.join([
-        struct.pack('>H', len(raw_key)),
-        raw_key,
-        struct.pack('>H', len(raw_value)),
-        raw_value,
-    ])
+    return b''.join([UINT16.pack(len(raw_key)), raw_key, UINT16.pack(len(raw_value)), raw_value])
 
   @classmethod
   def encode_contexts(cls, contexts):
-    return struct.pack('>H', len(contexts)) + b''.join(
-        cls.encode_context(k, v) for (k, v) in contexts)
+    pack = UINT16.pack
+    parts = [pack(len(contexts))]
+    for key, value in contexts:
+      raw_key = key.encode('utf-8')
+      raw_value = value.encode('utf-8')
+      parts.extend((pack(len(raw_key)), raw_key, pack(len(raw_value)), raw_value))
+    return b''.join(parts)
 
   @classmethod
-  def decode_context(cls, body):
-    key_len, = struct.unpack('>H', body[0:2])
-    key = body[2:key_len + 2].decode('utf-8')
-    value_len, = struct.unpack('>H', body[key_len + 2:key_len + 4])
-    value = body[key_len + 4:key_len + 4 + value_len].decode('utf-8')
-    return key_len + value_len + 4, (key, value)
+  def decode_context(cls, body, offset=0):
+    unpack_from = UINT16.unpack_from
+    key_len, = unpack_from(body, offset)
+    key_end = offset + 2 + key_len
+    value_len, = unpack_from(body, key_end)
+    value_end = key_end + 2 + value_len
+    if len(body) < value_end:
+      raise ValueError('Buffer is truncated (expected context length %d)' % (value_end - offset))
+    key = decode_utf8(body[offset + 2:key_end])
+    value = decode_utf8(body[key_end + 2:value_end])
+    return value_end - offset, (key, value)
 
   @classmethod
-  def decode_contexts(cls, body):
-    num_contexts, = struct.unpack('>H', body[0:2])
+  def decode_contexts(cls, body, offset=0):
+    unpack_from = UINT16.unpack_from
+    num_contexts, = unpack_from(body, offset)
     contexts = []
 
-    offset = 2
+    start, offset = offset, offset + 2
     for _ in range(num_contexts):
-      consumed, (k, v) = cls.decode_context(body[offset:])
-      offset += consumed
-      contexts.append((k, v))
+      key_len, = unpack_from(body, offset)
+      key_end = offset + 2 + key_len
+      value_len, = unpack_from(body, key_end)
+      value_end = key_end + 2 + value_len
+      if len(body) < value_end:
+        raise ValueError('Buffer is truncated (expected context length %d)' % (
+            value_end - offset))
+      contexts.append((
+          decode_utf8(body[offset + 2:key_end]),
+          decode_utf8(body[key_end + 2:value_end])))
+      offset = value_end
+
+    return offset - start, contexts
 
-    return offset, contexts
+  @classmethod
+  def skip_contexts(cls, body, offset=0):
+    """Return the encoded size of the contexts at offset without decoding them."""
+    unpack_from = UINT16.unpack_from
+    num_contexts, = unpack_from(body, offset)
+
+    start, offset = offset, offset + 2
+    for _ in range(2 * num_contexts):
+      length, = unpack_from(body, offset)
+      offset += 2 + length
+
+    if len(body) < offset:
+      raise ValueError('Buffer is truncated (expected contexts length %d)' % (offset - start))
+
+    return offset - start
+
+
+class EncodingCache(object):
+  """Caches the wire encodings of context blocks and dtabs, which repeat from message to message.
+
+  Encoding looks contexts up by value in a bounded LRU, so a service sending the same contexts
+  on every request encodes them once.  Dtabs are immutable and carry their own encoding once
+  computed.  Decoding looks raw blocks up by their bytes, so identical blocks decode to a single
+  shared contexts tuple or Dtab (whose encoding is then already known), and identical
+  destinations to a single string.
+
+  Decoded blocks come from the peer, so each cache is bounded by max_bytes (counting each raw
+  block twice, for the block and its decoding) as well as by max_entries.  The caches are shared
+  by every thread encoding or decoding messages, so they are only read and updated under a lock.
+
+  A context whose key is one of volatile_keys (by default the b3 trace context of mux.tracing)
+  differs from request to request, so when it comes last it is encoded and decoded separately
+  and joined to the cached encoding or decoding of the contexts before it.
+  """
+
+  DEFAULT_MAX_ENTRIES = 1024
+  DEFAULT_MAX_BYTES = 4 * 1024 * 1024
+  DEFAULT_VOLATILE_KEYS = ('b3',)
+
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES,
+               volatile_keys=DEFAULT_VOLATILE_KEYS):
+    self._volatile = frozenset(volatile_keys)
+    self._volatile_raw = frozenset(key.encode('utf-8') for key in volatile_keys)
+    self._encoded = LRUCache(max_entries, max_bytes)
+    self._contexts = LRUCache(max_entries, max_bytes)
+    self._dtabs = LRUCache(max_entries, max_bytes)
+    self._dests = LRUCache(max_entries, max_bytes)
+    self._lock = threading.Lock()
+    self._empty_dtab = Dtab.empty()
+    self._empty_dtab._encoded = UINT16.pack(0)
+
+  def encode_contexts(self, contexts):
+    if contexts and contexts[-1][0] in self._volatile:
+      encoded = self.encode_contexts(contexts[:-1])
+      return join_bytes([
+          UINT16.pack(len(contexts)),
+          memoryview(encoded)[2:],
+          Fragments.encode_context(*contexts[-1])])
+    try:
+      with self._lock:
+        encoded = self._encoded.get(contexts)
+    except TypeError:  # unhashable contexts, e.g. containing lists
+      return Fragments.encode_contexts(contexts)
+    if encoded is None:
+      encoded = Fragments.encode_contexts(contexts)
+      with self._lock:
+        self._encoded.put(contexts, encoded, 2 * len(encoded))
+    return encoded
+
+  def decode_contexts(self, body, offset=0):
+    size = Fragments.skip_contexts(body, offset)
+    if size == 2:
+      return size, ()
+    volatile = self._volatile_offset(body, offset)
+    raw = to_bytes(body[offset:offset + size if volatile is None else volatile])
+    with self._lock:
+      contexts = self._contexts.get(raw)
+    if contexts is None:
+      _, contexts = Fragments.decode_contexts(to_bytes(body[offset:offset + size]))
+      contexts = tuple(contexts)
+      with self._lock:
+        self._contexts.put(raw, contexts if volatile is None else contexts[:-1], 2 * len(raw))
+    elif volatile is not None:
+      contexts += (Fragments.decode_context(to_bytes(body[volatile:offset + size]))[1],)
+    return size, contexts
+
+  def _volatile_offset(self, body, offset):
+    """Return the offset of the last of the (one or more) contexts at offset if its key is
+    volatile, otherwise None."""
+    unpack_from = UINT16.unpack_from
+    num_contexts, = unpack_from(body, offset)
+    offset += 2
+    for _ in range(2 * (num_contexts - 1)):
+      length, = unpack_from(body, offset)
+      offset += 2 + length
+    key_len, = unpack_from(body, offset)
+    key = to_bytes(body[offset + 2:offset + 2 + key_len])
+    return offset if key in self._volatile_raw else None
+
+  def decode_dest(self, body, offset=0):
+    size = Fragments.skip_string(UINT16, body, offset)
+    raw = to_bytes(body[offset:offset + size])
+    with self._lock:
+      dest = self._dests.get(raw)
+    if dest is None:
+      _, dest = Fragments.decode_s2(raw)
+      with self._lock:
+        self._dests.put(raw, dest, 2 * size)
+    return size, dest
+
+  def encode_dtab(self, dtab):
+    encoded = dtab._encoded
+    if encoded is None:
+      encoded = dtab._encoded = Fragments.encode_contexts(dtab)
+    return encoded
+
+  def decode_dtab(self, body, offset=0):
+    size = Fragments.skip_contexts(body, offset)
+    if size == 2:
+      return size, self._empty_dtab
+    raw = to_bytes(body[offset:offset + size])
+    with self._lock:
+      dtab = self._dtabs.get(raw)
+    if dtab is None:
+      _, entries = Fragments.decode_contexts(raw)
+      dtab = Dtab(entries)
+      dtab._encoded = raw
+      with self._lock:
+        self._dtabs.put(raw, dtab, 2 * size)
+    return size, dtab
+
+  def clear(self):
+    with self._lock:
+      self._encoded.clear()
+      self._contexts.clear()
+      self._dtabs.clear()
+      self._dests.clear()
+
+
+ENCODING_CACHE = EncodingCache()
 
 
 class Packet(object):
+  __slots__ = ('tag',)
+
   IMPLS = {}
 
+  # Implementations indexed by the unsigned message type byte, so decode can dispatch
+  # directly on the top byte of the header word.
+  DECODERS = [None] * 256
+
   @classmethod
-  def decode(cls, buf):
-    if not isinstance(buf, bytearray):
-      raise TypeError('Packet.decode requires buffer of type bytearray.')
+  def decode(cls, buf, lazy=False):
+    """Decode a single (unframed) message from buf.
+
+    buf may be bytes, a bytearray or a memoryview.  Bodies are handed to decode_body as a
+    memoryview, so variable-length payloads (e.g. Tdispatch bodies) are views into buf rather
+    than copies of it.
+
+    If lazy is True, messages that support it (Tdispatch, Rdispatch) defer decoding their
+    headers until they are accessed; see decode_lazy.
+    """
+    if not isinstance(buf, memoryview):
+      if not isinstance(buf, (bytes, bytearray)):
+        raise TypeError('Packet.decode requires a bytes, bytearray or memoryview buffer.')
+      buf = memoryview(buf)
+    return cls.decode_from(buf, 0, len(buf), lazy)
 
-    if len(buf) < 4:
+  @classmethod
+  def decode_from(cls, view, start, end, lazy=False):
+    """Decode the message occupying view[start:end], where view is a memoryview."""
+    if end - start < 4:
       raise ValueError('Buffer insufficient size for message.')
 
-    typ = buf[0]
-
-    # twos compliment conversion
-    if 0 <= typ < 128:
-      pass
-    elif 128 <= typ < 256:
-      typ -= 256
-    else:
-      raise ValueError('Invalid message type: %s' % typ)
-
-    tag, = struct.unpack('>I', b'\x00' + buf[1:4])
-
-    impl = cls.IMPLS.get(typ)
+    header, = HEADER.unpack_from(view, start)
+    impl = cls.DECODERS[header >> 24]
+    tag = header & 0xFFFFFF
 
     if impl is None:
-      raise ValueError('Unknown Tmessage (%d) 0x%x with tag 0x%x' % (typ, typ, tag))
+      typ = header >> 24
+      raise ValueError('Unknown Tmessage (%d) 0x%x with tag 0x%x' % (
+          typ - 256 if typ >= 128 else typ, typ, tag))
 
-    return impl.decode_body(tag, buf[4:])
+    try:
+      if lazy:
+        return impl.decode_lazy(tag, view[start + 4:end])
+      return impl.decode_body(tag, view[start + 4:end])
+    except struct.error as e:
+      raise ValueError('Truncated %s: %s' % (impl.__name__, e))
 
   @classmethod
   def decode_body(cls, tag, body):
     raise NotImplemented
 
+  @classmethod
+  def decode_lazy(cls, tag, body):
+    """Decode body, deferring any work that can wait until fields are accessed.
+
+    Messages decoded this way keep a view of their raw encoded fields, so re-encoding a message
+    whose fields have not been reassigned passes those bytes straight through.
+    """
+    return cls.decode_body(tag, body)
+
   @classmethod
   def register(cls, typ, impl):
     cls.IMPLS[typ] = impl
+    cls.DECODERS[typ & 0xFF] = impl
+
+  @classmethod
+  def header_word(cls, message_type, tag):
+    return ((message_type & 0xFF) << 24) | (tag & 0xFFFFFF)
 
   def __init__(self, tag):
     self.tag = tag
 
   def encode_header(self, message_type):
-    return bytearray().join([
-        struct.pack('b', message_type),
-        struct.pack('>I', self.tag)[1:]
-    ])
+    return HEADER.pack(self.header_word(message_type, self.tag))
+
+  def encode_parts(self):
+    """Return the encoded message as a list of buffers.
+
+    Message bodies are included as-is rather than copied, so the list is suitable for vectored
+    writes (see frame_iov.)
+    """
+    raise NotImplementedError
 
   def encode(self):
-    raise NotImplemented
+    return join_buffers(self.encode_parts())
+
+  def encoded_size(self):
+    return sum(len(part) for part in self.encode_parts())
+
+  def encode_into(self, buffer, offset=0):
+    """Encode this message into the writable buffer at offset.
+
+    Returns the offset one past the end of the encoded message.
+    """
+    parts = self.encode_parts()
+    view = buffer if isinstance(buffer, memoryview) else memoryview(buffer)
+
+    if len(view) < offset + sum(len(part) for part in parts):
+      raise ValueError('Buffer too small to encode %s.' % self.__class__.__name__)
+
+    for part in parts:
+      end = offset + len(part)
+      view[offset:end] = part
+      offset = end
+
+    return offset
 
 
 class Treq(Packet):
+  __slots__ = ('body', 'trace_id', 'trace_flag')
+
   TRACE_ID = 1
   TRACE_FLAG = 2
 
   @classmethod
   def encode_kv(cls, kv):
-    return struct.pack('B', kv[0]) + struct.pack('B', len(kv[1])) + kv[1]
+    return KV_HEADER.pack(kv[0], len(kv[1])) + kv[1]
 
   @classmethod
   def encode_kvs(cls, kvs):
-    return struct.pack('B', len(kvs)) + b''.join(cls.encode_kv(kv) for kv in kvs)
+    return UINT8.pack(len(kvs)) + b''.join(cls.encode_kv(kv) for kv in kvs)
 
   @classmethod
-  def decode_kv(cls, kv):
-    key = kv[0]
-    value_len = kv[1]
-    return value_len + 2, (key, kv[2:value_len + 2])
+  def decode_kv(cls, kv, offset=0):
+    key, value_len = KV_HEADER.unpack_from(kv, offset)
+    start = offset + 2
+    if len(kv) < start + value_len:
+      raise ValueError('Buffer is truncated (expected kv length %d)' % value_len)
+    return value_len + 2, (key, kv[start:start + value_len])
 
   @classmethod
-  def decode_kvs(cls, body):
-    offset = 1
+  def decode_kvs(cls, body, offset=0):
+    num_kvs, = UINT8.unpack_from(body, offset)
+    start, offset = offset, offset + 1
     kvs = {}
 
-    for kv in range(body[0]):
-      consumed, (key, val) = cls.decode_kv(body[offset:])
+    for _ in range(num_kvs):
+      consumed, (key, val) = cls.decode_kv(body, offset)
       offset += consumed
       kvs[key] = val
 
-    return offset, kvs
+    return offset - start, kvs
 
   @classmethod
   def decode_body(cls, tag, body):
@@ -280,7 +592,7 @@ class Treq(Packet):
     if self.trace_id and not self.trace_flag:
       self.trace_flag = TraceFlag.default()
 
-  def encode(self):
+  def encode_parts(self):
     if self.trace_id:
       kvs = [
           (self.TRACE_ID, self.trace_id.encode()),
@@ -289,17 +601,15 @@ class Treq(Packet):
     else:
       kvs = []
 
-    return bytearray().join([
-        self.encode_header(Message.T_REQ),
-        self.encode_kvs(kvs),
-        self.body
-    ])
+    return [self.encode_header(Message.T_REQ) + self.encode_kvs(kvs), self.body]
 
 
 class Rreq(Packet):
+  __slots__ = ('status', 'body')
+
   @classmethod
   def decode_body(cls, tag, body):
-    status = body[0]
+    status, = UINT8.unpack_from(body, 0)
 
     if status not in (Status.OK, Status.ERROR, Status.NACK):
       raise ValueError('Got an unknown status type: 0x%x' % status)
@@ -311,102 +621,209 @@ class Rreq(Packet):
     self.status = status
     self.body = body
 
-  def encode(self):
-    return bytearray().join([
-        self.encode_header(Message.R_REQ),
-        struct.pack('B', self.status),
+  def encode_parts(self):
+    return [
+        HEADER_STATUS.pack(self.header_word(Message.R_REQ, self.tag), self.status),
         self.body,
-    ])
+    ]
 
 
 class RreqOk(Rreq):
+  __slots__ = ()
+
   def __init__(self, tag, reply):
     super(RreqOk, self).__init__(tag, Status.OK, reply)
 
 
 class RreqError(Rreq):
+  __slots__ = ()
+
   def __init__(self, tag, error):
     super(RreqError, self).__init__(tag, Status.ERROR, error.encode('utf-8'))
 
 
 class RreqNack(Rreq):
+  __slots__ = ()
+
   def __init__(self, tag):
     super(RreqNack, self).__init__(tag, Status.NACK, b'')
 
 
 class Tdispatch(Packet):
+  __slots__ = ('_raw', '_dest_offset', '_dtab_offset', '_contexts', '_dest', '_dtab', 'body')
+
   @classmethod
   def decode_body(cls, tag, body):
-    consumed_contexts, contexts = Fragments.decode_contexts(body)
-    consumed_dest, dest = Fragments.decode_s2(body[consumed_contexts:])
-    consumed_dtab, dtab = Fragments.decode_contexts(body[consumed_contexts + consumed_dest:])
-    body = body[consumed_contexts + consumed_dest + consumed_dtab:]
-    return cls(tag, contexts, dest, Dtab(dtab), body)
+    offset, contexts = ENCODING_CACHE.decode_contexts(body)
+    consumed, dest = ENCODING_CACHE.decode_dest(body, offset)
+    offset += consumed
+    consumed, dtab = ENCODING_CACHE.decode_dtab(body, offset)
+    offset += consumed
+    return cls(tag, contexts, dest, dtab, body[offset:])
+
+  @classmethod
+  def decode_lazy(cls, tag, body):
+    dest_offset = Fragments.skip_contexts(body, 0)
+    dtab_offset = dest_offset + Fragments.skip_string(UINT16, body, dest_offset)
+    body_offset = dtab_offset + Fragments.skip_contexts(body, dtab_offset)
+    msg = cls.__new__(cls)
+    Packet.__init__(msg, tag)
+    msg._raw, msg._dest_offset, msg._dtab_offset = body[:body_offset], dest_offset, dtab_offset
+    msg._contexts = msg._dest = msg._dtab = None
+    msg.body = body[body_offset:]
+    return msg
 
   def __init__(self, tag, contexts, dest, dtab, body):
     super(Tdispatch, self).__init__(tag)
 
-    if not isinstance(body, (bytearray, bytes)):
-      raise TypeError('body must be of type bytes or a bytearray.')
-
-    self.contexts, self.dest, self.dtab, self.body = tuple(contexts), dest, dtab, body
-
-  def encode(self):
-    return bytearray().join([
-        self.encode_header(Message.T_DISPATCH),
-        Fragments.encode_contexts(self.contexts),
-        Fragments.encode_s2(self.dest),
-        Fragments.encode_contexts(self.dtab),
+    if not isinstance(body, (bytearray, bytes, memoryview)):
+      raise TypeError('body must be of type bytes, bytearray or memoryview.')
+
+    self._raw = None
+    self.contexts, self.dest, self.dtab, self.body = contexts, dest, dtab, body
+
+  def _materialize(self):
+    # Decode every lazy field before the raw encoding they came from is dropped.
+    if self._raw is not None:
+      self.contexts, self.dest, self.dtab
+      self._raw = None
+
+  @property
+  def contexts(self):
+    if self._contexts is None:
+      _, self._contexts = ENCODING_CACHE.decode_contexts(self._raw, 0)
+    return self._contexts
+
+  @contexts.setter
+  def contexts(self, contexts):
+    self._materialize()
+    self._contexts = tuple(contexts)
+
+  @property
+  def dest(self):
+    if self._dest is None:
+      _, self._dest = ENCODING_CACHE.decode_dest(self._raw, self._dest_offset)
+    return self._dest
+
+  @dest.setter
+  def dest(self, dest):
+    self._materialize()
+    self._dest = dest
+
+  @property
+  def dtab(self):
+    if self._dtab is None:
+      _, self._dtab = ENCODING_CACHE.decode_dtab(self._raw, self._dtab_offset)
+    return self._dtab
+
+  @dtab.setter
+  def dtab(self, dtab):
+    self._materialize()
+    self._dtab = dtab if isinstance(dtab, Dtab) else Dtab(dtab)
+
+  def encode_parts(self):
+    if self._raw is not None:
+      return [self.encode_header(Message.T_DISPATCH), self._raw, self.body]
+
+    return [
+        bytearray().join([
+            self.encode_header(Message.T_DISPATCH),
+            ENCODING_CACHE.encode_contexts(self.contexts),
+            Fragments.encode_s2(self.dest),
+            ENCODING_CACHE.encode_dtab(self.dtab),
+        ]),
         self.body,
-    ])
+    ]
 
 
 class Rdispatch(Packet):
+  __slots__ = ('status', '_raw', '_contexts', 'body')
+
   @classmethod
   def decode_body(cls, tag, body):
-    status = body[0]
+    status, = UINT8.unpack_from(body, 0)
 
     if status not in (Status.OK, Status.ERROR, Status.NACK):
       raise ValueError('Got an unknown status type: 0x%x' % status)
 
-    consumed, contexts = Fragments.decode_contexts(body[1:])
-    body = body[1 + consumed:]
+    consumed, contexts = ENCODING_CACHE.decode_contexts(body, 1)
+
+    return cls(tag, status, contexts, body[1 + consumed:])
 
-    return cls(tag, status, contexts, body)
+  @classmethod
+  def decode_lazy(cls, tag, body):
+    status, = UINT8.unpack_from(body, 0)
+
+    if status not in (Status.OK, Status.ERROR, Status.NACK):
+      raise ValueError('Got an unknown status type: 0x%x' % status)
+
+    body_offset = 1 + Fragments.skip_contexts(body, 1)
+    msg = cls.__new__(cls)
+    Packet.__init__(msg, tag)
+    msg.status, msg._raw, msg._contexts = status, body[1:body_offset], None
+    msg.body = body[body_offset:]
+    return msg
 
   def __init__(self, tag, status, contexts, body):
     super(Rdispatch, self).__init__(tag)
 
-    if not isinstance(body, (bytearray, bytes)):
-      raise TypeError('body must be of type bytes or a bytearray.')
+    if not isinstance(body, (bytearray, bytes, memoryview)):
+      raise TypeError('body must be of type bytes, bytearray or memoryview.')
 
-    self.status, self.contexts, self.body = status, tuple(contexts), body
+    self._raw = None
+    self.status, self.contexts, self.body = status, contexts, body
 
-  def encode(self):
-    return bytearray().join([
-        self.encode_header(Message.R_DISPATCH),
-        struct.pack('B', self.status),
-        Fragments.encode_contexts(self.contexts),
+  @property
+  def contexts(self):
+    if self._contexts is None:
+      _, self._contexts = ENCODING_CACHE.decode_contexts(self._raw, 0)
+    return self._contexts
+
+  @contexts.setter
+  def contexts(self, contexts):
+    self._contexts, self._raw = tuple(contexts), None
+
+  def encode_parts(self):
+    if self._raw is not None:
+      return [
+          HEADER_STATUS.pack(self.header_word(Message.R_DISPATCH, self.tag), self.status),
+          self._raw,
+          self.body,
+      ]
+
+    return [
+        bytearray().join([
+            HEADER_STATUS.pack(self.header_word(Message.R_DISPATCH, self.tag), self.status),
+            ENCODING_CACHE.encode_contexts(self.contexts),
+        ]),
         self.body,
-    ])
+    ]
 
 
 class RdispatchOk(Rdispatch):
+  __slots__ = ()
+
   def __init__(self, tag, contexts, reply):
     super(RdispatchOk, self).__init__(tag, Status.OK, contexts, reply)
 
 
 class RdispatchError(Rdispatch):
+  __slots__ = ()
+
   def __init__(self, tag, contexts, error):
     super(RdispatchError, self).__init__(tag, Status.ERROR, contexts, error.encode('utf-8'))
 
 
 class RdispatchNack(Rdispatch):
+  __slots__ = ()
+
   def __init__(self, tag, contexts):
     super(RdispatchNack, self).__init__(tag, Status.NACK, contexts, b'')
 
 
 class Tdrain(Packet):
+  __slots__ = ()
+
   @classmethod
   def decode_body(cls, tag, body):
     if body:
@@ -416,11 +833,13 @@ class Tdrain(Packet):
   def __init__(self, tag):
     super(Tdrain, self).__init__(tag)
 
-  def encode(self):
-    return self.encode_header(Message.T_DRAIN)
+  def encode_parts(self):
+    return [self.encode_header(Message.T_DRAIN)]
 
 
 class Rdrain(Packet):
+  __slots__ = ()
+
   @classmethod
   def decode_body(cls, tag, body):
     if body:
@@ -430,11 +849,13 @@ class Rdrain(Packet):
   def __init__(self, tag):
     super(Rdrain, self).__init__(tag)
 
-  def encode(self):
-    return self.encode_header(Message.R_DRAIN)
+  def encode_parts(self):
+    return [self.encode_header(Message.R_DRAIN)]
 
 
 class Tping(Packet):
+  __slots__ = ()
+
   @classmethod
   def decode_body(cls, tag, body):
     if body:
@@ -444,11 +865,13 @@ class Tping(Packet):
   def __init__(self, tag):
     super(Tping, self).__init__(tag)
 
-  def encode(self):
-    return self.encode_header(Message.T_PING)
+  def encode_parts(self):
+    return [self.encode_header(Message.T_PING)]
 
 
 class Rping(Packet):
+  __slots__ = ()
+
   @classmethod
   def decode_body(cls, tag, body):
     if body:
@@ -458,44 +881,53 @@ class Rping(Packet):
   def __init__(self, tag):
     super(Rping, self).__init__(tag)
 
-  def encode(self):
-    return self.encode_header(Message.R_PING)
+  def encode_parts(self):
+    return [self.encode_header(Message.R_PING)]
 
 
 class Rerr(Packet):
+  __slots__ = ('error',)
+
   @classmethod
   def decode_body(cls, tag, body):
-    return cls(tag, body.decode('utf-8'))
+    return cls(tag, decode_utf8(body))
 
   def __init__(self, tag, error):
     super(Rerr, self).__init__(tag)
     self.error = error
 
-  def encode(self):
-    return self.encode_header(Message.R_ERR) + self.error.encode('utf-8')
+  def encode_parts(self):
+    return [self.encode_header(Message.R_ERR), self.error.encode('utf-8')]
 
 
 class Tdiscarded(Packet):
+  __slots__ = ('why',)
+
   @classmethod
   def decode_body(cls, tag, body):
-    return cls(tag, body.decode('utf-8'))
+    return cls(tag, decode_utf8(body))
 
   def __init__(self, tag, why):
     super(Tdiscarded, self).__init__(tag)
     self.why = why
 
-  def encode(self):
-    return self.encode_header(Message.T_DISCARDED) + self.why.encode('utf-8')
+  def encode_parts(self):
+    return [self.encode_header(Message.T_DISCARDED), self.why.encode('utf-8')]
 
 
 class Tlease(Packet):
+  __slots__ = ('unit', 'length')
+
   MILLISECONDS = 1
 
+  # The longest lease, as in Finagle, which clients take to mean an unlimited one.
+  MAX_LENGTH = (1 << 63) - 1
+
   @classmethod
   def decode_body(cls, tag, body):
     if len(body) < 9:
       raise ValueError('Insufficient data to decode Tlease.')
-    unit, length = struct.unpack('>BQ', body[0:9])
+    unit, length = LEASE.unpack_from(body, 0)
     return cls(tag, unit, length)
 
   def __init__(self, tag, unit, length):
@@ -504,12 +936,8 @@ class Tlease(Packet):
     if self.unit not in (self.MILLISECONDS,):
       raise ValueError('Unknown unit type %d' % self.unit)
 
-  def encode(self):
-    return bytearray().join([
-        self.encode_header(Message.T_LEASE),
-        struct.pack('B', self.unit),
-        struct.pack('>Q', self.length)
-    ])
+  def encode_parts(self):
+    return [self.encode_header(Message.T_LEASE) + LEASE.pack(self.unit, self.length)]
 
 
 Packet.register(Message.T_REQ, Treq)
@@ -525,16 +953,279 @@ Packet.register(Message.T_LEASE, Tlease)
 Packet.register(Message.R_ERR, Rerr)
 
 
+_MESSAGE_NAMES = {}
+
+
+def message_name(packet):
+  """Return the name of the registered message type of packet, e.g. Rreq for an RreqOk."""
+  cls = packet.__class__
+  name = _MESSAGE_NAMES.get(cls)
+  if name is None:
+    registered = set(Packet.IMPLS.values())
+    name = next((base.__name__ for base in cls.__mro__ if base in registered), cls.__name__)
+    _MESSAGE_NAMES[cls] = name
+  return name
+
+
+def frame_iov(packet):
+  """Return the framed packet as a list of buffers suitable for socket.sendmsg.
+
+  The length prefix is folded into the first (header) buffer; message bodies are passed through
+  without being copied.
+  """
+  parts = packet.encode_parts()
+  length = sum(len(part) for part in parts)
+  return [UINT32.pack(length) + parts[0]] + parts[1:]
+
+
 def frame(packet):
-  body = packet.encode()
-  return struct.pack('>I', len(body)) + body
+  return join_bytes(frame_iov(packet))
+
+
+def encode_many(packets):
+  """Frame every packet into a single bytearray, ready for one write."""
+  return join_buffers([buf for packet in packets for buf in frame_iov(packet)])
+
+
+def decode_many(buf, lazy=False):
+  """Decode every complete frame at the start of buf.
+
+  Returns (packets, consumed), where consumed is the number of bytes of buf occupied by the
+  decoded frames; any incomplete frame after them is left for the caller to complete.  Each
+  message is decoded in place from a view of buf, so only its body is sliced.  Fragmented
+  messages are not reassembled (see FrameDecoder), and a malformed frame raises ValueError.
+  """
+  view = buf if isinstance(buf, memoryview) else memoryview(buf)
+  decode_from = Packet.decode_from
+  unpack_from = UINT32.unpack_from
+  packets = []
+  start, end = 0, len(view)
+
+  while end - start >= 4:
+    length, = unpack_from(view, start)
+    frame_end = start + 4 + length
+    if frame_end > end:
+      break
+    packets.append(decode_from(view, start + 4, frame_end, lazy))
+    start = frame_end
+
+  return packets, start
+
+
+def fragment_iov(packet, max_fragment_size):
+  """Yield the framed packet as a series of fragments of at most max_fragment_size payload bytes.
+
+  Each fragment is a list of buffers as returned by frame_iov; payload chunks are views into the
+  encoded message, so the body is still never copied.  Messages that fit in a single fragment
+  are yielded unchanged.  Fragments are produced lazily so that a sender can interleave them
+  with other messages as the connection drains.
+  """
+  if max_fragment_size < 1:
+    raise ValueError('max_fragment_size must be positive.')
+
+  parts = packet.encode_parts()
+  remaining = sum(len(part) for part in parts) - 4
+
+  if remaining <= max_fragment_size:
+    yield [UINT32.pack(remaining + 4) + parts[0]] + parts[1:]
+    return
+
+  header, = HEADER.unpack_from(parts[0], 0)
+  chunk, chunk_size = [], 0
+
+  for part in [memoryview(parts[0])[4:]] + [memoryview(part) for part in parts[1:]]:
+    while part:
+      take = min(len(part), max_fragment_size - chunk_size)
+      chunk.append(part[:take])
+      part = part[take:]
+      chunk_size += take
+      remaining -= take
+      if chunk_size == max_fragment_size or remaining == 0:
+        word = header | TAG_FRAGMENT if remaining else header
+        yield [FRAME_HEADER.pack(chunk_size + 4, word)] + chunk
+        chunk, chunk_size = [], 0
 
 
 def unframe(body):
   if len(body) < 4:
     raise ValueError('Insufficient body to unframe a packet.')
 
-  length = struct.unpack('>I', body[0:4])
-  packet = Packet.decode(body[4:length + 4])
-
-  return length + 4, packet
+  return Fragments.decode_packet(body)
+
+
+class FrameDecoder(object):
+  """Incrementally decode framed packets from a stream of arbitrarily sized chunks.
+
+  Data is accumulated in a contiguous receive buffer, either by copying chunks in with feed()
+  or by reading straight into it with recv_into() (or get_buffer()/buffer_updated(), which
+  mirror asyncio.BufferedProtocol).  Decoded packets reference the receive buffer rather than
+  copying out of it, so a buffer is never written to again once its bytes have been handed
+  out: when it runs out of space the undecoded tail is moved into a freshly allocated buffer
+  and the old one is left to the packets still referring to it.  Allocation therefore happens
+  once per buffer_size bytes of traffic (or once per frame larger than that), not per frame.
+
+  Fragmented messages (see fragment_iov) are reassembled per tag, and may be interleaved with
+  other messages.  Reassembly copies the fragments once into a buffer for the whole message;
+  unfragmented messages are never copied.  max_message_size bounds the size of a reassembled
+  message.
+
+  If lazy is True, packets are decoded with Packet.decode(..., lazy=True).
+
+  If stats (a mux.stats.StatsReceiver) is given, the decoder counts the messages and bytes
+  received per message type as received/<type> and received_bytes/<type>, and records the time
+  taken to decode each message in nanoseconds as decode_ns.
+  """
+
+  DEFAULT_BUFFER_SIZE = 64 * 1024
+
+  # get_buffer always offers at least this much space (or buffer_size, if smaller) so that a
+  # nearly full buffer does not degrade into a series of tiny reads.
+  MIN_READ_SIZE = 4096
+
+  def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, max_frame_size=None,
+               max_message_size=None, lazy=False, stats=None):
+    if buffer_size < 4:
+      raise ValueError('buffer_size must be at least 4 bytes.')
+    self._buffer_size = buffer_size
+    self._max_frame_size = max_frame_size
+    self._max_message_size = max_message_size
+    self._lazy = lazy
+    self._stats = stats if stats is not None and stats.enabled else None
+    self._partial = {}  # tag -> [payload size, [payload chunks]] for partially received messages
+    self._view = memoryview(bytearray(buffer_size))
+    self._start = 0  # offset of the first byte not yet decoded
+    self._end = 0  # offset one past the last byte received
+    self._frame_size = 0  # size (including length prefix) of the next frame, if known
+    self._ready = []
+
+  def __len__(self):
+    """The number of received bytes not yet decoded into packets."""
+    return self._end - self._start
+
+  def _reserve(self, nbytes):
+    if len(self._view) - self._end >= nbytes:
+      return
+    pending = self._end - self._start
+    size = max(self._buffer_size, pending + nbytes, self._frame_size)
+    view = memoryview(bytearray(size))
+    view[0:pending] = self._view[self._start:self._end]
+    self._view, self._start, self._end = view, 0, pending
+
+  def get_buffer(self, sizehint=-1):
+    """Return a writable memoryview into the receive buffer of at least sizehint bytes.
+
+    After writing n bytes into the start of the returned view, call buffer_updated(n).
+    """
+    self._reserve(max(
+        sizehint,
+        self._frame_size - len(self),
+        min(self.MIN_READ_SIZE, self._buffer_size)))
+    return self._view[self._end:]
+
+  def buffer_updated(self, nbytes):
+    """Commit nbytes written into the view returned by get_buffer and decode what is complete.
+
+    Returns a list of the packets completed by this update.
+    """
+    if self._end + nbytes > len(self._view):
+      raise ValueError('Cannot commit more bytes than the receive buffer holds.')
+    self._end += nbytes
+    return self._decode()
+
+  def feed(self, data):
+    """Copy data into the receive buffer and return a list of the packets it completes."""
+    nbytes = len(data)
+    self._reserve(nbytes)
+    self._view[self._end:self._end + nbytes] = data
+    return self.buffer_updated(nbytes)
+
+  def recv_into(self, sock, nbytes=0):
+    """Read from sock directly into the receive buffer and return the packets completed.
+
+    Raises EOFError if the peer has closed the connection.
+    """
+    view = self.get_buffer(nbytes)
+    received = sock.recv_into(view, nbytes or len(view))
+    if received == 0:
+      raise EOFError('Connection closed with %d undecoded bytes.' % len(self))
+    return self.buffer_updated(received)
+
+  def _decode(self):
+    packets, self._ready = self._ready, []
+    view, start, end = self._view, self._start, self._end
+    stats = self._stats
+
+    while end - start >= 4:
+      length, = UINT32.unpack_from(view, start)
+      if self._max_frame_size is not None and length > self._max_frame_size:
+        raise ValueError('Frame of %d bytes exceeds maximum frame size of %d' % (
+            length, self._max_frame_size))
+      if end - start - 4 < length:
+        self._frame_size = length + 4
+        break
+      self._start, start = start + 4 + length, start + 4 + length
+      try:
+        if stats is not None:
+          started = clock()
+        fragmented = length >= 4 and (
+            self._partial or HEADER.unpack_from(view, start - length)[0] & TAG_FRAGMENT)
+        if fragmented:
+          message = self._reassemble(view[start - length:start])
+          if message is None:
+            continue
+          packet, size = Packet.decode(message, self._lazy), len(message)
+        else:
+          packet, size = Packet.decode_from(view, start - length, start, self._lazy), length
+        packets.append(packet)
+        if stats is not None:
+          self._record(packet, size + 4, started)
+      except ValueError:
+        # Skip past the malformed frame but hold on to what has been decoded so far.
+        self._ready = packets
+        raise
+    else:
+      self._frame_size = 0
+
+    return packets
+
+  def _record(self, packet, size, started):
+    elapsed = clock() - started
+    name = message_name(packet)
+    self._stats.counter('received/' + name)
+    self._stats.counter('received_bytes/' + name, size)
+    self._stats.record('decode_ns', int(elapsed * 1e9))
+
+  def _reassemble(self, fragment):
+    header, = HEADER.unpack_from(fragment, 0)
+    tag = header & TAG_MASK
+    partial = self._partial.get(tag)
+
+    if partial is None:
+      if not header & TAG_FRAGMENT:
+        return fragment
+      partial = self._partial[tag] = [0, []]
+
+    payload = fragment[4:]
+    partial[0] += len(payload)
+    partial[1].append(payload)
+
+    if self._max_message_size is not None and partial[0] > self._max_message_size:
+      del self._partial[tag]
+      raise ValueError('Fragmented message for tag %d exceeds maximum message size of %d' % (
+          tag, self._max_message_size))
+
+    if header & TAG_FRAGMENT:
+      return None
+
+    del self._partial[tag]
+    message = memoryview(bytearray(4 + partial[0]))
+    HEADER.pack_into(message, 0, header)
+    offset = 4
+    for chunk in partial[1]:
+      message[offset:offset + len(chunk)] = chunk
+      offset += len(chunk)
+    return message
+
+  def discard(self, tag):
+    """Drop any partially reassembled message for tag (e.g. after a Tdiscarded.)"""
+    self._partial.pop(tag & TAG_MASK, None)
@@ -15,6 +15,12 @@ setup(
   license = 'Apache License, Version 2.0',
   packages = find_packages(),
   zip_safe = True,
+  entry_points = {
+    'console_scripts': [
+      'mux-benchmark = mux.benchmarks.suite:main',
+      'mux-load = mux.benchmarks.load:main',
+    ],
+  },
   classifiers          = [
     'Programming Language :: Python',
     'Intended Audience :: Developers',
@@ -0,0 +1,55 @@
+import struct
+
+from mux.benchmarks import messages, suite
+from mux.wire import Packet
+
+import pytest
+
+
+def test_every_message_type_has_a_sample():
+  assert set(suite.SAMPLES) == set(Packet.IMPLS.values())
+  for typ, make in suite.SAMPLES.items():
+    msg = make(b'body', suite.make_contexts(2))
+    assert isinstance(msg, typ)
+    assert Packet.decode(msg.encode()).encode() == msg.encode()
+
+
+def test_legacy_message_codecs():
+  for msg in messages.sample_messages():
+    encoded = msg.encode()
+    assert messages.legacy_decode(encoded).encode() == encoded
+    assert type(messages.legacy_decode(bytearray(encoded))) is type(Packet.decode(encoded))
+    message_type_byte, = struct.unpack_from('b', encoded, 0)
+    assert bytes(messages.legacy_encode_header(message_type_byte, msg.tag)) == encoded[:4]
+
+
+def test_report_and_compare():
+  report = suite.run(groups=('parsers',), min_time=0.001, repeat=1)
+  assert [result['name'] for result in report['results']] == ['parse_dtab'] * 3 + ['parse_path']
+  assert all(result['ops_per_sec'] > 0 for result in report['results'])
+
+  baseline = dict(results=[
+      dict(group='parsers', name='parse_path', params=dict(labels=5), ops_per_sec=1.0),
+      dict(group='memory', name='Path', params={}, bytes=100.0),
+  ])
+  current = dict(results=[
+      dict(group='parsers', name='parse_path', params=dict(labels=5), ops_per_sec=2.0),
+      dict(group='memory', name='Path', params={}, bytes=50.0),
+      dict(group='memory', name='Dtab', params={}, bytes=50.0),
+  ])
+  lines = suite.compare(baseline, current)
+  assert lines[0].endswith('2.00x') and lines[1].endswith('2.00x') and lines[2].endswith('new')
+
+
+@pytest.mark.parametrize('transport', ('tcp', 'unix'))
+def test_load_generator(transport):
+  load = pytest.importorskip('mux.benchmarks.load')
+  report = load.run(
+      transport=transport, connections=2, concurrency=8, payload=64, contexts=2, dentries=2,
+      dispatch_ratio=0.5, duration=0.2, warmup=0.05)
+  assert report['requests'] > 0 and report['errors'] == 0
+  assert report['payload_bytes_per_sec'] == pytest.approx(
+      report['requests'] * 128 / report['seconds'])
+  latency = report['latency_us']
+  assert 0 < latency['min'] <= latency['p50'] <= latency['p99'] <= latency['p999'] <= latency['max']
+  assert 'req/s' in load.format_report(report)
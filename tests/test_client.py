@@ -0,0 +1,312 @@
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from mux.client import MuxClient
+from mux.session import LeaseExpired, ServerError, SessionClosed, SessionDraining
+from mux.wire import (
+    FrameDecoder,
+    RdispatchOk,
+    Rdrain,
+    Rerr,
+    Rping,
+    RreqOk,
+    Tdiscarded,
+    Tdispatch,
+    Tdrain,
+    Tlease,
+    Tping,
+    Treq,
+    frame,
+)
+
+
+class FakeServer(asyncio.Protocol):
+  """Collects requests and replies to them in reverse order once `batch` have arrived."""
+
+  def __init__(self, batch=1):
+    self.batch = batch
+    self.decoder = FrameDecoder()
+    self.received = []
+    self.pending = []
+
+  def connection_made(self, transport):
+    self.transport = transport
+
+  def data_received(self, data):
+    for packet in self.decoder.feed(data):
+      self.received.append(packet)
+      if isinstance(packet, (Tdispatch, Treq, Tping)):
+        self.pending.append(packet)
+    if len(self.pending) >= self.batch:
+      pending, self.pending = self.pending, []
+      for packet in reversed(pending):
+        self.transport.write(frame(self.reply(packet)))
+
+  def reply(self, packet):
+    if isinstance(packet, Tdispatch):
+      if packet.dest == '/fail':
+        return Rerr(packet.tag, 'failed')
+      return RdispatchOk(packet.tag, (), b'echo:' + bytes(packet.body))
+    elif isinstance(packet, Treq):
+      return RreqOk(packet.tag, bytes(packet.body))
+    else:
+      return Rping(packet.tag)
+
+
+@pytest.fixture
+def loop():
+  loop = asyncio.new_event_loop()
+  yield loop
+  loop.close()
+
+
+def start(loop, server):
+  listener = loop.run_until_complete(loop.create_server(lambda: server, '127.0.0.1', 0))
+  port = listener.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(MuxClient.connect('127.0.0.1', port, loop=loop))
+  listener.fake_server = server
+  return listener, client
+
+
+def stop(loop, listener, client):
+  client.close()
+  listener.fake_server.transport.close()
+  listener.close()
+  loop.run_until_complete(client.closed)
+  loop.run_until_complete(listener.wait_closed())
+
+
+def test_pipelined_out_of_order_replies(loop):
+  server = FakeServer(batch=1000)
+  listener, client = start(loop, server)
+  try:
+    futures = [client.dispatch('/echo', str(k).encode('utf-8')) for k in range(1000)]
+    assert client.outstanding == 1000
+    replies = loop.run_until_complete(asyncio.gather(*futures))
+    assert [bytes(reply.body) for reply in replies] == [
+        b'echo:' + str(k).encode('utf-8') for k in range(1000)]
+    assert len(set(packet.tag for packet in server.received)) == 1000
+    assert client.outstanding == 0
+  finally:
+    stop(loop, listener, client)
+
+
+def test_request_types(loop):
+  listener, client = start(loop, FakeServer(batch=3))
+  try:
+    rreq, rping, failure = loop.run_until_complete(asyncio.gather(
+        client.request(b'hello'),
+        client.ping(),
+        client.dispatch('/fail', b''),
+        return_exceptions=True))
+    assert bytes(rreq.body) == b'hello'
+    assert isinstance(rping, Rping)
+    assert isinstance(failure, ServerError)
+  finally:
+    stop(loop, listener, client)
+
+
+def test_cancel_sends_tdiscarded(loop):
+  server = FakeServer(batch=2)
+  listener, client = start(loop, server)
+  try:
+    future = client.dispatch('/echo', b'slow')
+    future.cancel()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert any(isinstance(packet, Tdiscarded) for packet in server.received)
+    # the tag stays reserved until the late reply arrives
+    assert client.outstanding == 1
+    loop.run_until_complete(client.dispatch('/echo', b'fast'))
+    assert client.outstanding == 0
+  finally:
+    stop(loop, listener, client)
+
+
+def test_unencodable_request_releases_tag(loop):
+  server = FakeServer()
+  listener, client = start(loop, server)
+  try:
+    with pytest.raises(ValueError):
+      client.dispatch('/' * 65536, b'body')
+    with pytest.raises(AttributeError):
+      client.dispatch('/echo', b'body', contexts=[('key', 1)])
+    assert client.outstanding == 0
+    assert loop.run_until_complete(client.dispatch('/echo', b'ok')).body == b'echo:ok'
+  finally:
+    stop(loop, listener, client)
+
+
+def test_tping_and_tdrain_from_server(loop):
+  server = FakeServer(batch=1)
+  listener, client = start(loop, server)
+  try:
+    server.transport.write(frame(Tping(9)) + frame(Tdrain(10)))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    tags = [packet.tag for packet in server.received]
+    assert tags == [9, 10]
+    assert client.draining
+    with pytest.raises(SessionDraining):
+      loop.run_until_complete(client.dispatch('/echo', b''))
+  finally:
+    stop(loop, listener, client)
+
+
+def test_leases(loop):
+  server = FakeServer(batch=1)
+  listener, client = start(loop, server)
+  try:
+    assert client.available and client.lease_remaining is None
+
+    server.transport.write(frame(Tlease(0, Tlease.MILLISECONDS, 0)))
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert not client.available and client.lease_remaining == 0
+    with pytest.raises(LeaseExpired):
+      loop.run_until_complete(client.dispatch('/echo', b''))
+    with pytest.raises(LeaseExpired):
+      loop.run_until_complete(client.request(b''))
+    loop.run_until_complete(client.ping())
+
+    server.transport.write(frame(Tlease(0, Tlease.MILLISECONDS, 100)))
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert client.available and 0 < client.lease_remaining <= 0.1
+    reply = loop.run_until_complete(client.dispatch('/echo', b'leased'))
+    assert bytes(reply.body) == b'echo:leased'
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert not client.available
+    with pytest.raises(LeaseExpired):
+      loop.run_until_complete(client.dispatch('/echo', b''))
+
+    server.transport.write(frame(Tlease(0, Tlease.MILLISECONDS, Tlease.MAX_LENGTH)))
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert client.available and client.lease_remaining is None
+  finally:
+    stop(loop, listener, client)
+
+
+def test_connection_lost_fails_outstanding(loop):
+  server = FakeServer(batch=2)
+  listener, client = start(loop, server)
+  try:
+    future = client.dispatch('/echo', b'')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    server.transport.close()
+    with pytest.raises(SessionClosed):
+      loop.run_until_complete(future)
+    with pytest.raises(SessionClosed):
+      loop.run_until_complete(client.dispatch('/echo', b''))
+  finally:
+    stop(loop, listener, client)
+
+
+class CountingTransport(object):
+  def __init__(self, transport):
+    self.transport = transport
+    self.writes = []
+
+  def writelines(self, iov):
+    self.writes.append(b''.join(iov))
+    self.transport.writelines(iov)
+
+  def __getattr__(self, name):
+    return getattr(self.transport, name)
+
+
+def test_writes_are_coalesced(loop):
+  server = FakeServer(batch=100)
+  listener, client = start(loop, server)
+  transport = client._transport = CountingTransport(client._transport)
+  try:
+    futures = [client.dispatch('/echo', b'x') for _ in range(100)]
+    assert transport.writes == []
+    assert client.queued_bytes > 0
+
+    # control messages skip the queue
+    client._tping_received(Tping(99))
+    assert len(transport.writes) == 1
+
+    loop.run_until_complete(asyncio.gather(*futures))
+    assert len(transport.writes) == 2
+    assert client.queued_bytes == 0
+  finally:
+    stop(loop, listener, client)
+
+
+def test_coalescing_limits(loop):
+  server = FakeServer(batch=1)
+  listener = loop.run_until_complete(loop.create_server(lambda: server, '127.0.0.1', 0))
+  listener.fake_server = server
+  port = listener.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, flush_bytes=1024, flush_delay=0.05))
+  transport = client._transport = CountingTransport(client._transport)
+  try:
+    # exceeding flush_bytes flushes immediately
+    client.dispatch('/echo', b'x' * 2048)
+    assert len(transport.writes) == 1
+
+    # otherwise frames wait for flush_delay
+    future = client.dispatch('/echo', b'x')
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert len(transport.writes) == 1
+    loop.run_until_complete(future)
+    assert len(transport.writes) == 2
+  finally:
+    stop(loop, listener, client)
+
+
+def test_drain_follows_queued_requests(loop):
+  server = FakeServer(batch=2)
+  listener = loop.run_until_complete(loop.create_server(lambda: server, '127.0.0.1', 0))
+  listener.fake_server = server
+  port = listener.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, flush_delay=1.0))
+  try:
+    client.dispatch('/echo', b'queued')
+    server.transport.write(frame(Tdrain(10)))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert [type(packet) for packet in server.received] == [Tdispatch, Rdrain]
+    assert client.queued_bytes == 0
+  finally:
+    stop(loop, listener, client)
+
+
+class PausingTransport(object):
+  """Pauses writing on the protocol after every write, as a transport with a full buffer does."""
+
+  def __init__(self, transport, protocol):
+    self.transport = transport
+    self.protocol = protocol
+
+  def writelines(self, iov):
+    self.transport.writelines(iov)
+    self.protocol.pause_writing()
+
+  def __getattr__(self, name):
+    return getattr(self.transport, name)
+
+
+def test_cancel_after_final_fragment_keeps_tag(loop):
+  server = FakeServer(batch=2)
+  listener = loop.run_until_complete(loop.create_server(lambda: server, '127.0.0.1', 0))
+  listener.fake_server = server
+  port = listener.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, max_fragment_size=4096, flush_delay=None))
+  client._transport = PausingTransport(client._transport, client)
+  try:
+    future = client.dispatch('/echo', b'x' * 10000)
+    client.resume_writing()
+    client.resume_writing()  # writes the final fragment
+    future.cancel()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert [type(packet) for packet in server.received] == [Tdispatch, Tdiscarded]
+    # the server has the whole request and will still reply, so the tag stays reserved
+    assert client.outstanding == 1
+    client.resume_writing()
+    loop.run_until_complete(client.dispatch('/echo', b'ok'))
+    assert client.outstanding == 0
+  finally:
+    client._transport = client._transport.transport
+    stop(loop, listener, client)
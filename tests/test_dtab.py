@@ -0,0 +1,145 @@
+from mux.dtab import Dtab, Dentry
+from mux.name_tree import NameTree
+from mux.parsers import parse_dtab, parse_path, parse_tree
+from mux.path import Path
+
+import pytest
+
+
+def test_lookup():
+  dtab = parse_dtab('/s => /a; /s/x => /b | /c; /t => /d')
+  assert dtab.lookup(parse_path('/u')) is NameTree.Neg
+  assert dtab.lookup(parse_path('/s/y')) == parse_tree('/a/y')
+  # later dentries take precedence
+  assert dtab.lookup(parse_path('/s/x/y')) == NameTree.Alt(
+      parse_tree('/b/y | /c/y'), parse_tree('/a/x/y'))
+  assert Dtab.empty().lookup(parse_path('/s')) is NameTree.Neg
+
+
+def test_lookup_order_is_by_position():
+  dtab = parse_dtab('/s/x => /a; / => /b; /s => /c')
+  assert dtab.lookup(parse_path('/s/x')) == parse_tree('/c/x | /b/s/x | /a')
+
+
+def test_lookup_wire_entries():
+  dtab = Dtab([('/s', '/a & /b'), ('/t', '!')])
+  assert dtab.lookup(parse_path('/s/1')) == parse_tree('/a/1 & /b/1')
+  assert dtab.lookup(parse_path('/t')) is NameTree.Fail
+  assert Dentry.read(('/s', '~')) == Dentry(Path('s'), NameTree.Neg)
+
+
+def test_lookup_large_dtab():
+  dtab = Dtab(Dentry(Path('s', str(k)), NameTree.Leaf(Path('n', str(k)))) for k in range(5000))
+  assert dtab.lookup(Path('s', '1234', 'x')) == NameTree.Leaf(Path('n', '1234', 'x'))
+  assert dtab.lookup(Path('s', '5000')) is NameTree.Neg
+
+
+def test_bind():
+  dtab = parse_dtab('/s => /a | /b; /a => /$/inet/host/1; /b => /c & /$/inet/host/2')
+  assert dtab.bind(parse_path('/s/x')) == parse_tree('/$/inet/host/1/x | /$/inet/host/2/x')
+  assert dtab.bind(parse_path('/$/inet/host/1')) == parse_tree('/$/inet/host/1')
+  assert dtab.bind(parse_path('/unbound')) is NameTree.Neg
+
+
+def test_bind_cycle():
+  dtab = parse_dtab('/a => /b; /b => /a')
+  with pytest.raises(ValueError):
+    dtab.bind(parse_path('/a'))
+  with pytest.raises(ValueError):
+    parse_dtab('/a => /b; /b => /c').bind(parse_path('/a'), max_depth=2)
+  assert parse_dtab('/a => /b; /b => /c').bind(parse_path('/a'), max_depth=3) is NameTree.Neg
+
+
+def test_bind_memoized():
+  dtab = parse_dtab('/a => /b; /b => /c | /d; /c => /$/1; /d => /$/2')
+  tree = dtab.bind(parse_path('/a'))
+  assert tree == parse_tree('/$/1 | /$/2')
+  assert dtab.bind(parse_path('/a')) is tree
+  assert dtab._bound.hits == 1
+
+  # /b was bound while binding /a and takes fewer lookups than the limit allows
+  assert dtab.bind(parse_path('/b'), max_depth=2) == tree
+  with pytest.raises(ValueError):
+    dtab.bind(parse_path('/a'), max_depth=2)
+
+  # a new dtab starts with a fresh memo
+  changed = parse_dtab('/a => /b; /b => /c | /d; /c => /$/1; /d => /$/3')
+  assert changed.bind(parse_path('/a')) == parse_tree('/$/1 | /$/3')
+
+
+def test_simplify():
+  for tree, simplified in (
+      ('/a', '/a'),
+      ('~ | /a | (/b | ~) | /c', '/a | /b | /c'),
+      ('/a | ! | /b', '/a | !'),
+      ('/a | (/b | $) | /c', '/a | /b | $'),
+      ('/a & ~ & (/b & /c)', '/a & /b & /c'),
+      ('/a & (/b | !)', '/a & (/b | !)'),
+      ('/a & ! & /b', '!'),
+      ('$ & ~', '$'),
+      ('$ & /a', '/a'),
+      ('~ | ~', '~'),
+      ('~ & (~ | ~)', '~')):
+    assert NameTree.simplify(parse_tree(tree)) == parse_tree(simplified)
+
+
+def test_concat_shares_base():
+  base = parse_dtab(';'.join('/s/%d => /$/base/%d' % (k, k) for k in range(100)))
+  local = parse_dtab('/s/1 => /$/local; /t => /s/2')
+  layered = base + local
+  assert layered._base is base and len(layered) == 102
+  assert list(layered) == list(base) + list(local)
+  assert layered == Dtab(list(base) + list(local))
+  assert hash(layered) == hash(Dtab(list(base) + list(local)))
+  assert layered != base and layered != local + base
+
+  assert layered.lookup(parse_path('/s/1/x')) == parse_tree('/$/local/x | /$/base/1/x')
+  assert layered.bind(parse_path('/t')) == parse_tree('/$/base/2')
+  assert base._index is not None and base + Dtab.empty() is base and Dtab.empty() + base is base
+
+  # layering a dtab at least as large as the base copies rather than nesting
+  assert (local + base)._base is None
+  assert (local + base).lookup(parse_path('/s/1')) == parse_tree('/$/base/1 | /$/local')
+
+
+def test_equality():
+  dtab = parse_dtab('/a => /b; /c => /d')
+  assert dtab == parse_dtab('/a => /b') + parse_dtab('/c => /d')
+  assert dtab != parse_dtab('/c => /d; /a => /b')
+  assert dtab != parse_dtab('/a => /b')
+  assert dtab != [Dentry(Path('a'), NameTree.Leaf(Path('b')))]
+  assert Dtab([('/a', '/b')]) == Dtab([('/a', '/b')])
+  assert Dtab.empty() == Dtab([])
+  assert len(set([dtab, parse_dtab('/a => /b; /c => /d'), Dtab.empty()])) == 2
+
+
+def test_equality_of_parsed_and_wire_entries():
+  parsed, wire = parse_dtab('/a=>/b'), Dtab([('/a', '/b')])
+  assert parsed == wire and hash(parsed) == hash(wire)
+  assert parse_dtab('/a => /b; /c => /d') == Dtab([('/a', '/b')]) + Dtab([('/c', ' /d ')])
+  assert parsed != Dtab([('/a', '/c')])
+
+
+def test_concat_depth_is_logarithmic():
+  dtab = Dtab.empty()
+  for k in range(3000):
+    dtab = dtab + Dtab([('/s/%d' % k, '/$/%d' % k)])
+
+  depth, layer = 0, dtab
+  while layer is not None:
+    depth, layer = depth + 1, layer._base
+  assert depth <= 12
+  assert len(dtab) == 3000 and len(list(dtab)) == 3000
+  assert dtab.lookup(parse_path('/s/0')) == parse_tree('/$/0')
+  assert hash(dtab) == hash(Dtab(list(dtab)))
+
+
+def test_equality_of_unparseable_entries():
+  assert Dtab([('a', 'b')]) == Dtab([('a', 'b')])
+  assert hash(Dtab([('a', 'b')])) == hash(Dtab([('a', 'b')]))
+  assert Dtab([('a', 'b')]) != Dtab([('a', 'c')])
+  mixed = Dtab([('/a', '/b'), ('foo', 'bar')])
+  assert mixed == Dtab([(' /a ', '/b'), ('foo', 'bar')])
+  assert mixed != parse_dtab('/a => /b')
+  with pytest.raises(ValueError):
+    mixed.lookup(parse_path('/a'))
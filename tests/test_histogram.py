@@ -0,0 +1,56 @@
+import random
+
+from mux.histogram import Histogram
+
+import pytest
+
+
+def test_histogram_exact_small_values():
+  histogram = Histogram()
+  for value in range(1, 101):
+    histogram.record(value)
+  assert histogram.count == 100 and histogram.min == 1 and histogram.max == 100
+  assert histogram.mean == 50.5
+  assert histogram.percentile(50) == 50
+  assert histogram.percentile(99) == 99
+  assert histogram.percentile(99.9) == 100
+  assert histogram.percentile(0) == 1
+  assert histogram.percentiles((50, 100)) == {50: 50, 100: 100}
+
+
+def test_histogram_precision():
+  rng = random.Random(1)
+  values = sorted(int(rng.expovariate(1.0 / 5000)) for _ in range(20000))
+  histogram = Histogram()
+  for value in values:
+    histogram.record(value)
+  for percentile in (50, 90, 99, 99.9):
+    exact = values[int(len(values) * percentile / 100.0 + 0.5) - 1]
+    estimate = histogram.percentile(percentile)
+    assert exact <= estimate <= exact * (1 + 1 / 128.0) + 1
+
+
+def test_histogram_large_values_stay_compact():
+  histogram = Histogram()
+  histogram.record(1 << 40)
+  histogram.record(0)
+  assert len(histogram._counts) < 5000
+  assert histogram.percentile(100) == 1 << 40
+  assert histogram.percentile(50) == 0
+
+
+def test_histogram_merge_and_clear():
+  a, b = Histogram(), Histogram()
+  a.record(10, count=3)
+  b.record(1000)
+  a.merge(b)
+  assert a.count == 4 and a.min == 10 and a.max == 1000
+  assert a.percentile(75) == 10 and a.percentile(100) == 1000
+
+  with pytest.raises(ValueError):
+    a.merge(Histogram(precision_bits=4))
+  with pytest.raises(ValueError):
+    a.record(-1)
+
+  a.clear()
+  assert a.count == 0 and a.percentile(50) == 0 and a.max is None
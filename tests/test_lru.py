@@ -0,0 +1,35 @@
+from mux.lru import LRUCache
+
+import pytest
+
+
+def test_lru_cache():
+  cache = LRUCache(2)
+  cache.put('a', 1)
+  cache.put('b', 2)
+  assert cache.get('a') == 1
+  cache.put('c', 3)
+  assert 'b' not in cache
+  assert cache.get('b') is None
+  assert cache.get('a') == 1 and cache.get('c') == 3
+  assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+  assert len(cache) == 2
+
+  cache.clear()
+  assert len(cache) == 0
+
+  with pytest.raises(ValueError):
+    LRUCache(0)
+
+
+def test_lru_cache_max_bytes():
+  cache = LRUCache(10, max_bytes=10)
+  cache.put('a', 1, size=4)
+  cache.put('b', 2, size=4)
+  cache.put('c', 3, size=4)
+  assert 'a' not in cache and cache.total_bytes == 8
+  cache.put('b', 2, size=1)
+  assert cache.total_bytes == 5
+  cache.put('huge', 4, size=11)
+  assert 'huge' not in cache and len(cache) == 2
+  assert cache.evictions == 1
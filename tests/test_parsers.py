@@ -1,6 +1,7 @@
 from mux.dtab import Dtab, Dentry
 from mux.name_tree import NameTree
 from mux.parsers import (
+    ParseCache,
     parse_dentry,
     parse_dtab,
     parse_path,
@@ -8,6 +9,8 @@ from mux.parsers import (
 )
 from mux.path import Path
 
+import threading
+
 import pytest
 
 
@@ -62,3 +65,83 @@ def test_parse_dtab():
       Dentry(Path.empty(), NameTree.Fail),
       Dentry(Path('foo'), NameTree.Leaf(Path('bar')))
   ])
+
+
+def test_parse_errors_report_position():
+  for string, position in (
+      ('/foo/bar/', 8),
+      ('/a//b=>!', 3),
+      ('/foo/\\x6', 5),
+      ('/foo => /bar |', 14),
+      ('/foo => (/bar', 13),
+      ('/foo = /bar', 5),
+      ('/foo => /bar; /baz => ?', 22)):
+    with pytest.raises(ValueError) as e:
+      parse_dtab(string)
+    assert 'position %d' % position in str(e.value)
+
+
+def test_parse_requires_entire_input():
+  for parse, string in ((parse_path, '/foo /bar'), (parse_tree, '/foo )'), (parse_dentry, '/=>! !')):
+    with pytest.raises(ValueError):
+      parse(string)
+
+
+def test_parse_matches_scanner():
+  from mux.benchmarks import parsers as benchmark, scanner
+  dtab = benchmark.make_dtab(20) + '; /a=>~; /b => $ & !; /=>/'
+  assert parse_dtab(dtab) == scanner.parse_dtab(dtab)
+  assert len(parse_dtab(dtab)) == 23
+
+
+def test_parse_long_label():
+  label = 'x' * 100000
+  assert parse_path('/' + label + '/\\x79') == Path(label, 'y')
+
+
+def test_parsed_values_are_hashable():
+  dtab = '/s => /a & /b | ~; /t => (/c | !) & $'
+  assert hash(parse_dtab(dtab)) == hash(parse_dtab(dtab))
+  assert len(set([parse_dtab(dtab), parse_dtab(dtab), parse_dtab('/s=>/a')])) == 2
+  assert parse_path('/a') != parse_path('/b')
+
+
+def test_parse_cache():
+  cache = ParseCache(max_entries=2)
+  assert cache.parse_dtab('/s=>/a') is cache.parse_dtab('/s=>/a')
+  assert cache.parse_path('/s') == Path('s')
+  assert cache.parse_tree('/s') == NameTree.Leaf(Path('s'))
+  assert cache.parse_dtab('/s=>/a') == parse_dtab('/s=>/a')
+  assert cache.stats == dict(hits=1, misses=4, evictions=2, entries=2, bytes=8)
+
+  with pytest.raises(ValueError):
+    cache.parse_dentry('/s')
+
+  cache.clear()
+  assert cache.stats['entries'] == cache.stats['bytes'] == 0
+
+
+def test_parse_cache_max_bytes():
+  cache = ParseCache(max_bytes=10)
+  cache.parse_path('/aaaa')
+  cache.parse_path('/bbbb')
+  cache.parse_path('/cccc')
+  assert cache.stats['entries'] == 2 and cache.stats['evictions'] == 1
+
+
+def test_parse_cache_threads():
+  cache = ParseCache(max_entries=8)
+  results = []
+
+  def parse():
+    for k in range(200):
+      results.append(cache.parse_path('/s/%d' % (k % 16)) == Path('s', str(k % 16)))
+
+  threads = [threading.Thread(target=parse) for _ in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert all(results) and len(results) == 800
+  stats = cache.stats
+  assert stats['hits'] + stats['misses'] == 800 and stats['entries'] <= 8
@@ -0,0 +1,48 @@
+import gc
+import weakref
+
+from mux.path import Path
+
+
+def test_path_value():
+  path = Path('a', 'b')
+  assert path == Path('a', 'b') and hash(path) == hash(Path('a', 'b'))
+  assert path != Path('a') and path != ('a', 'b')
+  assert {path: 1}[Path('a', 'b')] == 1
+  assert len(path) == 2 and path[1] == 'b' and list(path) == ['a', 'b']
+  assert str(path) == '/a/b' and str(Path.empty()) == '/'
+  assert repr(path) == "Path('a', 'b')"
+  assert not hasattr(path, '__dict__')
+
+
+def test_path_prefix_operations():
+  path = Path('a', 'b', 'c')
+  assert path.startswith(Path.empty())
+  assert path.startswith(Path('a', 'b'))
+  assert not path.startswith(Path('b'))
+  assert not Path('a').startswith(path)
+
+  assert path.drop(1) == Path('b', 'c')
+  assert path.drop(5) == Path.empty()
+  assert path.take(2) == Path('a', 'b')
+  assert path.take(-1) == Path.empty()
+  assert path.take(3) is path and path.drop(0) is path
+
+  assert path.concat(Path('d')) == Path('a', 'b', 'c', 'd')
+  assert path + Path.empty() is path
+  assert Path.empty() + path is path
+  assert path.take(1) + path.drop(1) == path
+  assert hash(path.take(1) + path.drop(1)) == hash(path)
+
+
+def test_path_intern():
+  path = Path('a', 'b').intern()
+  assert Path('a', 'b').intern() is path
+  assert Path('a', 'c').intern() is not path
+
+  released = Path('x', 'y')
+  assert released.intern() is released
+  released = weakref.ref(released)
+  gc.collect()
+  assert released() is None
+  assert ('x', 'y') not in Path._interned
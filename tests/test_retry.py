@@ -0,0 +1,153 @@
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from mux.client import MuxClient, MuxClientPool
+from mux.retry import NackRetries, RetryBudget
+from mux.server import MuxServer
+from mux.session import Nack
+from mux.stats import InMemoryStatsReceiver
+from mux.wire import Status
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def loop():
+  loop = asyncio.new_event_loop()
+  yield loop
+  loop.close()
+
+
+def test_budget_minimum_rate():
+  clock = FakeClock()
+  budget = RetryBudget(ttl=1.0, min_retries_per_sec=3, percent_can_retry=0, now=clock)
+  assert budget.balance == 3
+  assert [budget.try_withdraw() for _ in range(4)] == [True, True, True, False]
+  clock.now += 0.5
+  assert not budget.try_withdraw()
+  # Withdrawals are forgotten once they leave the window.
+  clock.now += 0.6
+  assert budget.balance == 3
+
+
+def test_budget_percent_of_requests():
+  clock = FakeClock()
+  budget = RetryBudget(ttl=10.0, min_retries_per_sec=0, percent_can_retry=0.2, now=clock)
+  assert not budget.try_withdraw()
+  for _ in range(10):
+    budget.deposit()
+  assert budget.balance == 2
+  assert [budget.try_withdraw() for _ in range(3)] == [True, True, False]
+  clock.now += 5
+  for _ in range(5):
+    budget.deposit()
+  assert budget.try_withdraw()
+  assert not budget.try_withdraw()
+  # The first deposits and withdrawals leave the window; the later ones remain.
+  clock.now += 5.5
+  assert budget.balance == 0
+  clock.now += 100
+  budget.deposit()
+  assert budget.balance == 0 and sum(budget._deposits) == 1
+
+
+def test_budget_validation():
+  with pytest.raises(ValueError):
+    RetryBudget(ttl=0)
+  with pytest.raises(ValueError):
+    RetryBudget(percent_can_retry=-1)
+
+
+def test_backoff_is_jittered_exponential():
+  retries = NackRetries(backoff_base=0.01, backoff_max=0.05)
+  for count, ceiling in [(1, 0.01), (2, 0.02), (3, 0.04), (4, 0.05), (100, 0.05)]:
+    delays = [retries.backoff(count) for _ in range(50)]
+    assert all(0 <= delay <= ceiling for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def nacking_server(loop, nacks):
+  """Serve requests, nacking each body the number of times given in nacks."""
+  def handle(request):
+    body = bytes(request.body)
+    if nacks.get(body, 0) > 0:
+      nacks[body] -= 1
+      raise Nack()
+    return body
+  server = MuxServer(handle, loop=loop)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  return server, server.sockets[0].getsockname()[1]
+
+
+def test_nacks_are_retried(loop):
+  nacks = {b'a': 2, b'b': 100, b'c': 0}
+  server, port = nacking_server(loop, nacks)
+  stats = InMemoryStatsReceiver()
+  retries = NackRetries(RetryBudget(min_retries_per_sec=0.5, percent_can_retry=0),
+                        max_retries=3, backoff_base=0.001, stats=stats)
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, retries=retries))
+  try:
+    a, c = loop.run_until_complete(asyncio.gather(
+        client.dispatch('/s', b'a'), client.request(b'c')))
+    assert (a.status, bytes(a.body)) == (Status.OK, b'a')
+    assert (c.status, bytes(c.body)) == (Status.OK, b'c')
+
+    # Three retries are allowed per request, then the nack is returned.
+    b = loop.run_until_complete(client.dispatch('/s', b'b'))
+    assert b.status == Status.NACK and nacks[b'b'] == 96
+
+    # The budget of five retries has now been spent.
+    b = loop.run_until_complete(client.dispatch('/s', b'b'))
+    assert b.status == Status.NACK and nacks[b'b'] == 95
+  finally:
+    client.close()
+    loop.run_until_complete(client.closed)
+    loop.run_until_complete(server.close())
+
+  snapshot = stats.snapshot()
+  assert snapshot['counters'] == dict(requeues=5, request_limit=1, budget_exhausted=1)
+  assert snapshot['histograms']['retries']['count'] == 4
+  assert snapshot['histograms']['retries']['max'] == 3
+  assert snapshot['gauges']['budget'] == 0
+
+
+def test_cancel_during_backoff(loop):
+  server, port = nacking_server(loop, {b'a': 1})
+  retries = NackRetries(backoff_base=10.0, backoff_max=10.0)
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, retries=retries))
+  try:
+    future = client.dispatch('/s', b'a')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert not future.done() and client.outstanding == 0
+    future.cancel()
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert client.outstanding == 0
+  finally:
+    client.close()
+    loop.run_until_complete(client.closed)
+    loop.run_until_complete(server.close())
+
+
+def test_pool_retries_on_another_session(loop):
+  nacks = {b'a': 1}
+  server, port = nacking_server(loop, nacks)
+  pool = loop.run_until_complete(MuxClientPool.connect(
+      '127.0.0.1', port, size=2, loop=loop, retries=NackRetries(backoff_base=0.001)))
+  try:
+    reply = loop.run_until_complete(pool.dispatch('/s', b'a'))
+    assert (reply.status, bytes(reply.body)) == (Status.OK, b'a')
+    assert nacks[b'a'] == 0
+  finally:
+    pool.close()
+    for client in pool.clients:
+      loop.run_until_complete(client.closed)
+    loop.run_until_complete(server.close())
@@ -0,0 +1,424 @@
+import time
+
+import pytest
+
+asyncio = pytest.importorskip('asyncio')
+
+from mux.client import MuxClient, MuxClientPool, NoSessionAvailable
+from mux.dtab import Dtab
+from mux.lease import LoadLessor
+from mux.server import MuxServer
+from mux.session import Nack, SessionDraining
+from mux.stats import InMemoryStatsReceiver
+from mux.tracing import Tracer, extract
+from mux.wire import (
+    FrameDecoder,
+    RdispatchOk,
+    Rdrain,
+    Rping,
+    Status,
+    Tdispatch,
+    Tdrain,
+    Tping,
+    frame,
+)
+
+
+@pytest.fixture
+def loop():
+  loop = asyncio.new_event_loop()
+  yield loop
+  loop.close()
+
+
+def handler(loop, gates):
+  def handle(request):
+    if isinstance(request, Tdispatch):
+      if request.dest == '/nack':
+        raise Nack()
+      elif request.dest == '/error':
+        raise RuntimeError('broken')
+      elif request.dest == '/context':
+        return RdispatchOk(0, (('k', 'v'),), b'with context')
+      elif request.dest == '/wait':
+        gate = gates[bytes(request.body)] = loop.create_future()
+        return gate
+      elif request.dest == '/bad':
+        return u'not bytes'
+      elif request.dest == '/trace':
+        trace = extract(request)
+        return b'sampled' if trace and trace[1].sampled else b'unsampled'
+    return b'echo:' + bytes(request.body)
+  return handle
+
+
+def start(loop, gates=None, server_stats=None, client_stats=None, server_tracer=None,
+          client_tracer=None):
+  server_kw = dict(stats=server_stats) if server_stats is not None else {}
+  client_kw = dict(stats=client_stats) if client_stats is not None else {}
+  if server_tracer is not None:
+    server_kw['tracer'] = server_tracer
+  if client_tracer is not None:
+    client_kw['tracer'] = client_tracer
+  server = MuxServer(handler(loop, gates if gates is not None else {}), loop=loop, **server_kw)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  port = server.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, **client_kw))
+  return server, client
+
+
+def stop(loop, server, client):
+  client.close()
+  loop.run_until_complete(client.closed)
+  loop.run_until_complete(server.close())
+
+
+def test_replies(loop):
+  server, client = start(loop)
+  try:
+    echo, treq, nack, error, context, bad = loop.run_until_complete(asyncio.gather(
+        client.dispatch('/echo', b'hi'),
+        client.request(b'treq'),
+        client.dispatch('/nack', b''),
+        client.dispatch('/error', b''),
+        client.dispatch('/context', b''),
+        client.dispatch('/bad', b'')))
+    assert (echo.status, bytes(echo.body)) == (Status.OK, b'echo:hi')
+    assert (treq.status, bytes(treq.body)) == (Status.OK, b'echo:treq')
+    assert nack.status == Status.NACK
+    assert (error.status, bytes(error.body)) == (Status.ERROR, b'broken')
+    assert context.contexts == (('k', 'v'),)
+    assert bad.status == Status.ERROR
+  finally:
+    stop(loop, server, client)
+
+
+def test_stats(loop):
+  stats = InMemoryStatsReceiver()
+  server, client = start(
+      loop, server_stats=stats.scope('server'), client_stats=stats.scope('client'))
+  try:
+    loop.run_until_complete(asyncio.gather(
+        client.dispatch('/echo', b'hi'),
+        client.dispatch('/nack', b''),
+        client.dispatch('/error', b''),
+        client.request(b'treq')))
+  finally:
+    stop(loop, server, client)
+
+  snapshot = stats.snapshot()
+  counters, gauges, histograms = (
+      snapshot['counters'], snapshot['gauges'], snapshot['histograms'])
+  assert counters['client/sent/Tdispatch'] == 3
+  assert counters['client/sent/Treq'] == 1
+  assert counters['server/received/Tdispatch'] == 3
+  assert counters['server/sent/Rdispatch'] == 3
+  assert counters['client/received/Rdispatch'] == 3
+  assert counters['client/received/Rreq'] == 1
+  assert counters['client/sent_bytes/Tdispatch'] == counters['server/received_bytes/Tdispatch']
+  assert counters['client/bytes_in'] == sum(
+      count for name, count in counters.items() if name.startswith('server/sent_bytes/'))
+  for side in ('client', 'server'):
+    assert counters[side + '/nacks'] == 1
+    assert counters[side + '/errors'] == 1
+  assert gauges['client/outstanding'] == 0
+  assert histograms['client/request_latency_us']['count'] == 4
+  assert histograms['server/handler_latency_us']['count'] == 4
+  assert histograms['server/decode_ns']['count'] == 4
+  assert histograms['client/encode_ns']['count'] == 4
+
+
+def test_tracing(loop):
+  client_tracer = Tracer(service_name='client', sample_rate=1)
+  server_tracer = Tracer(service_name='server', sample_rate=0)
+  server, client = start(loop, server_tracer=server_tracer, client_tracer=client_tracer)
+  try:
+    context = (('k', 'v'),)
+    echo, nack, treq = loop.run_until_complete(asyncio.gather(
+        client.dispatch('/echo', b'hi', contexts=context),
+        client.dispatch('/nack', b''),
+        client.request(b'treq')))
+    assert bytes(echo.body) == b'echo:hi'
+  finally:
+    stop(loop, server, client)
+
+  client_spans = dict((span.name, span) for span in client_tracer.spans.drain())
+  server_spans = dict((span.name, span) for span in server_tracer.spans.drain())
+  assert sorted(client_spans) == sorted(server_spans) == ['/echo', '/nack', 'treq']
+  for name, span in client_spans.items():
+    assert [value for _, value in span.annotations] == ['cs', 'cr']
+    assert [value for _, value in server_spans[name].annotations] == ['sr', 'ss']
+    assert server_spans[name].trace_id == span.trace_id and server_spans[name].shared
+  assert client_spans['/nack'].error == server_spans['/nack'].error == 'nack'
+  assert client_spans['/echo'].error is None
+
+
+def test_server_decides_sampling(loop):
+  server, client = start(loop, server_tracer=Tracer(sample_rate=1))
+  try:
+    reply = loop.run_until_complete(client.dispatch('/trace', b''))
+  finally:
+    stop(loop, server, client)
+  assert bytes(reply.body) == b'sampled'
+
+
+def test_server_keeps_unsampled_decision(loop):
+  server_tracer = Tracer(sample_rate=1)
+  server, client = start(loop, server_tracer=server_tracer, client_tracer=Tracer(sample_rate=0))
+  try:
+    reply = loop.run_until_complete(client.dispatch('/trace', b''))
+  finally:
+    stop(loop, server, client)
+  assert bytes(reply.body) == b'unsampled'
+  assert not len(server_tracer.spans)
+
+
+def test_pool_routes_around_revoked_leases(loop):
+  server = MuxServer(handler(loop, {}), loop=loop)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  port = server.sockets[0].getsockname()[1]
+  pool = loop.run_until_complete(MuxClientPool.connect('127.0.0.1', port, size=2, loop=loop))
+  try:
+    loop.run_until_complete(asyncio.gather(*[pool.dispatch('/echo', b'') for _ in range(4)]))
+    assert all(client.outstanding == 0 for client in pool.clients)
+
+    revoked = next(iter(server.sessions))
+    revoked.issue_lease(0)
+    loop.run_until_complete(asyncio.sleep(0.02))
+    leased = [client for client in pool.clients if client.available]
+    assert len(leased) == 1
+    requests = [pool.request(str(k).encode('utf-8')) for k in range(10)]
+    assert leased[0].outstanding == 10
+    loop.run_until_complete(asyncio.gather(*requests))
+
+    server.issue_lease(0)
+    loop.run_until_complete(asyncio.sleep(0.02))
+    with pytest.raises(NoSessionAvailable):
+      loop.run_until_complete(pool.dispatch('/echo', b''))
+
+    server.issue_lease(None)
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert all(client.available for client in pool.clients)
+  finally:
+    pool.close()
+    for client in pool.clients:
+      loop.run_until_complete(client.closed)
+    loop.run_until_complete(server.close())
+
+
+def test_load_lessor(loop):
+  gates = {}
+  stats = InMemoryStatsReceiver()
+  server, client = start(loop, gates)
+  lessor = LoadLessor(server, max_inflight=2, lease=0.5, interval=0.01, stats=stats).start()
+  try:
+    loop.run_until_complete(asyncio.sleep(0.03))
+    assert 0.4 < client.lease_remaining <= 0.5
+
+    waiting = [client.dispatch('/wait', str(k).encode('utf-8')) for k in range(2)]
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert lessor.overloaded and lessor.inflight == 2
+    assert not client.available
+
+    for gate in gates.values():
+      gate.set_result(b'done')
+    loop.run_until_complete(asyncio.gather(*waiting))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert not lessor.overloaded and client.available
+    assert stats.snapshot()['counters']['revocations'] == 1
+
+    lessor.stop()
+    loop.run_until_complete(asyncio.sleep(0.02))
+    assert client.lease_remaining is None
+  finally:
+    lessor.stop()
+    stop(loop, server, client)
+
+  with pytest.raises(ValueError):
+    LoadLessor(server)
+
+
+def test_load_lessor_event_loop_lag(loop):
+  stats = InMemoryStatsReceiver()
+  server, client = start(loop)
+  lessor = LoadLessor(server, max_lag=0.02, lease=0.5, interval=0.01, stats=stats).start()
+  try:
+    loop.run_until_complete(asyncio.sleep(0.03))
+    loop.call_soon(time.sleep, 0.05)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert stats.snapshot()['counters']['revocations'] >= 1
+    assert not lessor.overloaded and client.available
+  finally:
+    lessor.stop()
+    stop(loop, server, client)
+
+
+def test_out_of_order_replies_and_inline_pings(loop):
+  gates = {}
+  server, client = start(loop, gates)
+  try:
+    slow = client.dispatch('/wait', b'slow')
+    fast = client.dispatch('/wait', b'fast')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    (session,) = server.sessions
+    assert session.inflight == 2
+
+    # pings are answered while requests are still outstanding
+    assert isinstance(loop.run_until_complete(client.ping()), Rping)
+
+    gates[b'fast'].set_result(b'fast reply')
+    assert bytes(loop.run_until_complete(fast).body) == b'fast reply'
+    assert not slow.done()
+
+    gates[b'slow'].set_result(b'slow reply')
+    assert bytes(loop.run_until_complete(slow).body) == b'slow reply'
+  finally:
+    stop(loop, server, client)
+
+
+def test_discard_cancels_handler(loop):
+  gates = {}
+  server, client = start(loop, gates)
+  try:
+    request = client.dispatch('/wait', b'discard me')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    request.cancel()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert gates[b'discard me'].cancelled()
+    assert client.outstanding == 0
+  finally:
+    stop(loop, server, client)
+
+
+def test_unexpected_message_and_duplicate_tag(loop):
+  gates = {}
+  server = MuxServer(handler(loop, gates), loop=loop)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  port = server.sockets[0].getsockname()[1]
+
+  received = []
+
+  class Raw(asyncio.Protocol):
+    def connection_made(self, transport):
+      self.decoder = FrameDecoder()
+
+    def data_received(self, data):
+      received.extend(self.decoder.feed(data))
+
+  transport, _ = loop.run_until_complete(
+      loop.create_connection(Raw, '127.0.0.1', port))
+  try:
+    transport.write(frame(Tdispatch(5, (), '/wait', Dtab.empty(), b'a')))
+    transport.write(frame(Tdispatch(5, (), '/wait', Dtab.empty(), b'b')))
+    transport.write(frame(RdispatchOk(6, (), b'')))
+    transport.write(frame(Tping(7)))
+    loop.run_until_complete(asyncio.sleep(0.05))
+    # the Rping is written ahead of the coalesced Rerrs
+    assert [(packet.__class__.__name__, packet.tag) for packet in received] == [
+        ('Rping', 7), ('Rerr', 5), ('Rerr', 6)]
+  finally:
+    transport.close()
+    loop.run_until_complete(server.close())
+
+
+def test_drain(loop):
+  gates = {}
+  server, client = start(loop, gates)
+  try:
+    pending = client.dispatch('/wait', b'pending')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    closing = server.close()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert client.draining
+    with pytest.raises(SessionDraining):
+      loop.run_until_complete(client.dispatch('/echo', b''))
+    assert not closing.done()
+
+    gates[b'pending'].set_result(b'done')
+    assert bytes(loop.run_until_complete(pending).body) == b'done'
+    loop.run_until_complete(closing)
+    loop.run_until_complete(client.closed)
+    assert not server.sessions
+  finally:
+    stop(loop, server, client)
+
+
+def test_drain_waits_for_rdrain(loop):
+  gates = {}
+  server, client = start(loop, gates)
+  tdrains = []
+  client._handlers[Tdrain] = tdrains.append  # hold back the Rdrain
+  try:
+    pending = client.dispatch('/wait', b'pending')
+    loop.run_until_complete(asyncio.sleep(0.05))
+    closing = server.close()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert len(tdrains) == 1
+
+    # requests sent before the client saw the Tdrain are still answered
+    gates[b'pending'].set_result(b'done')
+    assert bytes(loop.run_until_complete(pending).body) == b'done'
+    reply = loop.run_until_complete(client.dispatch('/echo', b'in transit'))
+    assert reply.status == Status.NACK
+    assert not closing.done() and client.is_open
+
+    client.send(Rdrain(tdrains[0].tag))
+    loop.run_until_complete(closing)
+    loop.run_until_complete(client.closed)
+  finally:
+    stop(loop, server, client)
+
+
+def test_fragmented_messages_do_not_block_small_ones(loop):
+  order = []
+
+  def handle(request):
+    order.append(request.dest)
+    return request.body
+
+  server = MuxServer(handle, loop=loop, max_fragment_size=16 * 1024)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  port = server.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, max_fragment_size=16 * 1024))
+  client._transport.set_write_buffer_limits(high=64 * 1024)
+
+  try:
+    body = b'x' * (8 * 1024 * 1024)
+    big = client.dispatch('/big', body)
+    small = client.dispatch('/small', b'small')
+    assert bytes(loop.run_until_complete(small).body) == b'small'
+    reply = loop.run_until_complete(big)
+    assert order == ['/small', '/big']
+    assert len(reply.body) == len(body) and bytes(reply.body) == body
+  finally:
+    stop(loop, server, client)
+
+
+def test_cancel_while_fragments_are_sent_releases_tag(loop):
+  order = []
+
+  def handle(request):
+    order.append(request.dest)
+    return request.body
+
+  server = MuxServer(handle, loop=loop, max_fragment_size=4096)
+  loop.run_until_complete(server.listen('127.0.0.1', 0))
+  port = server.sockets[0].getsockname()[1]
+  client = loop.run_until_complete(
+      MuxClient.connect('127.0.0.1', port, loop=loop, max_fragment_size=4096))
+  client._transport.set_write_buffer_limits(high=64 * 1024)
+
+  try:
+    big = client.dispatch('/big', b'x' * (20 * 1024 * 1024))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    big.cancel()
+    reply = loop.run_until_complete(client.dispatch('/small', b'small'))
+    assert bytes(reply.body) == b'small'
+    loop.run_until_complete(asyncio.sleep(0.05))
+    assert client.outstanding == 0
+    assert order == ['/small']
+    assert not next(iter(server.sessions))._decoder._partial
+  finally:
+    stop(loop, server, client)
@@ -0,0 +1,46 @@
+from mux.stats import NULL_STATS, InMemoryStatsReceiver, NullStatsReceiver
+
+
+def test_null_stats():
+  assert not NULL_STATS.enabled
+  assert NULL_STATS.scope('client') is NULL_STATS
+  NULL_STATS.counter('a')
+  NULL_STATS.gauge('b', 1)
+  NULL_STATS.record('c', 1)
+  assert isinstance(NULL_STATS, NullStatsReceiver)
+
+
+def test_in_memory_stats():
+  stats = InMemoryStatsReceiver()
+  assert stats.enabled
+  stats.counter('requests')
+  stats.counter('requests', 2)
+  stats.gauge('depth', 5)
+  stats.gauge('depth', 3)
+  for value in range(1, 101):
+    stats.record('latency', value)
+
+  snapshot = stats.snapshot()
+  assert snapshot['counters'] == {'requests': 3}
+  assert snapshot['gauges'] == {'depth': 3}
+  latency = snapshot['histograms']['latency']
+  assert (latency['count'], latency['min'], latency['max']) == (100, 1, 100)
+  assert latency['mean'] == 50.5
+  assert (latency['p50'], latency['p99'], latency['p999']) == (50, 99, 100)
+  assert latency['p90'] == 90
+
+  stats.clear()
+  assert stats.snapshot() == dict(counters={}, gauges={}, histograms={})
+
+
+def test_scoped_stats():
+  stats = InMemoryStatsReceiver()
+  scoped = stats.scope('client').scope('session')
+  assert scoped.enabled
+  scoped.counter('bytes_in', 10)
+  scoped.gauge('queued_bytes', 0)
+  scoped.record('flush_bytes', 7)
+  snapshot = stats.snapshot()
+  assert snapshot['counters'] == {'client/session/bytes_in': 10}
+  assert snapshot['gauges'] == {'client/session/queued_bytes': 0}
+  assert snapshot['histograms']['client/session/flush_bytes']['count'] == 1
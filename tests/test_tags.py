@@ -0,0 +1,75 @@
+from mux.tags import MAX_TAG, TagPool, TagTable
+
+import pytest
+
+
+def test_tag_pool_exhaustion():
+  pool = TagPool(max_tag=4, reuse_delay=0)
+  tags = [pool.acquire() for _ in range(4)]
+  assert tags == [1, 2, 3, 4]
+  assert len(pool) == 4
+  assert pool.acquire() is None
+
+  pool.release(3)
+  assert len(pool) == 3
+  assert pool.acquire() == 3
+  assert pool.acquire() is None
+
+
+def test_tag_pool_reuse_delay():
+  pool = TagPool(reuse_delay=3)
+  first = pool.acquire()
+  pool.release(first)
+  # a released tag is not reused until reuse_delay more tags have been released after it
+  tags = [pool.acquire() for _ in range(3)]
+  assert first not in tags
+  for tag in tags:
+    pool.release(tag)
+  assert pool.acquire() == first
+  # tags[0] has only been followed by two releases, so a fresh tag is handed out instead
+  assert pool.acquire() == 5
+
+
+def test_tag_pool_bounded():
+  pool = TagPool(reuse_delay=16)
+  for _ in range(10000):
+    pool.release(pool.acquire())
+  # tags in circulation are bounded by the number in flight plus the reuse delay
+  inflight = [pool.acquire() for _ in range(100)]
+  assert max(inflight) <= 100 + 16 + 1
+
+
+def test_tag_pool_range():
+  for min_tag, max_tag in ((0, 10), (10, 5), (1, MAX_TAG + 1)):
+    with pytest.raises(ValueError):
+      TagPool(min_tag=min_tag, max_tag=max_tag)
+
+
+def test_tag_table():
+  table = TagTable(dense_limit=64)
+  assert len(table) == 0
+  assert table.get(5) is None
+
+  for tag in (1, 5, 63, 64, 1000, MAX_TAG):
+    table[tag] = 'value-%d' % tag
+  table[5] = 'replaced'
+  assert len(table) == 6
+  assert 5 in table and 64 in table and 2 not in table
+  assert table[5] == 'replaced'
+  assert table[MAX_TAG] == 'value-%d' % MAX_TAG
+  assert sorted(tag for tag, _ in table.items()) == [1, 5, 63, 64, 1000, MAX_TAG]
+
+  assert table.pop(5) == 'replaced'
+  assert table.pop(5) is None
+  del table[1000]
+  with pytest.raises(KeyError):
+    del table[1000]
+  with pytest.raises(KeyError):
+    table[2]
+  with pytest.raises(ValueError):
+    table[2] = None
+  assert len(table) == 4
+  assert sorted(table.values()) == sorted(['value-1', 'value-63', 'value-64', 'value-%d' % MAX_TAG])
+
+  table.clear()
+  assert len(table) == 0 and list(table.items()) == []
@@ -0,0 +1,170 @@
+import json
+import os
+import random
+
+import pytest
+
+from mux.dtab import Dtab
+from mux.tracing import (
+    B3_CONTEXT,
+    SAMPLED,
+    UNSAMPLED,
+    Span,
+    SpanBuffer,
+    Tracer,
+    ZipkinFileExporter,
+    decode_b3,
+    encode_b3,
+    extract,
+    with_trace,
+)
+from mux.wire import (
+    EncodingCache,
+    Fragments,
+    Packet,
+    RdispatchNack,
+    TraceFlag,
+    TraceId,
+    Tdispatch,
+    Treq,
+)
+
+
+def test_trace_flag_sampling():
+  assert TraceFlag.default().sampled is None
+  assert TraceFlag.debug().sampled is True
+  assert TraceFlag.debug().is_debug
+  assert TraceFlag.default().with_sampled(True) == SAMPLED
+  assert TraceFlag.default().with_sampled(False).sampled is False
+  assert SAMPLED.with_sampled(False).sampled is False
+  assert TraceFlag.debug().with_sampled(False).sampled is True
+
+
+def test_b3():
+  root = TraceId(0xab, 0xab, 0xab)
+  assert encode_b3(root, SAMPLED) == '00000000000000ab-00000000000000ab-1'
+  child = TraceId(0xcd, 0xab, 0x12)
+  for trace in [(root, SAMPLED), (root, TraceFlag.debug()), (root, TraceFlag.default()),
+                (child, SAMPLED.with_sampled(False)), (child, TraceFlag.default())]:
+    assert decode_b3(encode_b3(*trace)) == trace
+  assert decode_b3('463ac35c9f6413ad48485a3953bb6124-a2fb4a1d1a96d312-1')[0] == TraceId(
+      0xa2fb4a1d1a96d312, 0xa2fb4a1d1a96d312, 0x48485a3953bb6124)
+  for value in ('', 'abc', 'a-b-x', 'a-b-1-c-d', 'x-y'):
+    with pytest.raises(ValueError):
+      decode_b3(value)
+
+
+def test_extract():
+  trace = TraceId(1, 2, 3), SAMPLED
+  assert extract(Treq(1, b'', trace_id=trace[0], trace_flag=trace[1])) == trace
+  assert extract(Treq(1, b'')) is None
+  contexts = (('k', 'v'), (B3_CONTEXT, encode_b3(*trace)))
+  assert extract(Tdispatch(1, contexts, '/s', Dtab.empty(), b'')) == trace
+  assert extract(Tdispatch(1, (('k', 'v'),), '/s', Dtab.empty(), b'')) is None
+  assert extract(Tdispatch(1, ((B3_CONTEXT, 'junk'),), '/s', Dtab.empty(), b'')) is None
+
+
+def test_client_sampling():
+  never = Tracer(sample_rate=0, rng=random.Random(1))
+  always = Tracer(sample_rate=1, rng=random.Random(1))
+  trace_id, flag = never.client_trace()
+  assert trace_id.span_id == trace_id.parent_id == trace_id.trace_id
+  assert flag == UNSAMPLED and never.client_span((trace_id, flag), '/s') is None
+
+  trace_id, flag = always.client_trace()
+  assert trace_id.span_id == trace_id.parent_id == trace_id.trace_id
+  assert flag.sampled
+  assert always.client_span((trace_id, flag), '/s').name == '/s'
+
+  # Children continue the parent's trace and keep its decision, even when debug.
+  parent = TraceId(5, 4, 3)
+  child, flag = never.client_trace((parent, TraceFlag.debug()))
+  assert (child.parent_id, child.trace_id) == (5, 3) and child.span_id not in (3, 4, 5)
+  assert flag.sampled and never.client_span((child, flag), '/s') is not None
+  _, flag = always.client_trace((parent, SAMPLED.with_sampled(False)))
+  assert flag.sampled is False
+  assert always.client_span((child, flag), '/s') is None
+  _, flag = never.client_trace((parent, TraceFlag.default()))
+  assert flag.sampled is False
+
+
+def test_server_sampling():
+  never = Tracer(sample_rate=0)
+  always = Tracer(sample_rate=1)
+  encoded = Tdispatch(1, (('k', 'v'),), '/s', Dtab.empty(), b'').encode()
+  request = Packet.decode(encoded, lazy=True)
+  assert never.server_span(request) is None
+  trace_id, flag = extract(request)
+  assert flag == UNSAMPLED
+  # the decision is kept off the request, which stays undecoded
+  assert request._raw is not None and request.encode() == encoded
+
+  # An unsampled decision is kept, rather than starting a new trace.
+  assert always.server_span(request) is None
+  assert extract(request) == (trace_id, UNSAMPLED)
+  never.release(request)
+  assert extract(request) is None
+
+  request = Tdispatch(1, (), '/s', Dtab.empty(), b'')
+  span = always.server_span(request)
+  assert span.name == '/s' and not span.shared
+  assert extract(request) == (span.trace_id, SAMPLED)
+  always.release(request)
+
+  request = Treq(1, b'', trace_id=TraceId(1, 2, 3))
+  assert never.server_span(request) is None
+  assert extract(request)[1].sampled is False and request.trace_flag.sampled is None
+  never.release(request)
+
+  request = Treq(1, b'', trace_id=TraceId(1, 2, 3), trace_flag=TraceFlag.debug())
+  span = never.server_span(request)
+  assert span.shared and span.name == 'treq'
+
+
+def test_trace_context_is_encoded_apart():
+  cache = EncodingCache()
+  tracer = Tracer(sample_rate=0)
+  contexts = (('k', 'v'),)
+  for _ in range(100):
+    traced = with_trace(contexts, tracer.client_trace())
+    encoded = cache.encode_contexts(traced)
+    assert encoded == Fragments.encode_contexts(traced)
+    assert cache.decode_contexts(encoded)[1] == traced
+  assert len(cache._encoded) == len(cache._contexts) == 1
+  assert cache._encoded.evictions == cache._contexts.evictions == 0
+
+
+def test_span_buffer():
+  spans = SpanBuffer(3)
+  for k in range(5):
+    spans.append(k)
+  assert len(spans) == 3 and spans.dropped == 2
+  assert spans.drain(2) == [2, 3]
+  assert spans.drain() == [4]
+  assert spans.drain() == []
+
+
+def test_zipkin_export(tmpdir):
+  tracer = Tracer(service_name='svc', sample_rate=1)
+  span = Span(TraceId(2, 1, 1), TraceFlag.debug(), '/s')
+  span.annotate('cs')
+  span.complete('cr', RdispatchNack(1, ()))
+  tracer.record(span)
+  tracer.record(Span(TraceId(3, 3, 3), SAMPLED, 'treq', shared=True))
+
+  path = os.path.join(str(tmpdir), 'spans.json')
+  exporter = ZipkinFileExporter(tracer, path, interval=0.01, batch_size=1).start()
+  exporter.close()
+  assert exporter.exported == 2 and not len(tracer.spans)
+
+  with open(path) as fp:
+    batches = [json.loads(line) for line in fp]
+  assert [len(batch) for batch in batches] == [1, 1]
+  client, server = batches[0][0], batches[1][0]
+  assert (client['traceId'], client['id'], client['parentId']) == (
+      '0000000000000001', '0000000000000002', '0000000000000001')
+  assert [a['value'] for a in client['annotations']] == ['cs', 'cr']
+  assert client['annotations'][0]['endpoint'] == {'serviceName': 'svc'}
+  assert client['duration'] >= 0 and client['timestamp'] == client['annotations'][0]['timestamp']
+  assert client['debug'] and client['binaryAnnotations'][0]['value'] == 'nack'
+  assert 'parentId' not in server and 'timestamp' not in server
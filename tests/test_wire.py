@@ -1,5 +1,12 @@
+import socket
+import struct
+import threading
+
 from mux.dtab import Dtab
 from mux.wire import (
+    EncodingCache,
+    Fragments,
+    FrameDecoder,
     Packet,
     RdispatchError,
     RdispatchNack,
@@ -18,6 +25,14 @@ from mux.wire import (
     TraceFlag,
     TraceId,
     Treq,
+    decode_many,
+    encode_many,
+    frame,
+    TAG_FRAGMENT,
+    fragment_iov,
+    frame_iov,
+    join_bytes,
+    unframe,
 )
 
 import pytest
@@ -27,6 +42,11 @@ SHORT_MAX = 2 ** 24 - 1
 ULL_MAX = 2 ** 64 - 1
 
 
+def is_view_of(view, buf):
+  """Whether view is a memoryview of buf (which Python 2 memoryviews cannot tell.)"""
+  return isinstance(view, memoryview) and getattr(view, 'obj', buf) is buf
+
+
 @pytest.mark.randomize(('tag', 'int'), min_num=0, max_num=SHORT_MAX)
 @pytest.mark.randomize(('length', 'int'), min_num=0, max_num=ULL_MAX)
 def test_tlease(tag, length):
@@ -171,3 +191,385 @@ def test_rreq(tag):
     msg2 = Packet.decode(msg.encode())
     assert_equiv(msg, msg2)
 
+
+def test_tdispatch_dtab_from_pairs():
+  msg = Tdispatch(1, (), '/d', [('/a', '/b')], b'')
+  assert isinstance(msg.dtab, Dtab)
+  assert Packet.decode(msg.encode()).dtab == Dtab([('/a', '/b')])
+
+
+def test_decode_buffer_types():
+  msg = Tdispatch(1, (('foo', 'bar'),), '/wat', Dtab.empty(), b'payload')
+  encoded = msg.encode()
+  for buf in (encoded, bytes(encoded), memoryview(encoded)):
+    msg2 = Packet.decode(buf)
+    assert msg2.contexts == msg.contexts
+    assert msg2.dest == msg.dest
+    assert msg2.body == b'payload'
+
+  with pytest.raises(TypeError):
+    Packet.decode(u'not a buffer')
+
+
+def test_decode_body_is_view():
+  encoded = Tdispatch(1, (), '/wat', Dtab.empty(), b'x' * 1024).encode()
+  msg = Packet.decode(encoded)
+  assert isinstance(msg.body, memoryview)
+  assert is_view_of(msg.body, encoded)
+  encoded[-1:] = b'y'
+  assert msg.body[-1:] == b'y'
+
+  encoded = RreqOk(1, b'reply').encode()
+  msg = Packet.decode(encoded)
+  assert is_view_of(msg.body, encoded)
+
+
+def test_decode_truncated():
+  encoded = Tdispatch(1, (('foo', 'bar'),), '/wat', Dtab.empty(), b'').encode()
+  for length in range(4, len(encoded)):
+    with pytest.raises(ValueError):
+      Packet.decode(encoded[:length])
+
+
+def test_unframe():
+  framed = frame(Tping(7)) + frame(Rping(8))
+  consumed, msg = unframe(framed)
+  assert consumed == 8
+  assert isinstance(msg, Tping) and msg.tag == 7
+  consumed, msg = unframe(framed[consumed:])
+  assert isinstance(msg, Rping) and msg.tag == 8
+
+  for truncated in (b'', framed[:3], framed[:6]):
+    with pytest.raises(ValueError):
+      unframe(truncated)
+
+
+def make_stream():
+  msgs = [
+      Tdispatch(1, (('foo', 'bar'),), '/wat', Dtab.empty(), b'x' * 100),
+      Tping(2),
+      RreqOk(3, b'reply'),
+      Tdispatch(4, (), '/big', Dtab.empty(), b'y' * 10000),
+      Rerr(5, 'oops'),
+  ]
+  return msgs, b''.join(frame(msg) for msg in msgs)
+
+
+def test_frame_decoder_chunks():
+  msgs, stream = make_stream()
+  for chunk_size in (1, 3, 7, 64, 1000, len(stream)):
+    decoder = FrameDecoder(buffer_size=256)
+    decoded = []
+    for k in range(0, len(stream), chunk_size):
+      decoded.extend(decoder.feed(stream[k:k + chunk_size]))
+    assert len(decoder) == 0
+    assert [msg.tag for msg in decoded] == [msg.tag for msg in msgs]
+    assert [msg.encode() for msg in decoded] == [msg.encode() for msg in msgs]
+    assert decoded[0].body == b'x' * 100
+    assert decoded[3].body == b'y' * 10000
+
+
+def test_decode_many():
+  msgs, stream = make_stream()
+  assert encode_many(msgs) == stream
+
+  for buf in (stream, bytearray(stream), memoryview(stream)):
+    decoded, consumed = decode_many(buf)
+    assert consumed == len(stream)
+    assert [msg.encode() for msg in decoded] == [msg.encode() for msg in msgs]
+
+  decoded, consumed = decode_many(stream[:-1], lazy=True)
+  assert [msg.tag for msg in decoded] == [1, 2, 3, 4]
+  assert consumed == len(stream) - len(frame(msgs[-1]))
+  assert decoded[0].dest == '/wat'
+  assert decode_many(b'') == ([], 0)
+
+  with pytest.raises(ValueError):
+    decode_many(struct.pack('>I', 2) + b'..')
+
+
+def test_frame_decoder_views_survive_buffer_turnover():
+  decoder = FrameDecoder(buffer_size=64)
+  first, = decoder.feed(frame(RreqOk(1, b'a' * 40)))
+  for tag in range(2, 50):
+    decoder.feed(frame(RreqOk(tag, b'b' * 40)))
+  assert first.body == b'a' * 40
+
+
+def test_frame_decoder_recv_into():
+  msgs, stream = make_stream()
+  left, right = socket.socketpair()
+  try:
+    decoder = FrameDecoder(buffer_size=512)
+    decoded = []
+    left.sendall(stream)
+    while len(decoded) < len(msgs):
+      decoded.extend(decoder.recv_into(right))
+    assert [msg.tag for msg in decoded] == [msg.tag for msg in msgs]
+    left.close()
+    with pytest.raises(EOFError):
+      decoder.recv_into(right)
+  finally:
+    left.close()
+    right.close()
+
+
+def test_frame_decoder_errors():
+  decoder = FrameDecoder(max_frame_size=16)
+  with pytest.raises(ValueError):
+    decoder.feed(frame(RreqOk(1, b'x' * 100)))
+
+  # a malformed frame is skipped and packets decoded before it are not lost
+  decoder = FrameDecoder()
+  with pytest.raises(ValueError):
+    decoder.feed(frame(Tping(1)) + struct.pack('>I', 4) + b'\x7f\x00\x00\x02')
+  assert [msg.tag for msg in decoder.feed(frame(Tping(3)))] == [1, 3]
+
+
+def test_encode_into():
+  msgs, stream = make_stream()
+  buf = bytearray(len(stream) + 10)
+  offset = 10
+  for msg in msgs:
+    start = offset + 4
+    offset = msg.encode_into(buf, start)
+    assert offset - start == msg.encoded_size()
+    struct.pack_into('>I', buf, start - 4, offset - start)
+  assert buf[10:] == stream
+
+  with pytest.raises(ValueError):
+    Tping(1).encode_into(bytearray(3))
+  with pytest.raises(ValueError):
+    Tping(1).encode_into(bytearray(8), 5)
+
+
+def test_frame_iov():
+  body = b'z' * 100000
+  msg = Tdispatch(1, (('foo', 'bar'),), '/wat', Dtab.empty(), body)
+  iov = frame_iov(msg)
+  assert iov[-1] is body
+  assert join_bytes(iov) == frame(msg)
+
+  for msg in make_stream()[0]:
+    assert join_bytes(frame_iov(msg)) == frame(msg)
+
+  left, right = socket.socketpair()
+  try:
+    iov = frame_iov(RreqOk(3, b'reply'))
+    if hasattr(left, 'sendmsg'):
+      left.sendmsg(iov)
+    else:  # Python 2
+      left.sendall(join_bytes(iov))
+    decoder = FrameDecoder()
+    msg, = decoder.recv_into(right)
+    assert msg.tag == 3 and msg.body == b'reply'
+  finally:
+    left.close()
+    right.close()
+
+
+def test_unknown_message_type():
+  for typ in (0, 3, -3, 127):
+    with pytest.raises(ValueError):
+      Packet.decode(struct.pack('>bBH', typ, 0, 1))
+
+
+def test_string_fragments():
+  for encode, decode, length in (
+      (Fragments.encode_s1, Fragments.decode_s1, 255),
+      (Fragments.encode_s2, Fragments.decode_s2, 65535),
+      (Fragments.encode_s4, Fragments.decode_s4, 65536)):
+    string = u'x' * length
+    assert decode(b'..' + encode(string), 2) == (len(encode(string)), string)
+
+  with pytest.raises(ValueError):
+    Fragments.encode_s1(u'x' * 256)
+
+
+def test_fragment_iov():
+  body = b''.join(struct.pack('>I', k) for k in range(2500))
+  msg = Tdispatch(3, (('foo', 'bar'),), '/wat', Dtab.empty(), body)
+
+  unfragmented, = fragment_iov(msg, len(msg.encode()))
+  assert join_bytes(unfragmented) == frame(msg)
+
+  fragments = list(fragment_iov(msg, 1000))
+  sizes = [struct.unpack('>I', bytes(fragment[0][:4]))[0] for fragment in fragments]
+  assert sizes[:-1] == [1004] * (len(fragments) - 1)
+  assert sum(size - 4 for size in sizes) == len(msg.encode()) - 4
+  tags = [struct.unpack('>I', bytes(fragment[0][4:8]))[0] & 0xFFFFFF for fragment in fragments]
+  assert tags[:-1] == [3 | TAG_FRAGMENT] * (len(fragments) - 1) and tags[-1] == 3
+  assert is_view_of(fragments[-1][-1], body)
+
+  decoder = FrameDecoder()
+  stream = join_bytes(join_bytes(fragment) for fragment in fragments)
+  msg2, = decoder.feed(stream)
+  assert msg2.tag == 3 and msg2.contexts == msg.contexts and msg2.body == body
+
+
+def test_frame_decoder_interleaved_fragments():
+  big1 = Tdispatch(1, (), '/one', Dtab.empty(), b'1' * 10000)
+  big2 = RdispatchOk(2, (), b'2' * 7000)
+  small = Tping(3)
+
+  frags1, frags2 = list(fragment_iov(big1, 512)), list(fragment_iov(big2, 512))
+  stream = []
+  for k in range(max(len(frags1), len(frags2))):
+    stream.extend(frags1[k:k + 1] + frags2[k:k + 1])
+    if k == 5:
+      stream.append(frame_iov(small))
+
+  decoder = FrameDecoder(buffer_size=1024)
+  decoded = []
+  for iov in stream:
+    decoded.extend(decoder.feed(join_bytes(iov)))
+
+  assert [msg.tag for msg in decoded] == [3, 2, 1]
+  assert decoded[1].body == big2.body
+  assert decoded[2].body == big1.body
+
+
+def test_frame_decoder_fragment_limits():
+  msg = RdispatchOk(4, (), b'x' * 5000)
+  decoder = FrameDecoder(max_message_size=4096)
+  with pytest.raises(ValueError):
+    for iov in fragment_iov(msg, 1000):
+      decoder.feed(join_bytes(iov))
+
+  # discarding a tag drops its partially reassembled message
+  decoder = FrameDecoder()
+  fragments = list(fragment_iov(msg, 1000))
+  for iov in fragments[:-1]:
+    assert decoder.feed(join_bytes(iov)) == []
+  decoder.discard(4)
+  unfragmented, = decoder.feed(frame(RdispatchOk(4, (), b'fresh')))
+  assert unfragmented.body == b'fresh'
+
+
+def test_lazy_tdispatch():
+  contexts = (('foo', 'bar'), ('bork', 'bonk'))
+  dtab = Dtab([('/s', '/b')])
+  msg = Tdispatch(5, contexts, '/wat', dtab, b'payload')
+  encoded = msg.encode()
+
+  lazy = Packet.decode(encoded, lazy=True)
+  assert lazy._contexts is None and lazy._dest is None and lazy._dtab is None
+  assert lazy.body == b'payload'
+  assert lazy.dest == '/wat'
+  assert lazy._contexts is None
+  assert lazy.contexts == contexts
+  assert lazy.dtab == dtab
+
+  # unmodified lazy messages re-encode by passing the raw header fields through
+  lazy = Packet.decode(encoded, lazy=True)
+  lazy.tag = 6
+  parts = lazy.encode_parts()
+  assert is_view_of(parts[1], encoded)
+  assert lazy.encode() == Tdispatch(6, contexts, '/wat', dtab, b'payload').encode()
+  assert lazy._contexts is None
+
+  # reassigning any field re-encodes from the decoded values
+  lazy = Packet.decode(encoded, lazy=True)
+  lazy.dest = '/other'
+  assert lazy.contexts == contexts and lazy.dtab == dtab
+  assert lazy.encode() == Tdispatch(5, contexts, '/other', dtab, b'payload').encode()
+
+  for length in range(4, len(encoded) - len(b'payload')):
+    with pytest.raises(ValueError):
+      Packet.decode(encoded[:length], lazy=True)
+
+
+def test_lazy_rdispatch():
+  contexts = (('foo', 'bar'),)
+  encoded = RdispatchOk(5, contexts, b'reply').encode()
+
+  lazy = Packet.decode(encoded, lazy=True)
+  assert lazy._contexts is None
+  assert lazy.encode() == encoded
+  assert (lazy.status, lazy.contexts, lazy.body) == (0, contexts, b'reply')
+
+  lazy.contexts = ()
+  assert lazy.encode() == RdispatchOk(5, (), b'reply').encode()
+
+  # messages without a lazy form decode normally
+  assert Packet.decode(Tping(3).encode(), lazy=True).tag == 3
+  decoder = FrameDecoder(lazy=True)
+  msg, = decoder.feed(frame(RdispatchOk(5, contexts, b'reply')))
+  assert msg._contexts is None and msg.contexts == contexts
+
+
+def test_encoding_cache():
+  cache = EncodingCache(max_entries=4)
+  contexts = (('foo', 'bar'), ('bork', 'bonk'))
+  encoded = cache.encode_contexts(contexts)
+  assert encoded == Fragments.encode_contexts(contexts)
+  assert cache.encode_contexts(tuple(contexts)) is encoded
+  assert cache.encode_contexts([['foo', 'bar']]) == Fragments.encode_contexts([('foo', 'bar')])
+
+  # identical raw blocks decode to the same tuple
+  consumed, decoded = cache.decode_contexts(b'..' + encoded, 2)
+  assert consumed == len(encoded) and decoded == contexts
+  assert cache.decode_contexts(bytearray(encoded))[1] is decoded
+
+  dtab = Dtab([('/s', '/b')])
+  encoded_dtab = cache.encode_dtab(dtab)
+  assert cache.encode_dtab(dtab) is encoded_dtab
+  _, decoded_dtab = cache.decode_dtab(encoded_dtab)
+  assert decoded_dtab == dtab
+  assert cache.decode_dtab(memoryview(encoded_dtab))[1] is decoded_dtab
+  assert cache.encode_dtab(decoded_dtab) == encoded_dtab
+
+
+def test_encoding_cache_bytes_bound():
+  cache = EncodingCache(max_entries=100, max_bytes=1024)
+  blocks = [Fragments.encode_contexts((('key', str(k) * 100),)) for k in range(10)]
+  decoded = [cache.decode_contexts(memoryview(block))[1] for block in blocks]
+  assert decoded[-1] == (('key', '9' * 100),)
+  assert cache._contexts.total_bytes <= 1024 and len(cache._contexts) < 10
+  # Too large to cache at all, but still decoded.
+  huge = Fragments.encode_contexts((('key', 'x' * 1024),))
+  assert cache.decode_contexts(huge)[1] == (('key', 'x' * 1024),)
+  assert huge not in cache._contexts
+
+
+def test_encoding_cache_threads():
+  cache = EncodingCache(max_entries=16)
+  blocks = [Fragments.encode_contexts((('key', str(k)),)) for k in range(64)]
+  results = []
+
+  def decode():
+    for k in range(1000):
+      results.append(cache.decode_contexts(blocks[k % 64])[1] == (('key', str(k % 64)),))
+
+  threads = [threading.Thread(target=decode) for _ in range(8)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert all(results) and len(results) == 8000
+  contexts = cache._contexts
+  assert len(contexts) <= 16
+  assert contexts.total_bytes == sum(size for _, size in contexts._entries.values())
+
+
+def test_decoded_contexts_are_shared():
+  contexts = (('foo', 'bar'),)
+  encoded = Tdispatch(1, contexts, '/wat', Dtab([('/a', '/b')]), b'').encode()
+  msg1, msg2 = Packet.decode(encoded), Packet.decode(bytes(encoded))
+  assert msg1.contexts is msg2.contexts
+  assert msg1.dtab is msg2.dtab
+
+
+def test_messages_are_slotted():
+  def subclasses(cls):
+    for subclass in cls.__subclasses__():
+      yield subclass
+      for descendant in subclasses(subclass):
+        yield descendant
+
+  for cls in [Packet, TraceId, TraceFlag] + list(subclasses(Packet)):
+    assert '__slots__' in cls.__dict__, cls.__name__
+
+  msg = Packet.decode(Tdispatch(1, (), '/s', Dtab.empty(), b'').encode())
+  assert not hasattr(msg, '__dict__')
+  assert not hasattr(Dtab.empty(), '__dict__')